@@ -1,65 +1,301 @@
 '''
-input: content.json
-output: inverted_index.json
+input: content.json (a JSON array of {doc_id, title, url, content})
+output: <output_dir>/inverted_index_<shard>.bin, <output_dir>/inverted_index_<shard>.json, <output_dir>/routing.json,
+        <output_dir>/content.{offsets,records}, <output_dir>/corpus_stats.json, <output_dir>/doc_lengths.bin
+
+Single-pass, memory-bounded (SPIMI) index construction:
+    1. Documents are streamed from the JSON array, never loaded all at once
+    2. Batches are tokenized/lemmatized across a process pool
+    3. Postings accumulate in memory until the budget is reached, then the run is
+       sorted by term and spilled to disk in the binary index format
+    4. All runs are k-way merged term by term into the final per-shard outputs,
+       routed by first character, by hash or by size-balanced term ranges (see test/shard_router.py)
+
+Usage: python create_ii.py output.json binary_index --workers 8 --memory-mb 512 --router range --shards 32
 '''
 
 import nltk
 nltk.download('wordnet')
 nltk.download('stopwords')
+import argparse
+import heapq
 import json
-import re
-from collections import defaultdict
-from nltk.stem import WordNetLemmatizer
-from nltk.corpus import stopwords
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import deque
+from itertools import groupby
+from multiprocessing import Pool
 
-# Initialize lemmatizer and stopwords
-lemmatizer = WordNetLemmatizer()
-stop_words = set(stopwords.words('english'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test'))
+from binary_index import write_index, PostingsShard
+from doc_store import build_doc_store
+from corpus_stats import save_corpus_stats
+from text_analysis import analyze_text
+from json_stream import iter_json_array
+from shard_router import ShardedIndexWriter, make_router, merged_term_sizes, FIRST_CHAR_SHARDS
+
+# Rough in-memory cost of one posting and of one position, used against the memory budget
+POSTING_BYTES = 200
+POSITION_BYTES = 36
+# Maximum number of runs opened at once during a merge
+MERGE_FAN_IN = 64
 
 def preprocess_text(text):
     """
     Preprocess text, including lowercase, removing stopwords, non-alphabetic characters, and lemmatization
     """
-    text = text.lower()
-    words = re.findall(r'\b\w+\b', text)
-    words = [lemmatizer.lemmatize(word) for word in words if word not in stop_words]
-    return words
+    # Shared with the doc store's token offsets, so index positions map back to byte ranges
+    return analyze_text(text)
 
-def build_inverted_index(json_file_path, limit=None):
+def analyze_batch(batch):
     """
-    Build inverted index from given JSON file, including term frequency, term positions and total document terms
+    Worker: tokenize a batch of (doc_id, content) pairs
+    :return: [(doc_id, words, token_offsets), ...] in input order
     """
-    with open(json_file_path, 'r', encoding='utf-8') as file:
-        data = json.load(file)
+    return [(doc_id, *analyze_text(content, with_offsets=True)) for doc_id, content in batch]
 
-    if limit:
-        data = data[:limit]  # Limit the number of documents to process
+def iter_batches(records, batch_size, limit=None):
+    """Group the streamed records into lists of batch_size documents"""
+    batch = []
+    for count, record in enumerate(records):
+        if limit and count >= limit:
+            break
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
-    inverted_index = defaultdict(lambda: defaultdict(lambda: {"tf": 0, "positions": [], "total_terms": 0}))
+def parallel_analyze(batches, pool, max_pending):
+    """
+    Analyze batches in the pool, yielding (batch, results) in input order
+    At most max_pending batches are in flight, so reading never runs ahead of the workers
+    """
+    pending = deque()
+    for batch in batches:
+        payload = [(record['doc_id'], record.get('content') or '') for record in batch]
+        if pool is None:
+            yield batch, analyze_batch(payload)
+            continue
+        pending.append((batch, pool.apply_async(analyze_batch, (payload,))))
+        if len(pending) >= max_pending:
+            batch, result = pending.popleft()
+            yield batch, result.get()
+    while pending:
+        batch, result = pending.popleft()
+        yield batch, result.get()
 
-    for record in data:
-        doc_id = record['doc_id']  # Extract document ID
-        content = record['content']  # Extract document content
+class SpimiIndexer:
+    """
+    Accumulates postings for one run and spills sorted runs to disk when the budget is exceeded
+    :param run_dir: Directory for the temporary run files
+    :param memory_bytes: Approximate budget for the in-memory postings
+    """
 
-        # Preprocess content
-        words = preprocess_text(content)
-        total_terms = len(words)
+    def __init__(self, run_dir, memory_bytes):
+        self.run_dir = run_dir
+        self.memory_bytes = memory_bytes
+        self.postings = {}  # term -> {doc_id: [positions]}
+        self.used = 0
+        self.runs = []
 
-        # Build inverted index
+    def add(self, doc_id, words):
+        doc_id = int(doc_id)
+        postings = self.postings
         for position, word in enumerate(words, start=1):
-            inverted_index[word][doc_id]["tf"] += 1
-            inverted_index[word][doc_id]["positions"].append(position)
-            inverted_index[word][doc_id]["total_terms"] = total_terms
+            docs = postings.get(word)
+            if docs is None:
+                docs = postings[word] = {}
+            positions = docs.get(doc_id)
+            if positions is None:
+                positions = docs[doc_id] = []
+                self.used += POSTING_BYTES
+            positions.append(position)
+        self.used += POSITION_BYTES * len(words)
+        if self.used >= self.memory_bytes:
+            self.spill()
+
+    def spill(self):
+        """Write the current run sorted by term, using the binary index format"""
+        if not self.postings:
+            return
+        path = os.path.join(self.run_dir, f"run_{len(self.runs):05d}.bin")
+        terms = sorted(self.postings, key=lambda t: t.encode('utf-8'))
+        write_index(path, (
+            (term, {doc_id: {"tf": len(positions), "positions": positions}
+                    for doc_id, positions in self.postings[term].items()})
+            for term in terms
+        ))
+        print(f"Spilled run {len(self.runs)}: {len(terms)} terms (~{self.used / 2 ** 20:.0f} MB)")
+        self.runs.append(path)
+        self.postings = {}
+        self.used = 0
+
+    def merged(self):
+        """
+        k-way merge of all runs; with more than MERGE_FAN_IN runs, groups are first merged into larger runs
+        :return: iterator of (term, {doc_id: {"tf", "positions"}}) in UTF-8 byte order
+        """
+        self.spill()
+        level = 0
+        while len(self.runs) > MERGE_FAN_IN:
+            merged_runs = []
+            for i in range(0, len(self.runs), MERGE_FAN_IN):
+                group = self.runs[i:i + MERGE_FAN_IN]
+                path = os.path.join(self.run_dir, f"merge_{level}_{len(merged_runs):05d}.bin")
+                write_index(path, merge_runs(group))
+                for run in group:
+                    os.remove(run)
+                merged_runs.append(path)
+            print(f"Merged {len(self.runs)} runs into {len(merged_runs)}")
+            self.runs = merged_runs
+            level += 1
+        return merge_runs(self.runs)
+
+def merge_runs(paths):
+    """
+    k-way merge of sorted run files
+    :return: iterator of (term, {doc_id: {"tf", "positions"}}) in UTF-8 byte order
+    """
+    shards = [PostingsShard(path) for path in paths]
+    try:
+        streams = heapq.merge(
+            *(shard.iter_postings() for shard in shards),
+            key=lambda item: item[0].encode('utf-8')
+        )
+        for term, group in groupby(streams, key=lambda item: item[0]):
+            # A document is analyzed in exactly one run, so the runs' postings are disjoint
+            mapping = {}
+            for _, postings in group:
+                for i, doc_id in enumerate(postings.doc_ids):
+                    mapping[doc_id] = {"tf": postings.tfs[i], "positions": postings.positions(i)}
+            yield term, mapping
+    finally:
+        for shard in shards:
+            shard.close()
+
+class JsonShardWriter:
+    """
+    Stream one shard's postings as {term: {doc_id: {tf, positions, total_terms}}},
+    the format consumed by process_distributed_db.py
+    """
+
+    def __init__(self, path, doc_lengths):
+        self.f = open(path, 'w', encoding='utf-8')
+        self.doc_lengths = doc_lengths
+        self.count = 0
+        self.f.write('{')
+
+    def add(self, term, mapping):
+        data = {
+            str(doc_id): {**posting, "total_terms": self.doc_lengths.get(doc_id, 0)}
+            for doc_id, posting in mapping.items()
+        }
+        self.f.write((',\n' if self.count else '\n') + json.dumps(term, ensure_ascii=False) + ': ')
+        self.f.write(json.dumps(data, ensure_ascii=False))
+        self.count += 1
+
+    def close(self):
+        self.f.write('\n}\n')
+        self.f.close()
+
+def write_shards(merged, output_dir, doc_lengths, router, write_json=True):
+    """
+    Route the globally sorted term stream into per-shard files, plus routing.json
+    Every shard stays open until the end, so hash routing (non-contiguous shards) is written in one pass too
+    :param router: Term -> shard routing from shard_router.make_router
+    :return: {shard: number of terms}
+    """
+    writer = ShardedIndexWriter(router, output_dir)
+    json_writers = {}
+    try:
+        for term, mapping in merged:
+            shard = writer.add(term, mapping)
+            if shard is None or not write_json:
+                continue
+            json_writer = json_writers.get(shard)
+            if json_writer is None:
+                json_path = os.path.join(output_dir, f"inverted_index_{shard}.json")
+                json_writer = json_writers[shard] = JsonShardWriter(json_path, doc_lengths)
+            json_writer.add(term, mapping)
+    except BaseException:
+        writer.abort()
+        raise
+    finally:
+        for json_writer in json_writers.values():
+            json_writer.close()
+    if writer.skipped:
+        print(f"Skipped {writer.skipped} terms that belong to no shard")
+    return writer.close()
+
+def build_index(json_file_path, output_dir, workers=None, memory_mb=512, batch_size=256, limit=None,
+                write_json=True, router='first_char', shards=len(FIRST_CHAR_SHARDS)):
+    """
+    Build the binary shards, the document store and the corpus statistics from a JSON corpus
+    :param workers: Number of tokenizer processes (1 analyzes in this process)
+    :param memory_mb: Approximate memory budget for in-memory postings before spilling a run
+    :param limit: Only index the first `limit` documents
+    :param write_json: Also write inverted_index_<shard>.json for loading into MongoDB
+    :param router: Term routing: first_char (legacy a-z0-9 shards), hash or range (size-balanced)
+    :param shards: Number of shards for the hash and range routers
+    """
+    workers = workers or os.cpu_count() or 1
+    os.makedirs(output_dir, exist_ok=True)
+    run_dir = tempfile.mkdtemp(prefix='spimi_', dir=output_dir)
+    indexer = SpimiIndexer(run_dir, memory_mb * 2 ** 20)
+    doc_lengths = {}
+    start = time.time()
+
+    pool = Pool(workers) if workers > 1 else None
+    try:
+        def analyzed_documents():
+            batches = iter_batches(iter_json_array(json_file_path), batch_size, limit)
+            for batch, results in parallel_analyze(batches, pool, max_pending=2 * workers):
+                for record, (doc_id, words, offsets) in zip(batch, results):
+                    doc_lengths[int(doc_id)] = len(words)
+                    indexer.add(doc_id, words)
+                    # The document store is written in the same pass, with the token offsets for snippets
+                    yield {**record, 'token_offsets': offsets}
 
-    return inverted_index
+        doc_count = build_doc_store(analyzed_documents(), os.path.join(output_dir, 'content'))
+        print(f"Analyzed {doc_count} documents in {time.time() - start:.1f}s, {len(indexer.runs)} runs spilled so far")
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
-# Build inverted index
-json_file_path = 'output.json'  # Replace with your JSON file path
-# inverted_index = build_inverted_index(json_file_path, limit=5000)  # Process first 5000 data entries
-inverted_index = build_inverted_index(json_file_path)  # Process all data
+    try:
+        merged = indexer.merged()
+        # Range boundaries need the term sizes up front: one extra pass over the final runs' dictionaries
+        term_sizes = merged_term_sizes(indexer.runs) if router == 'range' else None
+        counts = write_shards(merged, output_dir, doc_lengths, make_router(router, shards, term_sizes), write_json)
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+    print(f"Wrote {len(counts)} binary index shards ({sum(counts.values())} terms, {router} routing) to {output_dir}/")
 
-# Save inverted index to file
-with open('inverted_index.json', 'w', encoding='utf-8') as f:
-    json.dump(inverted_index, f, ensure_ascii=False, indent=4)
+    # Save N, avgdl and per-document lengths so BM25 can be computed from postings alone
+    stats = save_corpus_stats(doc_lengths, output_dir)
+    print(f"Corpus statistics: N={stats['N']}, avgdl={stats['avgdl']:.2f}")
+    print(f"Inverted index construction completed in {time.time() - start:.1f}s")
+    return counts
 
-print("Inverted index construction completed")
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the inverted index, document store and corpus statistics")
+    parser.add_argument("json_file", nargs="?", default="output.json", help="JSON array of documents")
+    parser.add_argument("output_dir", nargs="?", default="binary_index",
+                        help="Output directory (copy the .bin/routing/content/stats files into test/cache to serve them)")
+    parser.add_argument("--workers", type=int, default=None, help="Tokenizer processes (default: CPU count)")
+    parser.add_argument("--memory-mb", type=int, default=512, help="Approximate postings memory before spilling a run")
+    parser.add_argument("--batch-size", type=int, default=256, help="Documents per worker task")
+    parser.add_argument("--limit", type=int, default=None, help="Only index the first N documents")
+    parser.add_argument("--no-json", action="store_true", help="Skip the per-shard JSON files used for MongoDB")
+    parser.add_argument("--router", choices=["first_char", "hash", "range"], default="first_char",
+                        help="Term to shard routing (hash/range balance the shard sizes)")
+    parser.add_argument("--shards", type=int, default=len(FIRST_CHAR_SHARDS), help="Shard count for hash/range routing")
+    args = parser.parse_args()
+    build_index(args.json_file, args.output_dir, args.workers, args.memory_mb, args.batch_size, args.limit,
+                write_json=not args.no_json, router=args.router, shards=args.shards)
@@ -0,0 +1,91 @@
+'''
+Incremental JSON readers for corpus files that are too large for json.load
+'''
+
+import json
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+
+
+class _Buffer:
+    """A sliding text window over a file, refilled on demand"""
+
+    def __init__(self, file, chunk_size):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.text = file.read(chunk_size)
+        self.pos = 0
+        self.eof = not self.text
+
+    def fill(self):
+        """Drop the consumed prefix and append more text (at least doubling the window)"""
+        more = self.file.read(max(self.chunk_size, len(self.text) - self.pos))
+        if not more:
+            self.eof = True
+            return False
+        self.text = self.text[self.pos:] + more
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Skip whitespace and return the next character, or '' at end of file"""
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Expected {char!r} at offset {self.pos} of the current window")
+        self.pos += 1
+
+    def decode(self):
+        """Decode one JSON value starting at the next non-whitespace character"""
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.text, self.pos)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            # A value ending exactly at the window edge (e.g. a number) may continue in the next chunk
+            if end == len(self.text) and not self.eof and self.fill():
+                continue
+            self.pos = end
+            return value
+
+
+def _iter_container(path, opening, closing, read_item, chunk_size):
+    with open(path, 'r', encoding='utf-8') as f:
+        buf = _Buffer(f, chunk_size)
+        buf.expect(opening)
+        if buf.peek() == closing:
+            return
+        while True:
+            yield read_item(buf)
+            char = buf.peek()
+            if char == closing:
+                return
+            buf.expect(',')
+
+
+def iter_json_array(path, chunk_size=1 << 20):
+    """
+    Yield the elements of a top-level JSON array one at a time
+    Memory use is bounded by the chunk size and the largest single element
+    """
+    return _iter_container(path, '[', ']', lambda buf: buf.decode(), chunk_size)
+
+
+def iter_json_object_items(path, chunk_size=1 << 20):
+    """Yield the (key, value) pairs of a top-level JSON object one at a time"""
+    def read_item(buf):
+        key = buf.decode()
+        buf.expect(':')
+        return key, buf.decode()
+    return _iter_container(path, '{', '}', read_item, chunk_size)
@@ -1,96 +1,272 @@
 '''
-input: inverted_index_XXX.json files (where XXX represents the starting letter of terms)
+input: inverted_index_XXX.json files (XXX is the shard name from routing.json, by default the terms' first letter)
 output: MongoDB database with multiple collections (inverted_index_XXX)
+
+Each file is parsed incrementally and bulk-inserted (unordered) into a staging collection,
+several files at a time. Progress is checkpointed per file so an interrupted load resumes where it stopped,
+and the staging collection atomically replaces the live one when the file is complete.
+
+Usage: python process_distributed_db.py <directory> --workers 8
 '''
 
+import argparse
 import json
 import os
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
 from tqdm import tqdm  # Used for progress bar
 
-def process_distributed_files(directory_path):
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test'))
+from binary_index import IndexWriter, write_index, shard_file_name
+from corpus_stats import save_corpus_stats, doc_lengths_from_postings
+from json_stream import iter_json_object_items
+from shard_router import ROUTING_FILE
+
+# Default MongoDB server the collections are loaded into
+MONGO_URI = 'mongodb://35.214.111.75:27017'
+DATABASE = 'search_db'
+# Per-shard progress files live here, inside the directory being loaded
+CHECKPOINT_DIR = '.mongo_load_checkpoints'
+STAGING_SUFFIX = '__staging'
+DUPLICATE_KEY = 11000
+
+def list_shard_files(directory_path):
+    return sorted(f for f in os.listdir(directory_path)
+                  if f.startswith('inverted_index_') and f.endswith('.json'))
+
+def checkpoint_path(directory_path, filename):
+    return os.path.join(directory_path, CHECKPOINT_DIR, filename)
+
+def read_checkpoint(path, source_stat):
+    """
+    Return the saved progress for a shard file, or None if there is none
+    or the source file has changed since it was written
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            checkpoint = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if checkpoint.get('size') != source_stat.st_size or checkpoint.get('mtime_ns') != source_stat.st_mtime_ns:
+        return None
+    return checkpoint
+
+def write_checkpoint(path, source_stat, terms_loaded, done=False):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({
+            'size': source_stat.st_size,
+            'mtime_ns': source_stat.st_mtime_ns,
+            'terms_loaded': terms_loaded,
+            'done': done,
+        }, f)
+    os.replace(path + '.tmp', path)
+
+def insert_unordered(collection, batch):
+    """
+    Unordered bulk insert. Duplicate-key errors are ignored, because re-inserting the
+    last batch after a crash must be harmless; any other write error is raised
+    """
+    try:
+        collection.insert_many(batch, ordered=False)
+    except BulkWriteError as e:
+        errors = [error for error in e.details.get('writeErrors', []) if error.get('code') != DUPLICATE_KEY]
+        if errors or e.details.get('writeConcernErrors'):
+            raise
+
+def load_shard_file(directory_path, filename, mongo_uri=MONGO_URI, batch_size=1000, resume=True):
+    """
+    Stream one inverted_index_XXX.json file into its MongoDB collection
+    The data goes into inverted_index_XXX__staging and is renamed over the live collection only once
+    it is complete, so a crash never leaves an empty or half-loaded shard behind
+    :return: (collection name, number of terms in the collection)
+    """
+    collection_suffix = filename.replace('inverted_index_', '').replace('.json', '')
+    collection_name = f'inverted_index_{collection_suffix}'
+    file_path = os.path.join(directory_path, filename)
+    source_stat = os.stat(file_path)
+    progress_path = checkpoint_path(directory_path, filename)
+
+    client = MongoClient(mongo_uri)
+    try:
+        db = client[DATABASE]
+        staging = db[collection_name + STAGING_SUFFIX]
+        collections = set(db.list_collection_names())
+        has_staging = staging.name in collections
+        checkpoint = read_checkpoint(progress_path, source_stat) if resume else None
+        if checkpoint and checkpoint['done']:
+            if has_staging:
+                # Interrupted between marking the load done and the rename; the staging count was verified
+                print(f"{filename}: finishing interrupted rename")
+                staging.rename(collection_name, dropTarget=True)
+            else:
+                print(f"{filename}: already loaded, skipping")
+            return collection_name, db[collection_name].estimated_document_count()
+
+        skip = checkpoint['terms_loaded'] if checkpoint else 0
+        if skip and not has_staging and collection_name in collections:
+            # Checkpoints written before the done marker preceded the rename: the rename already happened
+            print(f"{filename}: staging already renamed, marking done")
+            write_checkpoint(progress_path, source_stat, skip, done=True)
+            return collection_name, db[collection_name].estimated_document_count()
+        if skip and (not has_staging or staging.count_documents({}) < skip):
+            print(f"{filename}: staging collection is missing or incomplete, reloading from the start")
+            skip = 0
+        if skip:
+            print(f"{filename}: resuming after {skip} terms")
+        else:
+            staging.drop()
+        # The unique index makes replayed batches idempotent and is carried over by the rename
+        staging.create_index('term', unique=True)
+
+        loaded = 0
+        batch = []
+        with tqdm(desc=collection_name, unit=' terms', initial=skip) as pbar:
+            for term, term_data in iter_json_object_items(file_path):
+                if loaded < skip:
+                    loaded += 1
+                    continue
+                batch.append({"term": term, "data": term_data})
+                if len(batch) >= batch_size:
+                    insert_unordered(staging, batch)
+                    loaded += len(batch)
+                    pbar.update(len(batch))
+                    batch = []
+                    write_checkpoint(progress_path, source_stat, loaded)
+            if batch:
+                insert_unordered(staging, batch)
+                loaded += len(batch)
+                pbar.update(len(batch))
+
+        # Never replace the live collection with a staging collection that is missing terms
+        count = staging.count_documents({})
+        if count != loaded:
+            raise RuntimeError(f"{filename}: staging has {count} terms, expected {loaded}; "
+                               f"{collection_name} was left untouched")
+        # Mark the load done before the rename, so a crash in between finishes the rename on the next run
+        write_checkpoint(progress_path, source_stat, loaded, done=True)
+        # Atomically replace the live collection
+        staging.rename(collection_name, dropTarget=True)
+        return collection_name, loaded
+    finally:
+        client.close()
+
+def process_distributed_files(directory_path, mongo_uri=MONGO_URI, workers=4, batch_size=1000, resume=True):
     """
     Process all distributed inverted index files in the directory, each file corresponds to a MongoDB collection
+    Several shard files are parsed and loaded concurrently, each in its own process with its own client
     :param directory_path: Path to directory containing inverted index files
+    :param workers: Number of shard files loaded at the same time
+    :param resume: Continue from the per-shard checkpoints of an interrupted run
     """
-    # Connect to MongoDB
-    client = MongoClient('mongodb://35.214.111.75:27017')
-    db = client['search_db']
-    
-    # Get all inverted index files
-    files = [f for f in os.listdir(directory_path) 
-             if f.startswith('inverted_index_') and f.endswith('.json')]
-    
+    files = list_shard_files(directory_path)
     print(f"Found {len(files)} inverted index files")
-    
-    # Process each file
-    for filename in files:
-        # Get collection name suffix from filename (e.g.: inverted_index_a.json -> a)
-        collection_suffix = filename.replace('inverted_index_', '').replace('.json', '')
-        collection_name = f'inverted_index_{collection_suffix}'
-        
-        print(f"\nProcessing file: {filename}")
-        print(f"Corresponding collection: {collection_name}")
-        
-        # Get or create corresponding collection
-        collection = db[collection_name]
-        
-        # Empty existing collection (optional)
-        collection.drop()
-        
-        file_path = os.path.join(directory_path, filename)
-        try:
-            # Load JSON file
-            with open(file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            total_terms = len(data)
-            print(f"File contains {total_terms} terms")
-            
-            # Batch insert data
-            batch_size = 1000
-            batch = []
-            processed_terms = 0
-            
-            with tqdm(total=total_terms, desc="Processing progress") as pbar:
-                for term, term_data in data.items():
-                    batch.append({
-                        "term": term,
-                        "data": term_data
-                    })
-                    
-                    if len(batch) >= batch_size:
-                        collection.insert_many(batch)
-                        processed_terms += len(batch)
-                        pbar.update(len(batch))
-                        batch = []
-                
-                # Insert remaining data
-                if batch:
-                    collection.insert_many(batch)
-                    processed_terms += len(batch)
-                    pbar.update(len(batch))
-            
-            # Create index for each collection
-            print(f"Creating index for collection {collection_name}...")
-            collection.create_index("term")
-            
-            print(f"Successfully processed {processed_terms} terms")
-            
-        except Exception as e:
-            print(f"Error processing file {filename}: {str(e)}")
-    
-    print("\nAll database collections built!")
-    
+
+    start = time.time()
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(load_shard_file, directory_path, filename, mongo_uri, batch_size, resume): filename
+            for filename in files
+        }
+        for future in as_completed(futures):
+            filename = futures[future]
+            try:
+                collection_name, count = future.result()
+                print(f"Successfully loaded {count} terms into {collection_name}")
+            except Exception as e:
+                failed.append(filename)
+                print(f"Error processing file {filename}: {str(e)}")
+
+    print(f"\nAll database collections built in {time.time() - start:.1f}s!")
+    if failed:
+        print(f"Failed files (re-run to resume them): {', '.join(sorted(failed))}")
+
     # Print all created collections
+    client = MongoClient(mongo_uri)
+    db = client[DATABASE]
     collections = db.list_collection_names()
-    inverted_index_collections = [c for c in collections if c.startswith('inverted_index_')]
+    inverted_index_collections = [c for c in collections
+                                  if c.startswith('inverted_index_') and not c.endswith(STAGING_SUFFIX)]
     print("\nCreated inverted index collections:")
     for collection in sorted(inverted_index_collections):
-        count = db[collection].count_documents({})
+        count = db[collection].estimated_document_count()
         print(f"- {collection}: {count} terms")
+    client.close()
+    return failed
+
+def export_shard_file(file_path, output_path, doc_lengths):
+    """
+    Stream one inverted_index_XXX.json file into a binary shard, collecting document lengths on the way
+    Files written by create_ii.py are already in term order and are converted one term at a time;
+    a file that is not sorted is detected and falls back to sorting all of its terms in memory
+    :return: number of terms written
+    """
+    writer = IndexWriter(output_path)
+    previous = None
+    for term, postings in iter_json_object_items(file_path):
+        key = term.encode('utf-8')
+        if previous is not None and key <= previous:
+            break
+        previous = key
+        doc_lengths_from_postings(postings, doc_lengths)
+        writer.add(term, postings)
+    else:
+        return writer.close()
+
+    writer.abort()
+    print(f"{file_path}: terms are not sorted, sorting them in memory")
+    data = {}
+    for term, postings in iter_json_object_items(file_path):
+        doc_lengths_from_postings(postings, doc_lengths)
+        data[term] = postings
+    terms = sorted(data, key=lambda t: t.encode('utf-8'))
+    return write_index(output_path, ((term, data[term]) for term in terms))
+
+def export_binary_shards(directory_path, output_dir):
+    """
+    Convert every inverted_index_XXX.json file into the compressed binary shard format
+    read by test/search_func.py (inverted_index_XXX.bin), and save the corpus statistics
+    (N, avgdl, document lengths) collected from the postings' total_terms
+    :param directory_path: Path to directory containing inverted index files
+    :param output_dir: Directory the .bin shards are written to
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    files = [f for f in os.listdir(directory_path)
+             if f.startswith('inverted_index_') and f.endswith('.json')]
+    doc_lengths = {}
+
+    for filename in files:
+        shard = filename.replace('inverted_index_', '').replace('.json', '')
+        output_path = os.path.join(output_dir, shard_file_name(shard))
+        count = export_shard_file(os.path.join(directory_path, filename), output_path, doc_lengths)
+        print(f"Wrote {count} terms to {output_path}")
+
+    # The shards are only readable with the term routing they were built with
+    routing_path = os.path.join(directory_path, ROUTING_FILE)
+    if os.path.exists(routing_path):
+        shutil.copy2(routing_path, os.path.join(output_dir, ROUTING_FILE))
+    elif os.path.exists(os.path.join(output_dir, ROUTING_FILE)):
+        os.remove(os.path.join(output_dir, ROUTING_FILE))
+
+    stats = save_corpus_stats(doc_lengths, output_dir)
+    print(f"Corpus statistics: N={stats['N']}, avgdl={stats['avgdl']:.2f}")
 
 if __name__ == "__main__":
-    # Specify directory containing inverted index files
-    directory = "/Users/luzer/Downloads/inverted_index"  # Replace with your directory path
-    process_distributed_files(directory)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Load inverted_index_XXX.json files into MongoDB and export binary shards")
+    # Directory containing inverted index files
+    parser.add_argument("directory", nargs="?", default="/Users/luzer/Downloads/inverted_index")
+    parser.add_argument("--uri", default=MONGO_URI, help="MongoDB connection string")
+    parser.add_argument("--workers", type=int, default=4, help="Shard files loaded concurrently")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Terms per unordered bulk insert")
+    parser.add_argument("--no-resume", action="store_true", help="Ignore checkpoints and reload every shard")
+    args = parser.parse_args()
+    process_distributed_files(args.directory, args.uri, args.workers, args.batch_size, resume=not args.no_resume)
+
+    # Also emit the binary shards served by search_func (replaces the pickle caches)
+    binary_output = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test', 'cache')
+    export_binary_shards(args.directory, binary_output)
\ No newline at end of file
@@ -6,8 +6,8 @@ createApp({
             title: 'DeepSearch',
             searchQuery: '',
             searchType: 'or',  // 默认使用 OR 搜索
-            allResults: [],      // 存储所有搜索结果
-            currentResults: [],  // 当前页显示的结果
+            currentResults: [],  // 当前页显示的结果（由服务器分页返回）
+            searchCursor: null,  // 服务器返回的翻页游标
             searched: false,   // 是否已搜索
             loading: false,    // 是否正在加载
             currentPage: 1,      // 当前页码
@@ -25,6 +25,8 @@ createApp({
             suggestions: [],     // 查询建议列表
             showSuggestions: false, // 是否显示建议
             suggestionsLoading: false, // 建议加载状态
+            suggestTimer: null,  // 输入停顿后再请求建议的定时器
+            suggestSeq: 0,       // 建议请求的序号，只显示最新一次请求的结果
             searchTime: null,  // 添加搜索用时字段
         }
     },
@@ -154,11 +156,14 @@ createApp({
             
             // 保存当前查询
             this.lastSearchQuery = this.searchQuery;
+            // 丢弃还没返回的输入建议，避免搜索之后建议框又弹出来
+            clearTimeout(this.suggestTimer);
+            this.suggestSeq++;
             
             // 清空之前的结果
             this.loading = true
-            this.allResults = []
             this.currentResults = []
+            this.searchCursor = null
             this.searched = false
             this.currentPage = 1
             this.showSuggestions = false; // 隐藏建议
@@ -173,27 +178,7 @@ createApp({
             
             try {
                 console.log('发送查询:', this.searchQuery)
-                const requestData = {
-                    query: this.searchQuery,
-                    type: this.searchType,
-                };
-                
-                const response = await fetch(this.apiUrl, {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json',
-                    },
-                    body: JSON.stringify(requestData)
-                })
-
-                console.log('响应状态:', response.status, response.statusText)
-                
-                // 检查响应是否成功
-                if (!response.ok) {
-                    throw new Error(`HTTP错误: ${response.status}`);
-                }
-                
-                const data = await response.json()
+                const data = await this.fetchPage(1)
                 console.log('后端返回的数据:', data)
                 
                 // 详细记录结果内容
@@ -207,23 +192,21 @@ createApp({
 
                 if (data.error) {
                     console.error('搜索错误:', data.error)
-                    this.allResults = []
+                    this.currentResults = []
                     this.totalResults = 0
                 } else {
-                    // 保存所有结果
-                    this.allResults = Array.isArray(data.results) ? data.results : []
+                    // 服务器只返回当前页，总数和游标用于之后翻页
+                    this.currentResults = Array.isArray(data.results) ? data.results : []
                     this.totalResults = data.count || 0
-                    console.log(`成功接收结果: ${this.allResults.length} 条`)
-                    
-                    // 更新当前页
-                    this.updatePage(1)
+                    this.searchCursor = data.cursor || null
+                    this.currentPage = 1
+                    console.log(`成功接收结果: ${this.currentResults.length} / ${this.totalResults} 条`)
                 }
                 this.searched = true
                 this.searchTime = data.elapsed_time || null
 
             } catch (error) {
                 console.error('搜索出错:', error)
-                this.allResults = []
                 this.currentResults = []
                 this.totalResults = 0
                 this.searched = true
@@ -232,12 +215,48 @@ createApp({
             }
         },
         
+        // 向服务器请求某一页的结果（翻页时带上游标，服务器直接使用缓存的排序结果）
+        async fetchPage(pageNum) {
+            const requestData = {
+                query: this.lastSearchQuery,
+                type: this.searchType,
+                page: pageNum,
+                page_size: this.pageSize,
+                cursor: pageNum > 1 ? this.searchCursor : null,
+            };
+            
+            const response = await fetch(this.apiUrl, {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                },
+                body: JSON.stringify(requestData)
+            })
+
+            console.log('响应状态:', response.status, response.statusText)
+            
+            // 检查响应是否成功
+            if (!response.ok) {
+                throw new Error(`HTTP错误: ${response.status}`);
+            }
+            
+            return await response.json()
+        },
+        
         // 更新当前页显示的结果
-        updatePage(pageNum) {
-            this.currentPage = pageNum
-            const startIndex = (pageNum - 1) * this.pageSize
-            const endIndex = Math.min(startIndex + this.pageSize, this.allResults.length)
-            this.currentResults = this.allResults.slice(startIndex, endIndex)
+        async updatePage(pageNum) {
+            this.loading = true
+            try {
+                const data = await this.fetchPage(pageNum)
+                this.currentResults = Array.isArray(data.results) ? data.results : []
+                this.totalResults = data.count || 0
+                this.searchCursor = data.cursor || this.searchCursor
+                this.currentPage = pageNum
+            } catch (error) {
+                console.error('翻页出错:', error)
+            } finally {
+                this.loading = false
+            }
             
             // 滚动到页面顶部
             window.scrollTo(0, 0)
@@ -252,8 +271,8 @@ createApp({
         
         clearSearch() {
             this.searchQuery = ''
-            this.allResults = []
             this.currentResults = []
+            this.searchCursor = null
             this.totalResults = 0
             this.currentPage = 1
             this.searched = false
@@ -413,32 +432,54 @@ createApp({
             }
         },
         
-        // 显示查询建议
+        // 显示查询建议（聚焦搜索框时，针对上次提交的查询，等待 LLM 扩展）
         async showQuerySuggestions() {
             // 如果没有上次的查询，不显示建议
             if (!this.lastSearchQuery) return;
             
             this.suggestionsLoading = true;
             this.showSuggestions = true;
-            
+            await this.fetchSuggestions(this.lastSearchQuery, true);
+            this.suggestionsLoading = false;
+        },
+        
+        // 输入时的查询建议：停顿 150ms 后请求本地补全（不等待 LLM，服务端在输入停下来之后才在后台生成扩展）
+        onQueryInput() {
+            clearTimeout(this.suggestTimer);
+            const query = this.searchQuery.trim();
+            if (query.length < 2) {
+                this.suggestSeq++;
+                this.showSuggestions = false;
+                return;
+            }
+            this.suggestTimer = setTimeout(async () => {
+                if (await this.fetchSuggestions(query, false)) {
+                    this.showSuggestions = this.suggestions.length > 0;
+                }
+            }, 150);
+        },
+        
+        // 请求查询建议，较早发出、较晚返回的请求结果被丢弃（返回 false）
+        async fetchSuggestions(query, expand) {
+            const seq = ++this.suggestSeq;
+            let suggestions = [];
             try {
                 const response = await fetch(
-                    `http://${window.location.hostname}:${window.location.port}/api/query-suggestions?query=${encodeURIComponent(this.lastSearchQuery)}`
+                    `http://${window.location.hostname}:${window.location.port}/api/query-suggestions?query=${encodeURIComponent(query)}${expand ? '&expand=true' : ''}`
                 );
                 
                 if (response.ok) {
                     const data = await response.json();
-                    this.suggestions = data.suggestions;
+                    suggestions = data.suggestions;
                 } else {
                     console.error('获取查询建议失败:', response.statusText);
-                    this.suggestions = [];
                 }
             } catch (error) {
                 console.error('获取查询建议错误:', error);
-                this.suggestions = [];
-            } finally {
-                this.suggestionsLoading = false;
             }
+            if (seq !== this.suggestSeq) return false;
+            this.suggestions = suggestions;
+            return true;
         },
         
         // 选择建议
@@ -471,6 +512,35 @@ createApp({
             });
             
             return highlightedContent + '...';
+        },
+
+        // 转义 HTML 特殊字符
+        escapeHtml(text) {
+            return text
+                .replace(/&/g, '&amp;')
+                .replace(/</g, '&lt;')
+                .replace(/>/g, '&gt;')
+                .replace(/"/g, '&quot;')
+                .replace(/'/g, '&#39;');
+        },
+
+        // 渲染服务端生成的摘要：按 highlights 区间（UTF-16 码元下标，与 slice 一致）高亮，没有区间时退回到按关键词高亮
+        renderSnippet(result) {
+            if (!result.snippet) {
+                return this.highlightKeywords(result.content && result.content.substring(0, 200), result.keywords);
+            }
+            if (!result.highlights) {
+                return this.highlightKeywords(this.escapeHtml(result.snippet), result.keywords);
+            }
+            let html = '';
+            let last = 0;
+            result.highlights.forEach(([start, end]) => {
+                if (start < last) return;
+                html += this.escapeHtml(result.snippet.slice(last, start));
+                html += '<span class="highlight-keyword">' + this.escapeHtml(result.snippet.slice(start, end)) + '</span>';
+                last = end;
+            });
+            return html + this.escapeHtml(result.snippet.slice(last));
         }
     },
 }).mount('#app')
@@ -1,5 +1,7 @@
 import fasttext
 import spacy
+from functools import lru_cache
+from typing import Optional
 from symspellpy.symspellpy import SymSpell, Verbosity
 
 model = fasttext.load_model("query_classifier.bin")
@@ -16,12 +18,17 @@ STOPWORDS = {
     "he", "she", "us", "you", "they", "me", "if", "any", "there", "about"
 }
 
+# Upper bound (entries) of the memo caches for spaCy / SymSpell results
+NLP_CACHE_SIZE = 4096
 
+
+@lru_cache(maxsize=NLP_CACHE_SIZE)
 def spacy_preprocess(text: str):
     """
     Use spaCy for tokenization and dependency analysis, merging (compound + NOUN/PROPN) into a single phrase.
     Returns list: [(token_text, token_pos), ...]
     Preserves original case for proper PROPN recognition.
+    Results are memoized (bounded LRU), so callers must not mutate the returned tuple.
     """
     doc = nlp(text)
     tokens_out = []
@@ -50,7 +57,19 @@ def spacy_preprocess(text: str):
         else:
             tokens_out.append((token.orth_, token.pos_))
 
-    return tokens_out
+    return tuple(tokens_out)
+
+
+@lru_cache(maxsize=NLP_CACHE_SIZE)
+def correct_spelling(word: str) -> Optional[str]:
+    """
+    SymSpell closest-match correction for a lowercase word (memoized)
+    Returns None if there is no suggestion, so callers keep the original token (and its case).
+    """
+    suggestions = sym_spell.lookup(word, Verbosity.CLOSEST, max_edit_distance=2)
+    if suggestions:
+        return suggestions[0].term
+    return None
 
 
 def classify_query_with_model(q: str) -> str:
@@ -89,9 +108,9 @@ def parse_boolean_query(q: str) -> str:
             continue
 
         # For regular words, apply spell correction
-        suggestions = sym_spell.lookup(token_text_stripped.lower(), Verbosity.CLOSEST, max_edit_distance=2)
-        if suggestions:
-            corrected_tokens.append(suggestions[0].term)
+        corrected = correct_spelling(token_text_stripped.lower())
+        if corrected is not None:
+            corrected_tokens.append(corrected)
         else:
             corrected_tokens.append(token_text_stripped)
 
@@ -128,6 +147,7 @@ def parse_boolean_query(q: str) -> str:
     return " AND ".join(subexps)
 
 
+@lru_cache(maxsize=NLP_CACHE_SIZE)
 def build_query(q: str) -> str:
 
     return parse_boolean_query(q)
@@ -157,9 +177,9 @@ def parse_phrase_query(q: str) -> str:
             corrected_tokens.append(token_text_stripped)
             continue
 
-        suggestions = sym_spell.lookup(token_text_stripped.lower(), Verbosity.CLOSEST, max_edit_distance=2)
-        if suggestions:
-            corrected_tokens.append(suggestions[0].term)
+        corrected = correct_spelling(token_text_stripped.lower())
+        if corrected is not None:
+            corrected_tokens.append(corrected)
         else:
             corrected_tokens.append(token_text_stripped)
 
@@ -0,0 +1,391 @@
+'''
+二进制倒排索引格式（替代按首字母切分的 pickle 缓存）
+
+文件布局（小端序）：
+    header:  magic(8s) version(u32) n_terms(u32) dict_offset(u64)
+    postings 区：每个词一个 postings 块，紧密排列
+    词典区（位于 dict_offset）：
+        term_offsets: (n_terms + 1) 个 u64，指向词字符串区内的偏移
+        entries:      n_terms 条 (postings_offset u64, postings_len u32, df u32, max_tf u32)
+        词字符串区:   按 UTF-8 字节序排列的全部词
+
+postings 块（varint 编码）：
+    df
+    df 个文档ID差值（第一个为绝对值）
+    df 个 tf
+    df 个位置块字节长度
+    df 个位置块，每块为 tf 个位置差值
+
+读取时用 mmap 打开，按词二分查找词典，只解码查询用到的 postings，
+位置列表在真正访问时才解码。
+'''
+
+import mmap
+import os
+import struct
+
+MAGIC = b"DSIDX001"
+VERSION = 1
+HEADER = struct.Struct("<8sIIQ")
+ENTRY = struct.Struct("<QIII")
+OFFSET = struct.Struct("<Q")
+
+
+def encode_varint(value, out):
+    """把非负整数以 varint 形式追加到 bytearray"""
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_varints(buf, pos, count):
+    """
+    从 buf 的 pos 处连续解码 count 个 varint
+    :return: (整数列表, 解码结束后的位置)
+    """
+    values = []
+    append = values.append
+    for _ in range(count):
+        result = 0
+        shift = 0
+        while True:
+            byte = buf[pos]
+            pos += 1
+            result |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        append(result)
+    return values, pos
+
+
+def encode_gaps(sorted_values, out):
+    """把升序整数列表按差值 varint 编码"""
+    previous = 0
+    for value in sorted_values:
+        encode_varint(value - previous, out)
+        previous = value
+
+
+def decode_gaps(buf, pos, count):
+    """解码差值编码的升序整数列表"""
+    gaps, pos = decode_varints(buf, pos, count)
+    total = 0
+    for i, gap in enumerate(gaps):
+        total += gap
+        gaps[i] = total
+    return gaps, pos
+
+
+def encode_postings(postings):
+    """
+    编码单个词的 postings
+    :param postings: {doc_id: {"tf": int, "positions": [int, ...]}}，doc_id 需可转换为整数
+    :return: (bytes, df, max_tf)
+    """
+    items = sorted((int(doc_id), data) for doc_id, data in postings.items())
+    out = bytearray()
+    encode_varint(len(items), out)
+    encode_gaps([doc_id for doc_id, _ in items], out)
+    max_tf = 0
+    for _, data in items:
+        encode_varint(data["tf"], out)
+        max_tf = max(max_tf, data["tf"])
+    blocks = []
+    for _, data in items:
+        block = bytearray()
+        encode_gaps(sorted(data["positions"]), block)
+        blocks.append(block)
+    for block in blocks:
+        encode_varint(len(block), out)
+    for block in blocks:
+        out += block
+    return bytes(out), len(items), max_tf
+
+
+class TermPostings:
+    """
+    单个词的 postings：升序的整数文档ID数组、对应的 tf 数组，位置列表惰性解码
+    """
+    __slots__ = ("term", "doc_ids", "tfs", "_buf", "_position_starts", "_positions", "_max_tf")
+
+    def __init__(self, term, doc_ids, tfs, buf=None, position_starts=None, positions=None, max_tf=None):
+        self.term = term
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self._buf = buf
+        self._position_starts = position_starts
+        self._positions = positions
+        self._max_tf = max_tf
+
+    @classmethod
+    def from_mapping(cls, term, mapping):
+        """从 pickle/MongoDB 中的 {doc_id: {"tf", "positions"}} 结构构造"""
+        items = sorted((int(doc_id), data) for doc_id, data in mapping.items())
+        return cls(
+            term,
+            [doc_id for doc_id, _ in items],
+            [data["tf"] for _, data in items],
+            positions=[data["positions"] for _, data in items],
+        )
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    @property
+    def df(self):
+        return len(self.doc_ids)
+
+    @property
+    def max_tf(self):
+        if self._max_tf is None:
+            self._max_tf = max(self.tfs) if self.tfs else 0
+        return self._max_tf
+
+    def positions(self, i):
+        """返回第 i 个文档中该词的位置列表（升序）"""
+        if self._positions is not None:
+            return self._positions[i]
+        values, _ = decode_gaps(self._buf, self._position_starts[i], self.tfs[i])
+        return values
+
+    def to_mapping(self):
+        """转换回 {str(doc_id): {"tf", "positions"}} 结构，兼容旧的字典式访问"""
+        return {
+            str(doc_id): {"tf": self.tfs[i], "positions": self.positions(i)}
+            for i, doc_id in enumerate(self.doc_ids)
+        }
+
+
+def decode_postings(term, buf, max_tf=None):
+    """解码一个 postings 块，位置列表保留在 buf 中惰性解码"""
+    df, pos = decode_varints(buf, 0, 1)
+    df = df[0]
+    doc_ids, pos = decode_gaps(buf, pos, df)
+    tfs, pos = decode_varints(buf, pos, df)
+    block_lengths, pos = decode_varints(buf, pos, df)
+    position_starts = []
+    for block_length in block_lengths:
+        position_starts.append(pos)
+        pos += block_length
+    return TermPostings(term, doc_ids, tfs, buf=buf, position_starts=position_starts, max_tf=max_tf)
+
+
+class PostingsShard:
+    """
+    通过 mmap 打开的一个二进制倒排索引分片
+    支持 `term in shard` 和 `shard[term]`，与原先 pickle 反序列化出的字典用法一致
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n_terms, dict_offset = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} 不是二进制倒排索引文件")
+        if version != VERSION:
+            raise ValueError(f"{path} 的索引版本 {version} 不受支持")
+        self.n_terms = n_terms
+        self._term_offsets = dict_offset
+        self._entries = dict_offset + OFFSET.size * (n_terms + 1)
+        self._term_blob = self._entries + ENTRY.size * n_terms
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+    def prefetch(self):
+        """把整个文件读入页缓存（预热用），之后的查询不再因缺页等待磁盘"""
+        if hasattr(mmap, "MADV_WILLNEED"):
+            self._mm.madvise(mmap.MADV_WILLNEED)
+        mm = self._mm
+        for offset in range(0, len(mm), mmap.PAGESIZE):
+            mm[offset]
+
+    def __len__(self):
+        return self.n_terms
+
+    def _term_bytes(self, i):
+        start = OFFSET.unpack_from(self._mm, self._term_offsets + OFFSET.size * i)[0]
+        end = OFFSET.unpack_from(self._mm, self._term_offsets + OFFSET.size * (i + 1))[0]
+        return self._mm[self._term_blob + start:self._term_blob + end]
+
+    def _find(self, term):
+        """二分查找词典，返回词的序号，不存在时返回 -1"""
+        key = term.encode("utf-8")
+        lo, hi = 0, self.n_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term_bytes(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.n_terms and self._term_bytes(lo) == key:
+            return lo
+        return -1
+
+    def _entry(self, i):
+        return ENTRY.unpack_from(self._mm, self._entries + ENTRY.size * i)
+
+    def __contains__(self, term):
+        return self._find(term) >= 0
+
+    def term_stats(self, term):
+        """
+        不解码 postings，直接从词典读取统计量
+        :return: (df, max_tf)，词不存在时返回 None
+        """
+        i = self._find(term)
+        if i < 0:
+            return None
+        _, _, df, max_tf = self._entry(i)
+        return df, max_tf
+
+    def get_postings(self, term):
+        """返回词的 TermPostings，词不存在时返回 None"""
+        i = self._find(term)
+        if i < 0:
+            return None
+        return self._decode(term, i)
+
+    def get_postings_block(self, term):
+        """
+        返回词未解码的 postings 块，用于原样转发（见 shard_server.py）
+        :return: (bytes, max_tf)，词不存在时返回 None
+        """
+        i = self._find(term)
+        if i < 0:
+            return None
+        offset, length, _, max_tf = self._entry(i)
+        return self._mm[offset:offset + length], max_tf
+
+    def _decode(self, term, i):
+        offset, length, _, max_tf = self._entry(i)
+        return decode_postings(term, self._mm[offset:offset + length], max_tf)
+
+    def __getitem__(self, term):
+        postings = self.get_postings(term)
+        if postings is None:
+            raise KeyError(term)
+        return postings.to_mapping()
+
+    def get(self, term, default=None):
+        postings = self.get_postings(term)
+        return default if postings is None else postings.to_mapping()
+
+    def terms(self):
+        """按字典序遍历分片中的所有词"""
+        for i in range(self.n_terms):
+            yield self._term_bytes(i).decode("utf-8")
+
+    def iter_term_sizes(self):
+        """按字典序遍历 (term, postings 字节数)，不解码 postings"""
+        for i in range(self.n_terms):
+            yield self._term_bytes(i).decode("utf-8"), self._entry(i)[1]
+
+    def iter_term_stats(self):
+        """按字典序遍历 (term, df, max_tf)，不解码 postings"""
+        for i in range(self.n_terms):
+            _, _, df, max_tf = self._entry(i)
+            yield self._term_bytes(i).decode("utf-8"), df, max_tf
+
+    def iter_postings(self):
+        """按字典序遍历 (term, TermPostings)"""
+        for i in range(self.n_terms):
+            term = self._term_bytes(i).decode("utf-8")
+            yield term, self._decode(term, i)
+
+
+class IndexWriter:
+    """
+    增量写出一个二进制倒排索引文件，词必须按 UTF-8 字节序严格递增地加入
+    可以同时打开多个写入器，把一个有序的词流分发到多个分片
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._tmp_path = path + ".tmp"
+        self._file = open(self._tmp_path, "wb")
+        self._file.write(HEADER.pack(MAGIC, VERSION, 0, 0))
+        self._offset = HEADER.size
+        self._term_blob = bytearray()
+        self._term_offsets = [0]
+        self._entries = []
+        self._previous = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, term, postings):
+        """:param postings: {doc_id: {"tf", "positions"}}"""
+        key = term.encode("utf-8")
+        if self._previous is not None and key <= self._previous:
+            raise ValueError(f"词必须严格按字典序写入: {term!r}")
+        self._previous = key
+        block, df, max_tf = encode_postings(postings)
+        self._file.write(block)
+        self._entries.append(ENTRY.pack(self._offset, len(block), df, max_tf))
+        self._offset += len(block)
+        self._term_blob += key
+        self._term_offsets.append(len(self._term_blob))
+
+    def close(self):
+        """写出词典并原子地替换目标文件"""
+        f = self._file
+        for value in self._term_offsets:
+            f.write(OFFSET.pack(value))
+        for entry in self._entries:
+            f.write(entry)
+        f.write(self._term_blob)
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, len(self._entries), self._offset))
+        f.close()
+        os.replace(self._tmp_path, self.path)
+        return len(self._entries)
+
+    def abort(self):
+        self._file.close()
+        os.remove(self._tmp_path)
+
+
+def write_index(path, items):
+    """
+    写出一个二进制倒排索引文件
+    :param path: 输出路径
+    :param items: 按词字典序排列的 (term, {doc_id: {"tf", "positions"}}) 迭代器，可以是流式的
+    :return: 写入的词数
+    """
+    writer = IndexWriter(path)
+    try:
+        for term, postings in items:
+            writer.add(term, postings)
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.close()
+
+
+def shard_file_name(shard):
+    return f"inverted_index_{shard}.bin"
+
+
+def write_sharded_index(inverted_index, output_dir, shard_of=lambda term: term[0]):
+    """
+    把内存中的 {term: {doc_id: {...}}} 倒排索引按分片写成多个二进制文件
+    :param shard_of: 词到分片名的映射，默认按首字符切分
+    :return: {分片名: 文件路径}
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    shards = {}
+    for term in inverted_index:
+        if term:
+            shards.setdefault(shard_of(term), []).append(term)
+    paths = {}
+    for shard, terms in shards.items():
+        terms.sort(key=lambda t: t.encode("utf-8"))
+        path = os.path.join(output_dir, shard_file_name(shard))
+        write_index(path, ((term, inverted_index[term]) for term in terms))
+        paths[shard] = path
+    return paths
@@ -0,0 +1,426 @@
+'''
+布尔查询表达式的语法树、解析和执行计划
+
+build_query 生成的表达式，如 "(python) AND ((java) OR (scala)) AND NOT (coffee) AND (machine learning)"，
+解析为语法树：
+    Term      单个词
+    Phrase    括号或引号中的多个词，要求在文档中相邻出现
+    And / Or  任意嵌套；没有运算符相连的并列子句按 OR 处理（与原来的默认或查询一致）
+    Not       作为 And 的子句时执行为集合差
+
+执行计划：
+    - And 的正子句按估计的文档数从小到大排列，最稀有的子句驱动，其余子句用跳跃查找验证
+    - Not 子句只对候选文档做跳跃查找，被排除的文档集合不会被展开
+    - Or 对各子句的文档ID流做归并
+所有算子都以升序文档ID游标衔接（next_geq），中间结果不物化成集合。
+
+本模块不访问索引：postings 和查询词的规范化由调用方（search_func.boolean_search）提供。
+'''
+
+import re
+from dataclasses import dataclass
+from typing import Tuple
+
+from query_eval import gallop, intersect, count_phrase_matches
+
+OPERATORS = ("AND", "OR", "NOT")
+TOKEN_PATTERN = re.compile(r'\(|\)|"[^"]*"?|[^\s()"]+')
+
+
+@dataclass(frozen=True)
+class Term:
+    word: str
+
+
+@dataclass(frozen=True)
+class Phrase:
+    words: Tuple[str, ...]
+
+
+@dataclass(frozen=True)
+class And:
+    children: tuple
+
+
+@dataclass(frozen=True)
+class Or:
+    children: tuple
+
+
+@dataclass(frozen=True)
+class Not:
+    child: object
+
+
+# ---------- 解析 ----------
+
+class _Parser:
+    """
+    递归下降解析，优先级 NOT > AND > OR
+    表达式来自 build_query，格式基本固定；对不匹配的括号等宽松处理，不抛出异常
+    """
+
+    def __init__(self, expression):
+        self.tokens = TOKEN_PATTERN.findall(expression)
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def take(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def starts_operand(self, token):
+        return token is not None and token != ")" and token not in ("AND", "OR")
+
+    def parse(self):
+        children = []
+        while self.pos < len(self.tokens):
+            if self.starts_operand(self.peek()):
+                children.append(self.parse_or())
+            else:
+                # 多余的 ")" 或悬空的运算符
+                self.take()
+        return _make(Or, children)
+
+    def parse_or(self):
+        children = [self.parse_and()]
+        while True:
+            token = self.peek()
+            if token == "OR":
+                self.take()
+                if self.starts_operand(self.peek()):
+                    children.append(self.parse_and())
+            elif self.starts_operand(token):
+                # 并列的子句之间没有运算符，按 OR 处理
+                children.append(self.parse_and())
+            else:
+                return _make(Or, children)
+
+    def parse_and(self):
+        children = [self.parse_unary()]
+        while self.peek() == "AND":
+            self.take()
+            if self.starts_operand(self.peek()):
+                children.append(self.parse_unary())
+        return _make(And, children)
+
+    def parse_unary(self):
+        if self.peek() == "NOT":
+            self.take()
+            if not self.starts_operand(self.peek()):
+                return None
+            child = self.parse_unary()
+            return None if child is None else Not(child)
+        return self.parse_primary()
+
+    def parse_primary(self):
+        token = self.take()
+        if token == "(":
+            # 括号中只有单词时是一个词或短语，否则是子表达式
+            end = self.pos
+            while end < len(self.tokens) and self.tokens[end] not in ("(", ")") + OPERATORS:
+                end += 1
+            if end < len(self.tokens) and self.tokens[end] == ")" or end == len(self.tokens):
+                words = [w for token in self.tokens[self.pos:end] for w in _words(token)]
+                self.pos = min(end + 1, len(self.tokens))
+                return _leaf(words)
+            node = self.parse_or()
+            if self.peek() == ")":
+                self.take()
+            return node
+        return _leaf(_words(token))
+
+
+def _words(token):
+    return token.strip('"').split()
+
+
+def _leaf(words):
+    if not words:
+        return None
+    if len(words) == 1:
+        return Term(words[0])
+    return Phrase(tuple(words))
+
+
+def _make(kind, children):
+    """去掉空子句，展开同类嵌套，单个子句直接返回"""
+    flat = []
+    for child in children:
+        if child is None:
+            continue
+        if isinstance(child, kind):
+            flat.extend(child.children)
+        elif child not in flat:
+            flat.append(child)
+    if not flat:
+        return None
+    if len(flat) == 1:
+        return flat[0]
+    return kind(tuple(flat))
+
+
+def parse_expression(expression):
+    """:return: 语法树，表达式中没有任何词时返回 None"""
+    return _Parser(expression).parse()
+
+
+# ---------- 语法树工具 ----------
+
+def to_expression(node, canonical=False):
+    """
+    把语法树转换回 build_query 风格的表达式
+    canonical 为 True 时统一小写并对 AND/OR 子句排序，用作结果缓存的键
+    """
+    if node is None:
+        return ""
+    if isinstance(node, Term):
+        return f"({node.word.lower() if canonical else node.word})"
+    if isinstance(node, Phrase):
+        words = " ".join(node.words)
+        return f"({words.lower() if canonical else words})"
+    if isinstance(node, Not):
+        child = to_expression(node.child, canonical)
+        return f"NOT ({child})" if isinstance(node.child, And) else f"NOT {child}"
+    # Or 自带括号；And 之下的 And 只在手工构造、没有展开的语法树中出现
+    parts = [to_expression(child, canonical) for child in node.children]
+    if isinstance(node, And):
+        parts = [f"({part})" if isinstance(child, And) else part for child, part in zip(node.children, parts)]
+    if canonical:
+        parts = sorted(set(parts))
+    if isinstance(node, And):
+        return " AND ".join(parts)
+    return "(" + " OR ".join(parts) + ")"
+
+
+def positive_words(node):
+    """不在 NOT 之下的全部单词，按出现顺序（用于高亮和回退的或查询）"""
+    if node is None or isinstance(node, Not):
+        return []
+    if isinstance(node, Term):
+        return [node.word]
+    if isinstance(node, Phrase):
+        return list(node.words)
+    return [word for child in node.children for word in positive_words(child)]
+
+
+def all_words(node):
+    if node is None:
+        return []
+    if isinstance(node, Term):
+        return [node.word]
+    if isinstance(node, Phrase):
+        return list(node.words)
+    if isinstance(node, Not):
+        return all_words(node.child)
+    return [word for child in node.children for word in all_words(child)]
+
+
+def relaxed_query(node):
+    """
+    放宽后的查询：正子句中的词改为或查询，顶层的 NOT 子句保留
+    结果太少时用它补充结果，而不会引入被明确排除的文档
+    """
+    words = []
+    for word in positive_words(node):
+        if word not in words:
+            words.append(word)
+    relaxed = _make(Or, [Term(word) for word in words])
+    negations = [child for child in node.children if isinstance(child, Not)] if isinstance(node, And) else []
+    if relaxed is None or not negations:
+        return relaxed
+    return And((relaxed, *negations))
+
+
+# ---------- 执行计划 ----------
+
+class _ListCursor:
+    """升序文档ID数组上的游标"""
+
+    def __init__(self, doc_ids):
+        self.doc_ids = doc_ids
+        self.i = 0
+
+    def next_geq(self, target):
+        self.i = gallop(self.doc_ids, target, self.i)
+        return self.doc_ids[self.i] if self.i < len(self.doc_ids) else None
+
+
+class _StreamCursor:
+    """惰性产生的升序文档ID流上的游标"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.current = -1
+
+    def next_geq(self, target):
+        while self.current is not None and self.current < target:
+            self.current = next(self.stream, None)
+        return self.current
+
+
+class _AndCursor:
+    def __init__(self, positives, negatives):
+        self.driver = positives[0]
+        self.others = positives[1:]
+        self.negatives = negatives
+
+    def next_geq(self, target):
+        while True:
+            doc = self.driver.next_geq(target)
+            if doc is None:
+                return None
+            for cursor in self.others:
+                found = cursor.next_geq(doc)
+                if found is None:
+                    return None
+                if found != doc:
+                    # 跳到更靠后的文档，重新由驱动子句对齐
+                    target = found
+                    break
+            else:
+                if any(cursor.next_geq(doc) == doc for cursor in self.negatives):
+                    target = doc + 1
+                    continue
+                return doc
+
+
+class _OrCursor:
+    def __init__(self, children):
+        self.children = children
+
+    def next_geq(self, target):
+        found = [doc for doc in (cursor.next_geq(target) for cursor in self.children) if doc is not None]
+        return min(found) if found else None
+
+
+class _EmptyCursor:
+    def next_geq(self, target):
+        return None
+
+
+class TermPlan:
+    def __init__(self, postings):
+        self.postings = postings
+        self.estimate = len(postings)
+
+    def cursor(self):
+        return _ListCursor(self.postings.doc_ids)
+
+
+class PhrasePlan:
+    """短语：先对各词的文档ID求交集，再只为交集中的文档检查位置"""
+
+    def __init__(self, postings_lists):
+        self.postings_lists = postings_lists
+        self.estimate = min(len(postings) for postings in postings_lists)
+
+    def _docs(self):
+        for doc_id, indices in intersect(self.postings_lists):
+            position_lists = [postings.positions(i) for postings, i in zip(self.postings_lists, indices)]
+            if count_phrase_matches(position_lists, limit=1):
+                yield doc_id
+
+    def cursor(self):
+        return _StreamCursor(self._docs())
+
+
+class AndPlan:
+    def __init__(self, positives, negatives):
+        self.positives = sorted(positives, key=lambda plan: plan.estimate)
+        self.negatives = negatives
+        self.estimate = self.positives[0].estimate
+
+    def cursor(self):
+        return _AndCursor(
+            [plan.cursor() for plan in self.positives], [plan.cursor() for plan in self.negatives]
+        )
+
+
+class OrPlan:
+    def __init__(self, children):
+        self.children = children
+        self.estimate = sum(plan.estimate for plan in children)
+
+    def cursor(self):
+        return _OrCursor([plan.cursor() for plan in self.children])
+
+
+class EmptyPlan:
+    estimate = 0
+
+    def cursor(self):
+        return _EmptyCursor()
+
+
+EMPTY = EmptyPlan()
+
+
+def plan_query(node, analyze, postings):
+    """
+    把语法树编译成执行计划
+    :param analyze: 单词 -> 索引词列表（小写化、去停用词、词形还原）
+    :param postings: 索引词 -> TermPostings（索引中没有的词不在其中）
+    :return: 执行计划；查询中只有停用词时返回 None
+    """
+    if isinstance(node, Term):
+        terms = analyze(node.word)
+        if not terms:
+            return None
+        plans = [TermPlan(postings[term]) if term in postings else EMPTY for term in terms]
+        return plans[0] if len(plans) == 1 else _and_plan(plans, [])
+    if isinstance(node, Phrase):
+        terms = [term for word in node.words for term in analyze(word)]
+        if not terms:
+            return None
+        if any(term not in postings for term in terms):
+            return EMPTY
+        if len(terms) == 1:
+            return TermPlan(postings[terms[0]])
+        return PhrasePlan([postings[term] for term in terms])
+    if isinstance(node, Not):
+        # 单独的否定没有可枚举的文档集合（And 之外的 NOT 不匹配任何文档）
+        return EMPTY
+    if isinstance(node, And):
+        positives = []
+        negatives = []
+        for child in node.children:
+            if isinstance(child, Not):
+                plan = plan_query(child.child, analyze, postings)
+                if plan is not None and plan is not EMPTY:
+                    negatives.append(plan)
+            else:
+                plan = plan_query(child, analyze, postings)
+                if plan is not None:
+                    positives.append(plan)
+        if not positives:
+            return EMPTY if negatives else None
+        return _and_plan(positives, negatives)
+    children = [plan_query(child, analyze, postings) for child in node.children]
+    children = [plan for plan in children if plan is not None]
+    if not children:
+        return None
+    children = [plan for plan in children if plan is not EMPTY]
+    if not children:
+        return EMPTY
+    return children[0] if len(children) == 1 else OrPlan(children)
+
+
+def _and_plan(positives, negatives):
+    if any(plan is EMPTY for plan in positives):
+        return EMPTY
+    if len(positives) == 1 and not negatives:
+        return positives[0]
+    return AndPlan(positives, negatives)
+
+
+def execute_plan(plan):
+    """按升序产生匹配的文档ID"""
+    cursor = plan.cursor()
+    doc = cursor.next_geq(0)
+    while doc is not None:
+        yield doc
+        doc = cursor.next_geq(doc + 1)
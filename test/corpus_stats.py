@@ -0,0 +1,169 @@
+'''
+语料统计量：文档总数 N、平均文档长度 avgdl、每篇文档的长度
+词的文档频率 df 已经保存在二进制倒排索引的词典中（binary_index.PostingsShard.term_stats）
+
+corpus_stats.json：{"N": ..., "avgdl": ..., "total_terms": ...}
+doc_lengths.bin：以 doc_id 为下标的 u32 数组（小端序），不存在的文档长度为 0
+doc_lengths.sparse：稀疏格式（增量段使用），升序的 doc_id(u64 × N) 之后是对应的长度(u32 × N)，
+    文件大小只与文档数有关；N 和 total_terms 作为元数据，合并多个段时直接相加
+
+有了这些统计量，BM25 可以直接从 postings 的 tf 计算，查询时不需要加载或分词文档内容。
+'''
+
+import json
+import math
+import os
+import sys
+from array import array
+from bisect import bisect_left
+
+STATS_FILE = "corpus_stats.json"
+DOC_LENGTHS_FILE = "doc_lengths.bin"
+SPARSE_LENGTHS_FILE = "doc_lengths.sparse"
+
+# 与 rank_bm25.BM25Okapi 相同的默认参数
+K1 = 1.5
+B = 0.75
+
+
+def bm25_idf(df, n_docs):
+    """BM25 的 idf（加 1 平滑，保证非负）"""
+    return math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+
+
+def bm25_term_score(tf, df, doc_length, n_docs, avgdl, k1=K1, b=B):
+    """单个词在单篇文档上的 BM25 得分"""
+    norm = k1 * (1 - b + b * doc_length / avgdl) if avgdl else k1
+    return bm25_idf(df, n_docs) * tf * (k1 + 1) / (tf + norm)
+
+
+def bm25_upper_bound(max_tf, df, n_docs, k1=K1, b=B):
+    """
+    单个词单文档得分的上界：得分随 tf 增大、随文档长度减小，
+    取 tf = max_tf、文档长度趋于 0 时的值
+    """
+    return bm25_idf(df, n_docs) * max_tf * (k1 + 1) / (max_tf + k1 * (1 - b))
+
+
+class CorpusStats:
+    """
+    加载好的语料统计量
+    """
+
+    def __init__(self, n_docs, avgdl, doc_lengths, total_terms=None):
+        self.n_docs = n_docs
+        self.avgdl = avgdl
+        self.total_terms = total_terms if total_terms is not None else round(n_docs * avgdl)
+        self._doc_lengths = doc_lengths
+
+    def doc_length(self, doc_id):
+        doc_id = int(doc_id)
+        if 0 <= doc_id < len(self._doc_lengths):
+            return self._doc_lengths[doc_id]
+        return 0
+
+    def __contains__(self, doc_id):
+        # 稠密表中长度为 0 与不存在无法区分
+        return self.doc_length(doc_id) > 0
+
+    def bm25(self, tf, df, doc_id):
+        return bm25_term_score(tf, df, self.doc_length(doc_id), self.n_docs, self.avgdl)
+
+    def upper_bound(self, max_tf, df):
+        return bm25_upper_bound(max_tf, df, self.n_docs)
+
+    def summary(self):
+        return {"N": self.n_docs, "avgdl": self.avgdl}
+
+
+class SparseCorpusStats(CorpusStats):
+    """
+    稀疏格式的语料统计量，doc_ids 升序，doc_lengths 与之一一对应
+    """
+
+    def __init__(self, n_docs, avgdl, doc_ids, doc_lengths, total_terms=None):
+        super().__init__(n_docs, avgdl, doc_lengths, total_terms)
+        self._doc_ids = doc_ids
+
+    def _slot(self, doc_id):
+        doc_id = int(doc_id)
+        i = bisect_left(self._doc_ids, doc_id)
+        if i < len(self._doc_ids) and self._doc_ids[i] == doc_id:
+            return i
+        return None
+
+    def doc_length(self, doc_id):
+        i = self._slot(doc_id)
+        return self._doc_lengths[i] if i is not None else 0
+
+    def __contains__(self, doc_id):
+        return self._slot(doc_id) is not None
+
+
+def save_corpus_stats(doc_lengths, directory, sparse=False):
+    """
+    保存语料统计量
+    :param doc_lengths: {doc_id: 文档经过预处理后的词数}
+    :param directory: 输出目录
+    :param sparse: 写出稀疏的 (doc_id, 长度) 表，而不是以 doc_id 为下标的数组
+    """
+    os.makedirs(directory, exist_ok=True)
+    lengths = {int(doc_id): length for doc_id, length in doc_lengths.items()}
+    if sparse:
+        doc_ids = array("Q", sorted(lengths))
+        tables = [doc_ids, array("I", (lengths[doc_id] for doc_id in doc_ids))]
+        lengths_path = os.path.join(directory, SPARSE_LENGTHS_FILE)
+    else:
+        table = array("I", bytes(4 * (max(lengths) + 1 if lengths else 0)))
+        for doc_id, length in lengths.items():
+            table[doc_id] = length
+        tables = [table]
+        lengths_path = os.path.join(directory, DOC_LENGTHS_FILE)
+    with open(lengths_path, "wb") as f:
+        for table in tables:
+            if sys.byteorder != "little":
+                table.byteswap()
+            table.tofile(f)
+
+    total_terms = sum(lengths.values())
+    stats = {
+        "N": len(lengths),
+        "avgdl": total_terms / len(lengths) if lengths else 0.0,
+        "total_terms": total_terms,
+    }
+    with open(os.path.join(directory, STATS_FILE), "w", encoding="utf-8") as f:
+        json.dump(stats, f, indent=2)
+    return stats
+
+
+def load_corpus_stats(directory):
+    """加载语料统计量（稠密或稀疏格式），文件不存在时返回 None"""
+    stats_path = os.path.join(directory, STATS_FILE)
+    sparse_path = os.path.join(directory, SPARSE_LENGTHS_FILE)
+    lengths_path = sparse_path if os.path.exists(sparse_path) else os.path.join(directory, DOC_LENGTHS_FILE)
+    if not (os.path.exists(stats_path) and os.path.exists(lengths_path)):
+        return None
+    with open(stats_path, "r", encoding="utf-8") as f:
+        stats = json.load(f)
+    with open(lengths_path, "rb") as f:
+        data = f.read()
+    if lengths_path == sparse_path:
+        split = 8 * stats["N"]
+        doc_ids, doc_lengths = array("Q", data[:split]), array("I", data[split:])
+        tables = [doc_ids, doc_lengths]
+    else:
+        doc_lengths = array("I", data)
+        tables = [doc_lengths]
+    if sys.byteorder != "little":
+        for table in tables:
+            table.byteswap()
+    if lengths_path == sparse_path:
+        return SparseCorpusStats(stats["N"], stats["avgdl"], doc_ids, doc_lengths, stats.get("total_terms"))
+    return CorpusStats(stats["N"], stats["avgdl"], doc_lengths, stats.get("total_terms"))
+
+
+def doc_lengths_from_postings(postings, doc_lengths):
+    """从旧格式 postings 中的 total_terms 字段收集文档长度"""
+    for doc_id, data in postings.items():
+        if "total_terms" in data:
+            doc_lengths[doc_id] = data["total_terms"]
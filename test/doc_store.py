@@ -0,0 +1,246 @@
+'''
+基于偏移表的文档存储（替代整体反序列化的 content_cache.pkl）
+
+<prefix>.offsets：magic(8s) slots(u64)，之后是以 doc_id 为下标的定长 u64 偏移表，0 表示文档不存在
+    稀疏格式（增量段使用，doc_id 不连续）：magic(8s) count(u64)，之后是升序的 doc_id(u64 × count)
+    和对应的偏移(u64 × count)，文件大小只与文档数有关，按 doc_id 二分查找
+<prefix>.records：magic(8s)，之后是紧密排列的文档记录
+    每条记录：各字段的字节长度(u32 × len(FIELDS))，随后依次是各字段的内容
+    title/url/content 为 UTF-8 文本；token_offsets 为每个索引位置在正文中的字节区间，
+    按 (与上一个词结尾的间隔, 词长) 做 varint 编码
+
+两个文件都通过 mmap 打开，按 doc_id 查找是 O(1) 的，并且只读取请求的字段。
+'''
+
+import mmap
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+
+from binary_index import encode_varint, decode_varints
+
+OFFSETS_MAGIC = b"DSOFF001"
+SPARSE_OFFSETS_MAGIC = b"DSOFF002"
+RECORDS_MAGIC = b"DSREC002"
+OFFSETS_HEADER = struct.Struct("<8sQ")
+OFFSET = struct.Struct("<Q")
+FIELDS = ("title", "url", "content", "token_offsets")
+TEXT_FIELDS = ("title", "url", "content")
+# 第一版记录文件没有 token_offsets 字段
+LEGACY_RECORDS_MAGIC = b"DSREC001"
+LEGACY_FIELDS = ("title", "url", "content")
+
+
+def store_paths(prefix):
+    return prefix + ".offsets", prefix + ".records"
+
+
+def store_exists(prefix):
+    return all(os.path.exists(path) for path in store_paths(prefix))
+
+
+def record_header(fields):
+    return struct.Struct("<" + "I" * len(fields))
+
+
+def encode_token_offsets(offsets):
+    out = bytearray()
+    previous_end = 0
+    for start, end in offsets:
+        encode_varint(start - previous_end, out)
+        encode_varint(end - start, out)
+        previous_end = end
+    return bytes(out)
+
+
+def decode_token_offsets(buf):
+    values, _ = decode_varints(buf, 0, count_varints(buf))
+    offsets = []
+    previous_end = 0
+    for i in range(0, len(values) - 1, 2):
+        start = previous_end + values[i]
+        previous_end = start + values[i + 1]
+        offsets.append((start, previous_end))
+    return offsets
+
+
+def count_varints(buf):
+    """varint 的个数等于最高位为 0 的字节数"""
+    return sum(1 for byte in buf if byte < 0x80)
+
+
+def build_doc_store(docs, prefix, sparse=False):
+    """
+    流式写出文档存储
+    :param docs: 文档字典的可迭代对象，需要包含 doc_id（可转换为非负整数）以及 title/url/content，
+                 token_offsets（[(byte_start, byte_end), ...]）可选，见 text_analysis.add_token_offsets
+    :param prefix: 输出文件前缀，例如 cache/content
+    :param sparse: 写出稀疏的 (doc_id, 偏移) 表，而不是以 doc_id 为下标的偏移表
+    :return: 写入的文档数
+    """
+    offsets_path, records_path = store_paths(prefix)
+    directory = os.path.dirname(prefix)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    header = record_header(FIELDS)
+    locations = {}
+    with open(records_path + ".tmp", "wb") as f:
+        f.write(RECORDS_MAGIC)
+        position = len(RECORDS_MAGIC)
+        for doc in docs:
+            values = [str(doc.get(field) or "").encode("utf-8") for field in TEXT_FIELDS]
+            values.append(encode_token_offsets(doc.get("token_offsets") or ()))
+            f.write(header.pack(*(len(value) for value in values)))
+            for value in values:
+                f.write(value)
+            locations[int(doc["doc_id"])] = position
+            position += header.size + sum(len(value) for value in values)
+
+    if sparse:
+        doc_ids = array("Q", sorted(locations))
+        tables = [doc_ids, array("Q", (locations[doc_id] for doc_id in doc_ids))]
+        header = OFFSETS_HEADER.pack(SPARSE_OFFSETS_MAGIC, len(doc_ids))
+    else:
+        slots = max(locations) + 1 if locations else 0
+        table = array("Q", bytes(OFFSET.size * slots))
+        for doc_id, position in locations.items():
+            table[doc_id] = position
+        tables = [table]
+        header = OFFSETS_HEADER.pack(OFFSETS_MAGIC, slots)
+    with open(offsets_path + ".tmp", "wb") as f:
+        f.write(header)
+        for table in tables:
+            if sys.byteorder != "little":
+                table.byteswap()
+            table.tofile(f)
+
+    os.replace(records_path + ".tmp", records_path)
+    os.replace(offsets_path + ".tmp", offsets_path)
+    return len(locations)
+
+
+class DocStore:
+    """
+    只读文档存储，`get(doc_id)` 的用法与原先的 _content_cache 字典一致
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        offsets_path, records_path = store_paths(prefix)
+        self._offsets_file = open(offsets_path, "rb")
+        self._records_file = open(records_path, "rb")
+        self._offsets = mmap.mmap(self._offsets_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._records = mmap.mmap(self._records_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.slots = OFFSETS_HEADER.unpack_from(self._offsets, 0)
+        records_magic = self._records[:len(RECORDS_MAGIC)]
+        if (magic not in (OFFSETS_MAGIC, SPARSE_OFFSETS_MAGIC)
+                or records_magic not in (RECORDS_MAGIC, LEGACY_RECORDS_MAGIC)):
+            raise ValueError(f"{prefix} 不是文档存储文件")
+        # 稀疏格式：slots 为文档数，doc_id 表读入内存，偏移表仍然从映射中读取
+        self._ids = None
+        self._table_start = OFFSETS_HEADER.size
+        if magic == SPARSE_OFFSETS_MAGIC:
+            self._ids = array("Q", self._offsets[OFFSETS_HEADER.size:OFFSETS_HEADER.size + OFFSET.size * self.slots])
+            if sys.byteorder != "little":
+                self._ids.byteswap()
+            self._table_start += OFFSET.size * self.slots
+        self.fields = FIELDS if records_magic == RECORDS_MAGIC else LEGACY_FIELDS
+        self._header = record_header(self.fields)
+
+    def close(self):
+        self._offsets.close()
+        self._records.close()
+        self._offsets_file.close()
+        self._records_file.close()
+
+    def _locate(self, doc_id):
+        try:
+            doc_id = int(doc_id)
+        except (TypeError, ValueError):
+            return 0
+        if self._ids is not None:
+            slot = bisect_left(self._ids, doc_id)
+            if slot == len(self._ids) or self._ids[slot] != doc_id:
+                return 0
+        elif doc_id < 0 or doc_id >= self.slots:
+            return 0
+        else:
+            slot = doc_id
+        return OFFSET.unpack_from(self._offsets, self._table_start + OFFSET.size * slot)[0]
+
+    def __contains__(self, doc_id):
+        return self._locate(doc_id) != 0
+
+    def doc_ids(self):
+        """按升序遍历存储中的全部 doc_id"""
+        if self._ids is not None:
+            yield from self._ids
+            return
+        table = self._offsets[OFFSETS_HEADER.size:OFFSETS_HEADER.size + OFFSET.size * self.slots]
+        for doc_id, (position,) in enumerate(OFFSET.iter_unpack(table)):
+            if position:
+                yield doc_id
+
+    def _field_span(self, position, field):
+        """返回记录中某个字段的 (起始位置, 长度)"""
+        lengths = self._header.unpack_from(self._records, position)
+        start = position + self._header.size
+        for name, length in zip(self.fields, lengths):
+            if name == field:
+                return start, length
+            start += length
+        return start, 0
+
+    def get(self, doc_id, fields=TEXT_FIELDS):
+        """
+        读取一篇文档
+        :param doc_id: 文档ID（字符串或整数）
+        :param fields: 需要读取的文本字段，默认读取 title/url/content
+        :return: {"doc_id", 字段...}，文档不存在时返回 None
+        """
+        position = self._locate(doc_id)
+        if not position:
+            return None
+        lengths = self._header.unpack_from(self._records, position)
+        start = position + self._header.size
+        document = {"doc_id": str(doc_id)}
+        for field, length in zip(self.fields, lengths):
+            if field in fields and field in TEXT_FIELDS:
+                document[field] = self._records[start:start + length].decode("utf-8")
+            start += length
+        return document
+
+    def token_offsets(self, doc_id):
+        """
+        返回每个索引位置在正文中的字节区间 [(byte_start, byte_end), ...]
+        旧格式或文档不存在时返回 None
+        """
+        position = self._locate(doc_id)
+        if not position or "token_offsets" not in self.fields:
+            return None
+        start, length = self._field_span(position, "token_offsets")
+        return decode_token_offsets(self._records[start:start + length])
+
+    def read_content_bytes(self, doc_id, byte_start, byte_end):
+        """只读取正文 UTF-8 编码中的一个字节区间（不解码），文档不存在时返回 None"""
+        position = self._locate(doc_id)
+        if not position:
+            return None
+        start, length = self._field_span(position, "content")
+        byte_end = min(byte_end, length)
+        return self._records[start + byte_start:start + byte_end]
+
+
+if __name__ == "__main__":
+    # 从 content.json 构建文档存储: python doc_store.py content.json cache/content
+    import json
+
+    from text_analysis import add_token_offsets
+
+    source, prefix = sys.argv[1], sys.argv[2]
+    with open(source, "r", encoding="utf-8") as f:
+        count = build_doc_store(add_token_offsets(json.load(f)), prefix)
+    print(f"已写入 {count} 篇文档到 {prefix}")
@@ -1,8 +1,7 @@
-import requests
+import httpx
 import json
+import os
 import sys
-import time
-from Boolean_test import build_query
 
 
 '''
@@ -14,32 +13,74 @@ sk-XXX
 模型
 deepseek-reasoner
 deepseek-chat
+
+Web 服务（main.py 的 /api/ai-stream）使用 stream_answer：在事件循环中异步读取 SSE，
+每个文本块直接转发给客户端；所有请求共享一个保持连接的连接池，不再为每个请求建立新连接、开新线程。
+ds_api 是同步版本，供命令行等非异步调用方使用。
 '''
 # 你的 DeepSeek API 密钥
-api_key = "sk-XXX"
+api_key = os.environ.get("DEEPSEEK_API_KEY", "sk-XXX")
+
+# API 地址，可以指向兼容的代理，测试时指向本地的假 SSE 服务器
+base_url = os.environ.get("DEEPSEEK_BASE_URL", "https://api.deepseek.com/v1")
 
 # API 端点（假设是 chat/completions）
-url = "https://api.deepseek.com/v1/chat/completions"
+url = base_url.rstrip("/") + "/chat/completions"
 
 # 请求头
 headers = {
     "Authorization": f"Bearer {api_key}",
     "Content-Type": "application/json"
 }
-def ds_api(question, stream_handler=None):
+
+# 连接池上限：空闲连接保留 60 秒，之后的请求复用已完成 TLS 握手的连接
+POOL_LIMITS = httpx.Limits(max_connections=50, max_keepalive_connections=20, keepalive_expiry=60)
+# read 是两个数据块之间最多等待的秒数，而不是整个回答的时长
+TIMEOUT = httpx.Timeout(connect=5.0, read=60.0, write=10.0, pool=5.0)
+
+_async_client = None
+_client = None
+
+
+class DeepSeekError(Exception):
+    """API 返回了非 200 的状态码，或者响应在 [DONE] 之前结束"""
+
+
+def get_async_client():
+    """进程内共享的异步客户端，在第一次使用时创建（预加载后 fork 的工作进程各自创建）"""
+    global _async_client
+    if _async_client is None:
+        _async_client = httpx.AsyncClient(headers=headers, limits=POOL_LIMITS, timeout=TIMEOUT)
+    return _async_client
+
+
+async def close_async_client():
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
+
+def get_client():
+    """同步调用共享的客户端"""
+    global _client
+    if _client is None:
+        _client = httpx.Client(headers=headers, limits=POOL_LIMITS, timeout=TIMEOUT)
+    return _client
+
+
+def build_payload(question, expression=None):
     """
-    调用 DeepSeek API 并处理响应
-    
     参数:
     question - 要发送的问题
-    stream_handler - 可选的回调函数，用于处理流式数据
-    
-    返回值:
-    生成的完整文本
+    expression - 可选，已经由 build_query 生成的布尔表达式（避免重复解析）
     """
-
-    question_processed = build_query(question)
-    data = {
+    if expression is None:
+        # Boolean_test 在导入时加载 fastText/spaCy/SymSpell 模型，只在需要解析问题时导入
+        from Boolean_test import build_query
+        expression = build_query(question)
+    question_processed = expression
+    return {
     "model": "deepseek-chat",
     "messages": [
         {
@@ -66,50 +107,101 @@ Provide direct answers without introductory phrases like 'Here is information ab
     "stream": True
 }
 
+
+def parse_sse_line(line):
+    """
+    解析一行 SSE 响应
+    返回值: (是否结束, 文本块)，不是数据行或没有文本时文本块为 None
+    "data:" 之后的空格可有可无（SSE 规范只去掉一个前导空格）
+    """
+    if not line.startswith('data:'):
+        return False, None
+    content = line[5:]
+    if content.startswith(' '):
+        content = content[1:]
+    if content == '[DONE]':
+        return True, None
+    try:
+        payload = json.loads(content)
+    except json.JSONDecodeError:
+        return False, None
+    # 用量统计等数据块的 choices 可能为空列表
+    choices = payload.get('choices') if isinstance(payload, dict) else None
+    if not choices or not isinstance(choices[0], dict):
+        return False, None
+    delta = choices[0].get('delta') or {}
+    return False, delta.get('content')
+
+
+async def stream_answer(question, expression=None, client=None):
+    """
+    异步调用 DeepSeek API，逐个产生回答的文本块
+    非 200 状态码、响应在 [DONE] 之前正常结束时抛出 DeepSeekError（回答不完整），
+    连接中断或超时抛出 httpx.HTTPError；
+    调用方中途停止迭代（如浏览器断开）时关闭这条连接，不占用连接池
+    """
+    client = client or get_async_client()
+    async with client.stream("POST", url, json=build_payload(question, expression)) as response:
+        if response.status_code != 200:
+            body = await response.aread()
+            raise DeepSeekError(f"请求失败，状态码：{response.status_code} {body[:200].decode('utf-8', 'replace')}")
+        done = False
+        # [DONE] 之后继续读到响应结束，完整读完的连接才会被放回连接池复用
+        async for line in response.aiter_lines():
+            if done:
+                continue
+            done, text_chunk = parse_sse_line(line)
+            if text_chunk:
+                yield text_chunk
+        if not done:
+            raise DeepSeekError("响应在 [DONE] 之前结束，回答不完整")
+
+
+def ds_api(question, stream_handler=None, expression=None):
+    """
+    调用 DeepSeek API 并处理响应（同步版本）
+
+    参数:
+    question - 要发送的问题
+    stream_handler - 可选的回调函数，用于处理流式数据
+    expression - 可选，已经由 build_query 生成的布尔表达式（避免重复解析）
+
+    返回值:
+    生成的完整文本
+    """
     full_text = ""
-    
+
     try:
-        with requests.post(url, headers=headers, json=data, stream=True) as response:
+        with get_client().stream("POST", url, json=build_payload(question, expression)) as response:
             if response.status_code == 200:
+                done = False
                 for line in response.iter_lines():
-                    if line:
-                        try:
-                            line_text = line.decode('utf-8')
-                            if line_text.startswith('data: '):
-                                content = line_text[6:]
-                                
-                                if content == '[DONE]':
-                                    break
-                                    
-                                payload = json.loads(content)
-                                delta = payload.get('choices', [{}])[0].get('delta', {})
-                                
-                                if 'content' in delta:
-                                    text_chunk = delta['content']
-                                    full_text += text_chunk
-                                    
-                                    # 控制台输出
-                                    sys.stdout.write(text_chunk)
-                                    sys.stdout.flush()
-                                    time.sleep(0.01)
-                                    
-                                    # 如果提供了流处理函数，调用它
-                                    if stream_handler:
-                                        stream_handler(text_chunk)
-                        except json.JSONDecodeError:
-                            pass
-                        except Exception as e:
-                            print(f"\n处理响应时出错: {str(e)}")
-                print()
+                    if done:
+                        continue
+                    done, text_chunk = parse_sse_line(line)
+                    if text_chunk:
+                        full_text += text_chunk
+                        # 如果提供了流处理函数，调用它
+                        if stream_handler:
+                            stream_handler(text_chunk)
             else:
                 print(f"请求失败，状态码：{response.status_code}")
-                print(response.text)
+                print(response.read().decode('utf-8', 'replace'))
     except Exception as e:
         print(f"发送请求时出错: {str(e)}")
-        
+
     return full_text
 
 if __name__ == "__main__":
+    from Boolean_test import build_query
+
     question = "what is machine learning?"
     question = build_query(question)
-    ds_api(question)
\ No newline at end of file
+
+    # 控制台输出
+    def print_chunk(text_chunk):
+        sys.stdout.write(text_chunk)
+        sys.stdout.flush()
+
+    ds_api(question, print_chunk)
+    print()
@@ -1,33 +1,43 @@
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.responses import FileResponse, StreamingResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import Optional, List, AsyncGenerator
-from search_func import or_search, and_search, phrase_search
+from search_func import or_search, and_search, phrase_search, index_version, hydrate_documents, get_snippet, SEGMENTS_PATH, CACHE_DIR, shard_cache_stats, iter_vocabulary
 import uvicorn
 import socket
-from query_parser import parse_query, parse_to_list, handle_long_query
-from retrieval_model import retrieval_sort
-from ds_api import ds_api
+from query_parser import parse_to_list, analyze_query
+from ds_api import stream_answer, close_async_client
 import asyncio
 from fastapi import applications
 from fastapi.openapi.docs import get_swagger_ui_html
 from fastapi.openapi.utils import get_openapi
-import threading
-import queue
 from query_extension import extend_query_gpt35
 import time  # 添加导入，如果尚未导入
+from result_cache import QueryResultCache, estimate_size
+from search_executor import SearchExecutor, SearchDeadline, SearchCancelled
+from segments import BackgroundMerger
+from query_log import QueryLog, QUERY_LOG_FILE
+from warmup import Warmup
+from suggest import SuggestionEngine, LLMExpander, SUGGEST_LIMIT
+from stream_hub import StreamHub, answer_key
+import os
 
 # 定义请求和响应模型
 class SearchRequest(BaseModel):
     query: str
     type: str = 'or'
+    page: int = 1  # 从 1 开始的页码
+    page_size: int = 15
+    cursor: Optional[str] = None  # 上一次响应返回的游标，翻页时复用缓存的排序结果
 
 class SearchResult(BaseModel):
     title: str
     url: str
-    content: str
+    content: Optional[str] = None  # 不再返回全文，只返回 snippet
+    snippet: Optional[str] = None  # 匹配位置最密集的一段正文
+    highlights: Optional[List[List[int]]] = None  # snippet 内需要高亮的 [起始, 结束) 下标（UTF-16 码元，与 JavaScript 一致）
     keywords: Optional[List[str]] = None
 
 class SearchResponse(BaseModel):
@@ -38,10 +48,42 @@ class SearchResponse(BaseModel):
     search_time: Optional[float] = None  # 仅搜索时间
     ai_time: Optional[float] = None  # 仅AI处理时间
     elapsed_time: Optional[float] = None  # 总时间
+    page: int = 1
+    page_size: int = 15
+    total_pages: int = 1
+    cursor: Optional[str] = None  # 翻页游标
 
 # 只创建一个FastAPI实例！
 app = FastAPI(title="搜索引擎 API")
 
+# 每页最多返回的结果数
+MAX_PAGE_SIZE = 100
+
+# 查询结果缓存：键为规范化后的布尔表达式，缓存排好序的轻量结果（不含正文），
+# 64MB 上限、10 分钟过期，索引文件变化时整体失效
+result_cache = QueryResultCache(max_bytes=64 * 1024 * 1024, ttl=600, version_fn=index_version)
+
+# 查询分析、检索和排序都在执行器中运行，事件循环只负责调度（类型/并发数/超时见 search_executor）
+search_executor = SearchExecutor()
+
+# 后台按分层策略合并增量段（SEGMENT_MERGE=0 关闭，例如由单独的进程执行 segments.py merge）
+segment_merger = BackgroundMerger(SEGMENTS_PATH) if os.environ.get("SEGMENT_MERGE", "1") != "0" else None
+
+# 查询日志：记录查询词的流行度，预热时先加载最常用的分片
+query_log = QueryLog(os.path.join(CACHE_DIR, QUERY_LOG_FILE))
+
+# 启动时在后台并行加载索引，/healthz/ready 在必需的分片加载完成后才返回 200（配置见 warmup.py）
+warmup = Warmup(query_log)
+
+# 查询建议（见 suggest.py），词表在启动后于后台线程中构建
+suggestion_engine = SuggestionEngine(query_log, iter_vocabulary, index_version)
+llm_expander = LLMExpander(extend_query_gpt35)
+# 每次最多返回的查询建议数
+MAX_SUGGEST_LIMIT = 50
+
+# AI 回答流：相同问题的并发请求合并为一个上游请求，完整的回答缓存 1 小时（16MB 上限）
+answer_hub = StreamHub()
+
 # 配置 CORS
 app.add_middleware(
     CORSMiddleware,
@@ -51,6 +93,42 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+def hydrate_page(ranked, keywords):
+    """只为当前页的文档读取标题/URL，并根据匹配位置生成摘要（不返回全文）"""
+    page_results = []
+    documents = hydrate_documents([doc["doc_id"] for doc in ranked], fields=("title", "url"))
+    for doc, document in zip(ranked, documents):
+        if document is None:
+            continue
+        try:
+            # 修复 URL
+            url = document["url"]
+            if not url.startswith(('http://', 'https://')):
+                url = 'https://' + url.lstrip('/')
+            
+            snippet = get_snippet(doc["doc_id"], doc.get("term_positions")) or {}
+
+            # 添加关键词列表用于前端高亮（没有高亮区间时使用）
+            page_results.append(SearchResult(
+                title=document["title"],
+                url=url,
+                snippet=snippet.get("snippet"),
+                highlights=snippet.get("highlights"),
+                keywords=keywords  # 添加关键词列表
+            ))
+        except Exception as e:
+            print(f"处理文档时出错: {str(e)}, 文档: {doc}")
+    return page_results
+
+def record_and_lookup(analyzed):
+    """
+    记录查询日志并查找结果缓存（在线程池中执行）
+    :return: (查询开始时的索引版本, 缓存的结果或 None)，版本在查询前取得，写入结果时用来丢弃基于旧索引的结果
+    """
+    query_log.record(analyzed.raw, analyzed.terms)
+    version = result_cache.version()
+    return version, result_cache.get(analyzed.cache_key)
+
 # 搜索接口
 @app.post("/api/search", response_model=SearchResponse)
 async def search(request: SearchRequest):
@@ -64,123 +142,80 @@ async def search(request: SearchRequest):
         # 添加调试打印
         print("\n=== 搜索请求信息 ===")
         print(f"收到查询: {query}")
-        print(f"查询类型: {search_type}")
+        print(f"查询类型: {search_type}, 页码: {request.page}, 每页: {request.page_size}")
         
         if not query:
             print("错误: 空查询")
             raise HTTPException(status_code=400, detail="查询不能为空")
+        if request.page < 1 or not 1 <= request.page_size <= MAX_PAGE_SIZE:
+            raise HTTPException(status_code=400, detail="页码或每页数量无效")
 
-        # 获取关键词列表用于高亮
-        keywords = parse_to_list(query)
-        print(f"高亮关键词: {keywords}")
+        # 整个请求共用一个截止时间，排队等待执行器的时间也计算在内
+        deadline = SearchDeadline()
 
-        try:
-            processed_query = query
-            print(f"正在查询: {processed_query}")
-        except Exception as e:
-            print(f"查询处理错误: {str(e)}")
-            raise HTTPException(status_code=400, detail=f"查询处理错误: {str(e)}")
+        # 翻页时用游标直接取缓存中的排序结果，不重新分析和执行查询
+        # 结果缓存的读写可能检查索引版本（列目录、stat 文件），都在线程池中执行，不阻塞事件循环
+        loop = asyncio.get_running_loop()
+        ranked = await loop.run_in_executor(None, result_cache.get, request.cursor) if request.cursor else None
+        cache_key = request.cursor
+        if ranked is not None:
+            print(f"命中结果缓存（游标）: {cache_key}")
+        else:
+            # 每个请求只分析一次查询（spaCy/SymSpell），之后各阶段复用同一个 AnalyzedQuery
+            analyzed = await search_executor.analyze(query, deadline)
 
-        # 执行搜索
-        try:
-            print(f"执行搜索...")
-            results = parse_query(processed_query)
-            print(f"初始搜索返回结果结构: {results.keys() if isinstance(results, dict) else '非字典结构'}")
-            
-            # 检查结果是否为空或少于30条
-            result_count = 0
-            if isinstance(results, dict) and "results" in results:
-                result_count = len(results["results"])
-            
-            print(f"初始搜索找到 {result_count} 条结果")
-            
-            # 修改检查逻辑，处理结果可能为空的情况
-            if result_count < 30:
-                print(f"搜索结果较少 (仅{result_count}条)，尝试使用handle_long_query函数")
-                # 调用handle_long_query获取更多结果
-                alternative_results = handle_long_query(processed_query)
-                
-                # 检查替代结果
-                alt_result_count = 0
-                if isinstance(alternative_results, dict) and "results" in alternative_results:
-                    alt_result_count = len(alternative_results["results"])
-                
-                print(f"替代搜索找到 {alt_result_count} 条结果")
-                
-                # 只有当替代结果有更多内容时才替换
-                if alt_result_count > result_count:
-                    print(f"使用handle_long_query获得更多结果: {alt_result_count}条")
-                    results = alternative_results
-                else:
-                    print("handle_long_query未能提供更好的结果，保留原始结果")
-            
-            # 限制结果数量，防止排序过慢
-            max_results = 5000
-            if "results" in results and len(results["results"]) > max_results:
-                print(f"结果数量过多 ({len(results['results'])}), 限制为前{max_results}条进行排序")
-                results["results"] = results["results"][:max_results]
-            
-            print(f"搜索结束，开始进行推荐排序")
-            print(f"开始计时")
-            start_time = time.time()
-            result_after_sort = retrieval_sort(results)
-            print(f"排序完成，用时: {time.time() - start_time:.2f} 秒")
-            
-        except Exception as e:
-            print(f"搜索执行错误: {str(e)}")
-            raise HTTPException(status_code=500, detail=f"搜索执行错误: {str(e)}")
-            
-        # 处理结果
-        simplified_results = []
-        if "results" in result_after_sort:
-            print(f"处理 {len(result_after_sort['results'])} 个结果...")
-            for doc in result_after_sort["results"]:
+            # 查询结果缓存：规范化表达式相同的查询直接复用排好序的结果
+            cache_key = analyzed.cache_key
+            version, ranked = await loop.run_in_executor(None, record_and_lookup, analyzed)
+            if ranked is not None:
+                print(f"命中结果缓存: {cache_key}")
+            else:
+                # 获取关键词列表用于高亮
+                keywords = parse_to_list(analyzed)
+                print(f"高亮关键词: {keywords}")
                 try:
-                    # 修复 URL
-                    url = doc["url"]
-                    if not url.startswith(('http://', 'https://')):
-                        url = 'https://' + url.lstrip('/')
-                    
-                    # 添加关键词列表用于前端高亮
-                    simplified_result = SearchResult(
-                        title=doc["title"],
-                        url=url,
-                        content=doc["content"],
-                        keywords=keywords  # 添加关键词列表
-                    )
-                    simplified_results.append(simplified_result)
+                    outcome = await search_executor.search(analyzed, deadline)
+                except SearchCancelled:
+                    raise
                 except Exception as e:
-                    print(f"处理文档时出错: {str(e)}, 文档: {doc}")
+                    print(f"搜索执行错误: {str(e)}")
+                    raise HTTPException(status_code=500, detail=f"搜索执行错误: {str(e)}")
+                ranked = {"keywords": keywords, "results": outcome["results"]}
+                # 有分片服务器未响应时结果不完整，不缓存，下一次查询重新请求
+                if outcome["unavailable_shards"]:
+                    print(f"结果不完整（未响应: {', '.join(outcome['unavailable_shards'])}），不写入缓存")
+                else:
+                    size = outcome["size"] + estimate_size(keywords)
+                    # 查询期间索引发生变化（缓存可能已经清空）时不写入旧结果
+                    await loop.run_in_executor(None, result_cache.put, cache_key, ranked, size, version)
 
-        print(f"找到结果数量: {len(simplified_results)}")
-        # 停止计时，记录搜索时间
-        search_elapsed_time = time.time() - start_time
-        print(f"搜索完成，用时: {search_elapsed_time:.2f} 秒")
-        
-        # AI处理（如果有）...
-        # 这部分不计入搜索时间
-
-        response = SearchResponse(
-            count=len(simplified_results),
-            results=simplified_results,
-            keywords=keywords,
-            elapsed_time=search_elapsed_time  # 仅包含搜索部分的时间
+        # 只为当前页读取文档内容
+        total = len(ranked["results"])
+        offset = (request.page - 1) * request.page_size
+        page_results = await loop.run_in_executor(
+            None, hydrate_page, ranked["results"][offset:offset + request.page_size], ranked["keywords"]
         )
 
-        # 检查序列化
-        try:
-            from fastapi.encoders import jsonable_encoder
-            response_json = jsonable_encoder(response)
-            print(f"响应JSON长度: {len(str(response_json))}")
-            if len(simplified_results) > 0:
-                print(f"第一个结果: {response_json['results'][0]}")
-        except Exception as e:
-            print(f"序列化响应时出错: {str(e)}")
+        # 停止计时，记录搜索时间
+        search_elapsed_time = time.time() - start_time
+        print(f"共 {total} 条结果，返回第 {request.page} 页 {len(page_results)} 条，用时: {search_elapsed_time:.2f} 秒")
 
-        return response
+        return SearchResponse(
+            count=total,
+            results=page_results,
+            keywords=ranked["keywords"],
+            elapsed_time=search_elapsed_time,
+            page=request.page,
+            page_size=request.page_size,
+            total_pages=max(1, -(-total // request.page_size)),
+            cursor=cache_key
+        )
 
     except HTTPException:
         raise
+    except SearchCancelled as e:
+        print(f"查询未在截止时间内完成: {str(e)}")
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         print(f"服务器错误: {str(e)}")
         raise HTTPException(status_code=500, detail=f"服务器错误: {str(e)}")
@@ -197,42 +232,21 @@ async def ai_stream_endpoint(query: Optional[str] = None):
         
     print(f"收到AI流式请求，查询: '{query}'")
     
-    # 创建一个标准队列用于线程间通信
-    message_queue = queue.Queue()
-    
-    # 定义回调函数将流式输出放入队列
-    def stream_callback(chunk: str):
-        message_queue.put(chunk)
-    
-    # 在后台线程中运行 ds_api
-    def run_ds_api():
-        try:
-            ds_api(query, stream_callback)
-        except Exception as e:
-            error_msg = f"Error: {str(e)}"
-            message_queue.put(error_msg)
-        finally:
-            # 标记流结束
-            message_queue.put(None)
-    
-    # 启动后台线程
-    thread = threading.Thread(target=run_ds_api)
-    thread.daemon = True
-    thread.start()
-    
-    # 从队列读取并输出数据的异步生成器
+    # 在事件循环中直接读取 DeepSeek 的流式响应并转发，不再经过后台线程和队列；
+    # 相同的问题共用一个上游请求，已完成的回答直接重放（见 stream_hub.py）
     async def generate_stream() -> AsyncGenerator[str, None]:
-        while True:
-            try:
-                chunk = message_queue.get(timeout=0.1)
-                
-                if chunk is None:  # 流结束标记
-                    break
-                    
+        try:
+            # 表达式来自带缓存的查询分析，不再重复解析
+            analyzed = await asyncio.get_running_loop().run_in_executor(None, analyze_query, query)
+            expression = analyzed.expression
+            chunks = answer_hub.subscribe(
+                answer_key(expression), lambda: stream_answer(query, expression=expression)
+            )
+            async for chunk in chunks:
                 yield f"data: {chunk}\n\n"
-            except queue.Empty:
-                await asyncio.sleep(0.05)
-                continue
+        except Exception as e:
+            print(f"AI流式响应出错: {str(e)}")
+            yield f"data: Error: {str(e)}\n\n"
     
     # 返回 SSE 流
     return StreamingResponse(
@@ -266,6 +280,37 @@ async def show_routes():
             })
     return {"routes": routes}
 
+@app.get("/api/cache-stats", response_model=dict)
+async def cache_stats():
+    """查询结果缓存的命中率、占用和失效统计"""
+    return result_cache.stats()
+
+@app.get("/api/shard-cache-stats", response_model=dict)
+async def shard_cache_statistics():
+    """已加载倒排索引分片的估算内存、命中率、加载和淘汰统计（SEARCH_EXECUTOR=process 时只反映 Web 进程）"""
+    return shard_cache_stats()
+
+@app.get("/api/ai-stream-stats", response_model=dict)
+async def ai_stream_stats():
+    """AI 回答流的进行中请求、合并次数和回答缓存的命中率"""
+    return answer_hub.stats()
+
+@app.get("/api/suggest-stats", response_model=dict)
+async def suggest_stats():
+    """查询建议中 LLM 扩展的进行中调用、延迟调用、因并发上限跳过的次数和缓存命中率"""
+    return llm_expander.stats()
+
+@app.get("/healthz/live")
+async def liveness():
+    """进程存活即返回 200"""
+    return {"status": "ok"}
+
+@app.get("/healthz/ready")
+async def readiness():
+    """预热完成（必需的分片已加载）时返回 200，否则返回 503，负载均衡据此决定是否转发请求"""
+    status = warmup.status()
+    return JSONResponse(status_code=200 if status["ready"] else 503, content=status)
+
 @app.get("/api/test", response_model=dict)
 async def test_endpoint():
     """简单测试端点，确认API正常工作"""
@@ -280,6 +325,21 @@ async def startup_event():
             methods = ", ".join(route.methods)
             print(f"{methods:8} {route.path}")
     print("=====================\n")
+    if segment_merger is not None and not segment_merger.is_alive():
+        segment_merger.start()
+    # serve.py 在 fork 之前已经完成预热时不会重复执行
+    warmup.start()
+    suggestion_engine.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    search_executor.shutdown()
+    if segment_merger is not None:
+        segment_merger.stop()
+    query_log.flush()
+    suggestion_engine.stop()
+    llm_expander.close()
+    await close_async_client()
 
 # 端口查找函数
 def find_free_port(start_port=5000, max_port=5100):
@@ -294,28 +354,34 @@ def find_free_port(start_port=5000, max_port=5100):
             continue
     raise OSError("Could not find a free port")
 
-# 添加此API端点，获取查询扩展建议
+# 查询建议：本地前缀补全（历史查询 + 索引词表），不足时由缓存的 LLM 查询扩展补充
 @app.get("/api/query-suggestions")
-async def get_query_suggestions(query: str):
-    """根据用户查询返回查询扩展建议"""
+async def get_query_suggestions(query: str, limit: int = SUGGEST_LIMIT, expand: bool = False):
+    """
+    根据用户输入返回查询建议
+    expand 为 true 时（提交的查询）等待 LLM 扩展；否则（逐键输入）只附加已缓存的扩展，
+    输入停顿后才在后台生成
+    """
     if not query or len(query.strip()) < 2:
         return {"suggestions": []}
-    
-    try:
-        # 使用extend_query_gpt35生成建议
-        result = extend_query_gpt35(query)
-        
-        # 获取扩展查询列表
-        suggestions = result.get("expanded_queries", [])
-        
-        # 返回原始查询和扩展建议
-        return {
-            "original_query": result.get("original_query", query),
-            "suggestions": suggestions
-        }
-    except Exception as e:
-        print(f"生成查询建议时出错: {str(e)}")
-        return {"suggestions": [], "error": str(e)}
+    limit = max(1, min(limit, MAX_SUGGEST_LIMIT))
+
+    # 已经算好的前缀直接在事件循环中返回；需要在整段条目上计算时交给线程池
+    suggestions = suggestion_engine.suggest(query, limit, compute=False)
+    if suggestions is None:
+        suggestions = await asyncio.get_running_loop().run_in_executor(None, suggestion_engine.suggest, query, limit)
+    if len(suggestions) < limit:
+        expanded = await llm_expander.expand(query, wait=expand)
+        for item in expanded or []:
+            if item not in suggestions:
+                suggestions.append(item)
+                if len(suggestions) >= limit:
+                    break
+
+    return {
+        "original_query": query,
+        "suggestions": suggestions
+    }
 
 # 应用入口
 if __name__ == "__main__":
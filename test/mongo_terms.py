@@ -0,0 +1,130 @@
+'''
+按词从 MongoDB 读取倒排索引：只取查询需要的词，而不是扫描整个 inverted_index_XXX 集合
+    - 每个分片一次 {"term": {"$in": [...]}} 查询，只投影 term 和 data 字段
+    - $in 查询依赖 term 字段上的索引（否则每次都是全表扫描），每个集合第一次查询前确保索引存在；
+      创建失败（例如没有权限）时打印警告并继续查询
+    - 各分片的查询在同一个事件循环中并发执行（asyncio.gather）
+    - 安装了 motor 时使用带连接池的异步客户端；否则（或传入 pymongo / mongomock 的同步客户端时）
+      在线程中执行同步查询，pymongo 的 MongoClient 本身也带连接池
+
+调用方（search_func）在同步的查询线程中执行，TermStore 在一个后台线程中运行自己的事件循环，
+fetch 把协程提交给这个循环并等待结果。事件循环和客户端在第一次使用时创建，
+预加载后 fork 出的工作进程各自创建（两者都不能跨 fork 共享）。
+'''
+
+import asyncio
+import os
+import threading
+
+try:
+    from motor.motor_asyncio import AsyncIOMotorClient
+except ImportError:
+    AsyncIOMotorClient = None
+
+COLLECTION_PREFIX = "inverted_index_"
+# 每次查询最多等待的秒数
+MONGO_TERM_TIMEOUT = float(os.environ.get("MONGO_TERM_TIMEOUT", 5.0))
+MONGO_POOL_SIZE = int(os.environ.get("MONGO_POOL_SIZE", 20))
+PROJECTION = {"_id": 0, "term": 1, "data": 1}
+TERM_INDEX = "term"
+
+
+class TermStore:
+    """
+    :param uri: MongoDB 地址，client 为 None 时用它创建客户端
+    :param database: 数据库名
+    :param client: 已有的客户端（motor、pymongo 或 mongomock），测试时传入
+    :param timeout: 一次 fetch 最多等待的秒数
+    """
+
+    def __init__(self, uri=None, database="search_db", client=None, timeout=MONGO_TERM_TIMEOUT,
+                 pool_size=MONGO_POOL_SIZE):
+        self.uri = uri
+        self.database = database
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._client = client
+        self._owns_client = client is None
+        self._loop = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        # 已经确认过 term 索引的分片
+        self._indexed = set()
+
+    @property
+    def is_async(self):
+        return AsyncIOMotorClient is not None and isinstance(self._client, AsyncIOMotorClient)
+
+    def _new_client(self):
+        if AsyncIOMotorClient is not None:
+            return AsyncIOMotorClient(self.uri, maxPoolSize=self.pool_size)
+        import pymongo
+        return pymongo.MongoClient(self.uri, maxPoolSize=self.pool_size, connect=False)
+
+    async def _setup(self):
+        # motor 客户端绑定到创建它时所在的事件循环
+        if self._owns_client:
+            self._client = self._new_client()
+
+    def _ensure_loop(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return self._loop
+        with self._lock:
+            if self._pid != pid:
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever, name="mongo-terms", daemon=True)
+                thread.start()
+                asyncio.run_coroutine_threadsafe(self._setup(), loop).result(self.timeout)
+                self._loop, self._thread, self._pid = loop, thread, pid
+        return self._loop
+
+    async def _ensure_index(self, shard, collection):
+        if shard in self._indexed:
+            return
+        try:
+            if self.is_async:
+                await collection.create_index(TERM_INDEX)
+            else:
+                await asyncio.to_thread(collection.create_index, TERM_INDEX)
+        except Exception as e:
+            print(f"警告: 无法在 {collection.name} 上创建 term 索引，按词查询将扫描整个集合: {e}")
+        # 失败时也不再重试，避免每次查询都尝试创建
+        self._indexed.add(shard)
+
+    async def _fetch_shard(self, shard, terms):
+        collection = self._client[self.database][COLLECTION_PREFIX + shard]
+        await self._ensure_index(shard, collection)
+        query = {"term": {"$in": sorted(terms)}}
+        if self.is_async:
+            docs = await collection.find(query, PROJECTION).to_list(length=None)
+        else:
+            docs = await asyncio.to_thread(lambda: list(collection.find(query, PROJECTION)))
+        return {doc["term"]: doc["data"] for doc in docs}
+
+    async def fetch_async(self, terms_by_shard):
+        """:param terms_by_shard: {分片名: 词集合}  :return: {词: data}，索引中没有的词不在其中"""
+        shards = [shard for shard, terms in terms_by_shard.items() if terms]
+        replies = await asyncio.gather(*(self._fetch_shard(shard, terms_by_shard[shard]) for shard in shards))
+        found = {}
+        for reply in replies:
+            found.update(reply)
+        return found
+
+    def fetch(self, terms_by_shard):
+        """同步接口：在后台事件循环中执行 fetch_async，超时抛出 TimeoutError"""
+        if not any(terms_by_shard.values()):
+            return {}
+        loop = self._ensure_loop()
+        return asyncio.run_coroutine_threadsafe(self.fetch_async(terms_by_shard), loop).result(self.timeout)
+
+    def close(self):
+        if self._pid != os.getpid():
+            return
+        loop = self._loop
+        if self._owns_client and self._client is not None:
+            self._client.close()
+        loop.call_soon_threadsafe(loop.stop)
+        self._thread.join(self.timeout)
+        self._pid = None
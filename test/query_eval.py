@@ -0,0 +1,181 @@
+'''
+基于 postings 数组的查询求值算法
+输入均为 binary_index.TermPostings（文档ID升序），不再为所有文档构建得分字典
+'''
+
+import heapq
+from itertools import accumulate
+
+
+def gallop(doc_ids, target, lo=0):
+    """
+    从 lo 开始用指数探测 + 二分查找第一个 >= target 的下标
+    :return: 下标，全部小于 target 时返回 len(doc_ids)
+    """
+    n = len(doc_ids)
+    if lo >= n or doc_ids[lo] >= target:
+        return lo
+    step = 1
+    hi = lo + 1
+    while hi < n and doc_ids[hi] < target:
+        lo = hi
+        step <<= 1
+        hi = lo + step
+    hi = min(hi, n)
+    # 不变式：doc_ids[lo] < target，答案在 (lo, hi] 之间
+    lo += 1
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if doc_ids[mid] < target:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def top_k_or(postings_lists, k, term_score=None, upper_bound=None, stats=None):
+    """
+    MaxScore 动态剪枝的 top-k 或查询
+    按得分上界把词分为"必要"和"非必要"两组：只遍历必要组的文档，
+    非必要组只在文档仍有可能进入 top-k 时才跳跃查找
+    :param postings_lists: TermPostings 列表
+    :param k: 返回的文档数
+    :param term_score: term_score(j, i) -> 第 j 个词在其第 i 个 posting 上的得分，默认为 tf
+    :param upper_bound: upper_bound(j) -> 第 j 个词单文档得分的上界，默认为 max_tf
+    :param stats: 可选的字典，写入 "scored"（完整打分的文档数）
+    :return: [(score, doc_id), ...]，按得分降序、doc_id 升序，与穷举打分的前 k 条一致
+    """
+    if term_score is None:
+        term_score = lambda j, i: postings_lists[j].tfs[i]
+    if upper_bound is None:
+        upper_bound = lambda j: postings_lists[j].max_tf
+
+    # 按上界升序排列，prefix[m] 为前 m+1 个词上界之和
+    order = sorted(
+        (j for j in range(len(postings_lists)) if len(postings_lists[j])),
+        key=upper_bound
+    )
+    prefix = list(accumulate(upper_bound(j) for j in order))
+    doc_lists = [postings_lists[j].doc_ids for j in order]
+    cursors = [0] * len(order)
+
+    heap = []  # (score, -doc_id) 的小根堆，堆顶是当前第 k 名
+    first_essential = 0
+    scored = 0
+
+    while k > 0:
+        # 必要组中当前最小的文档
+        doc = None
+        for pos in range(first_essential, len(order)):
+            ids = doc_lists[pos]
+            c = cursors[pos]
+            if c < len(ids) and (doc is None or ids[c] < doc):
+                doc = ids[c]
+        if doc is None:
+            break
+
+        score = 0
+        for pos in range(first_essential, len(order)):
+            ids = doc_lists[pos]
+            c = cursors[pos]
+            if c < len(ids) and ids[c] == doc:
+                score += term_score(order[pos], c)
+                cursors[pos] = c + 1
+        scored += 1
+
+        # 非必要组按上界从大到小探测，剩余上界之和不足以进入 top-k 时提前结束
+        for pos in range(first_essential - 1, -1, -1):
+            if score + prefix[pos] <= heap[0][0]:
+                break
+            ids = doc_lists[pos]
+            c = gallop(ids, doc, cursors[pos])
+            cursors[pos] = c
+            if c < len(ids) and ids[c] == doc:
+                score += term_score(order[pos], c)
+                cursors[pos] = c + 1
+
+        if len(heap) < k:
+            heapq.heappush(heap, (score, -doc))
+        elif score > heap[0][0]:
+            heapq.heapreplace(heap, (score, -doc))
+        else:
+            continue
+
+        # 门槛提高后，把上界之和不超过门槛的词移入非必要组
+        if len(heap) == k:
+            threshold = heap[0][0]
+            while first_essential < len(order) and prefix[first_essential] <= threshold:
+                first_essential += 1
+
+    if stats is not None:
+        stats["scored"] = scored
+    return sorted(((score, -neg_doc) for score, neg_doc in heap), key=lambda x: (-x[0], x[1]))
+
+
+def intersect(postings_lists):
+    """
+    按文档频率从小到大求多个 postings 的交集
+    以最稀有的词驱动，其余列表用跳跃查找前进，代价取决于最短的列表
+    :param postings_lists: TermPostings 列表
+    :return: [(doc_id, [该文档在每个列表中的下标, ...]), ...]，下标顺序与输入列表一致
+    """
+    if not postings_lists or any(len(postings) == 0 for postings in postings_lists):
+        return []
+
+    order = sorted(range(len(postings_lists)), key=lambda j: len(postings_lists[j]))
+    rarest = postings_lists[order[0]].doc_ids
+    others = order[1:]
+    cursors = [0] * len(postings_lists)
+    matches = []
+
+    for i, doc in enumerate(rarest):
+        indices = [0] * len(postings_lists)
+        indices[order[0]] = i
+        for j in others:
+            ids = postings_lists[j].doc_ids
+            c = gallop(ids, doc, cursors[j])
+            cursors[j] = c
+            if c == len(ids):
+                # 某个列表已经耗尽，之后不可能再有交集
+                return matches
+            if ids[c] != doc:
+                break
+            indices[j] = c
+        else:
+            matches.append((doc, indices))
+    return matches
+
+
+def count_phrase_matches(position_lists, limit=None):
+    """
+    统计短语在文档中出现的次数
+    第 i 个词的位置减去偏移 i 后，所有列表共有的值就是短语的起始位置；
+    各列表只向前推进，总代价与位置数线性相关
+    :param position_lists: 按短语顺序排列的升序位置列表
+    :param limit: 找到这么多次匹配后立即返回，None 表示统计全部
+    :return: 匹配次数（不超过 limit）
+    """
+    if not position_lists or any(not positions for positions in position_lists):
+        return 0
+
+    cursors = [0] * len(position_lists)
+    candidate = position_lists[0][0]
+    matches = 0
+    while True:
+        for i, positions in enumerate(position_lists):
+            target = candidate + i
+            c = cursors[i]
+            while c < len(positions) and positions[c] < target:
+                c += 1
+            cursors[i] = c
+            if c == len(positions):
+                return matches
+            if positions[c] != target:
+                # 以更靠后的位置作为新的候选起点重新对齐
+                candidate = positions[c] - i
+                break
+        else:
+            matches += 1
+            if limit is not None and matches >= limit:
+                return matches
+            candidate += 1
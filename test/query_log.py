@@ -0,0 +1,100 @@
+'''
+查询日志：统计查询词和查询的次数，作为预热顺序（warmup.py）等的流行度依据
+
+计数先累积在内存中，每 FLUSH_EVERY 次查询合并写入一次文件。
+预加载后 fork 的多个工作进程各自记录，写入时在文件锁内读出已有计数再加上本进程的增量，互不覆盖。
+文件中只保留次数最多的 MAX_ENTRIES 个词和查询。
+'''
+
+import fcntl
+import json
+import os
+import threading
+from collections import Counter
+
+QUERY_LOG_FILE = "query_log.json"
+FLUSH_EVERY = 100
+MAX_ENTRIES = 50000
+
+
+def read_query_log(path):
+    """:return: (词计数, 查询计数)，文件不存在或损坏时为空"""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return Counter(), Counter()
+    return Counter(data.get("terms", {})), Counter(data.get("queries", {}))
+
+
+def _most_common(counter, limit):
+    return dict(counter.most_common(limit))
+
+
+class QueryLog:
+    """
+    :param path: 日志文件路径
+    :param flush_every: 累积多少次查询后写入文件
+    """
+
+    def __init__(self, path, flush_every=FLUSH_EVERY, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.flush_every = flush_every
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._terms, self._queries = read_query_log(path)
+        self._pending_terms = Counter()
+        self._pending_queries = Counter()
+        self._pending = 0
+
+    def record(self, query, terms):
+        """记录一次查询；达到 flush_every 次时写入文件（在调用线程中执行）"""
+        query = " ".join(query.lower().split())
+        with self._lock:
+            if query:
+                self._pending_queries[query] += 1
+            for term in set(terms):
+                self._pending_terms[term] += 1
+            self._pending += 1
+            due = self._pending >= self.flush_every
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return
+            terms, self._pending_terms = self._pending_terms, Counter()
+            queries, self._pending_queries = self._pending_queries, Counter()
+            self._pending = 0
+        try:
+            with open(self.path + ".lock", "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    saved_terms, saved_queries = read_query_log(self.path)
+                    saved_terms.update(terms)
+                    saved_queries.update(queries)
+                    data = {
+                        "terms": _most_common(saved_terms, self.max_entries),
+                        "queries": _most_common(saved_queries, self.max_entries),
+                    }
+                    with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+                        json.dump(data, f, ensure_ascii=False)
+                    os.replace(self.path + ".tmp", self.path)
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+        except OSError as e:
+            print(f"写入查询日志失败: {e}")
+            return
+        with self._lock:
+            self._terms = Counter(data["terms"])
+            self._queries = Counter(data["queries"])
+
+    def term_counts(self):
+        """已写入文件的词计数加上本进程尚未写入的部分"""
+        with self._lock:
+            return self._terms + self._pending_terms
+
+    def query_counts(self):
+        with self._lock:
+            return self._queries + self._pending_queries
@@ -1,68 +1,105 @@
 import re
-from search_func import or_search, and_search, phrase_search
+from dataclasses import dataclass
+from typing import List
+from search_func import or_search, phrase_search, boolean_search, process_query
 from Boolean_test import build_query
+from result_cache import canonical_expression
+from boolean_query import parse_expression, positive_words, relaxed_query, Term, Phrase, Or
+
+
+@dataclass(frozen=True)
+class AnalyzedQuery:
+    """
+    一次请求只分析一次的查询：在 parse_to_list / parse_query / handle_long_query / ds_api 之间传递，
+    避免每个阶段重复执行 spaCy 解析和 SymSpell 纠错
+    """
+    raw: str                # 用户输入的原始查询
+    expression: str         # build_query 生成的布尔表达式
+    keywords: List[str]     # 表达式中的单词（用于高亮）
+    terms: List[str]        # 词形还原、去停用词后的索引词
+    cache_key: str          # 规范化后的表达式，用作结果缓存的键
+
+
+def analyze_query(query):
+    """
+    分析原始查询，生成 AnalyzedQuery
+    build_query 及其内部的 spaCy/SymSpell 调用都有备忘缓存，热门查询不会重复做 NLP
+    """
+    expression = build_query(query).strip()
+    keywords = expression_keywords(expression)
+    return AnalyzedQuery(
+        raw=query,
+        expression=expression,
+        keywords=keywords,
+        terms=process_query(" ".join(keywords)),
+        cache_key=canonical_expression(expression),
+    )
+
+
+def query_expression(query_expr):
+    """取得布尔表达式：已分析的查询直接复用，原始字符串才调用 build_query"""
+    if isinstance(query_expr, AnalyzedQuery):
+        return query_expr.expression
+    return build_query(query_expr)
 
 def parse_to_list(query_expr):
     """
     将查询表达式解析为单词列表
     
     参数:
-        query_expr (str): 原始查询表达式
+        query_expr (str | AnalyzedQuery): 原始查询表达式，或已经分析过的查询
         
     返回:
         list: 查询中的单个单词列表，不包含运算符和括号
     """
+    if isinstance(query_expr, AnalyzedQuery):
+        return list(query_expr.keywords)
+
     # 调用Boolean_test.py的方法，获得处理后的query 
     query_expr = build_query(query_expr)
     # print(f"被Boolean处理后的query: {query_expr}")
     
-    # 移除多余的空格
-    query_expr = query_expr.strip()
-    
-    # 处理括号和AND操作符
-    query_expr = query_expr.replace('(', ' ').replace(')', ' ')
-    terms = []
-    
-    # 分割AND部分
-    if ' AND ' in query_expr:
-        parts = query_expr.split(' AND ')
-        for part in parts:
-            # 提取每部分的单词
-            words = [w.strip() for w in part.split() if w.strip()]
-            terms.extend(words)
-    else:
-        # 如果没有AND，直接分割为单词
-        terms = [w.strip() for w in query_expr.split() if w.strip()]
-    
-    # 移除重复项并保持原始顺序
+    unique_terms = expression_keywords(query_expr)
+    print(f"解析后的单词列表: {unique_terms}")
+    return unique_terms
+
+def expression_keywords(query_expr):
+    """
+    从 build_query 生成的布尔表达式中提取单词列表（去掉运算符、括号和 NOT 排除的词，保持顺序去重）
+    """
     unique_terms = []
-    for term in terms:
-        if term not in unique_terms and term != 'AND':
+    for term in positive_words(parse_expression(query_expr)):
+        if term not in unique_terms:
             unique_terms.append(term)
-    
-    print(f"解析后的单词列表: {unique_terms}")
     return unique_terms
 
 # 处理查询词太长的情况情况
-def handle_long_query(query_expr):
+def handle_long_query(query_expr, hydrate=True):
     """
     处理查询词太长或结果很少的情况
     
     参数:
-        query_expr (str): 原始查询表达式
+        query_expr (str | AnalyzedQuery): 原始查询表达式，或已经分析过的查询
+        hydrate (bool): 是否读取标题/URL/正文，分页返回时由调用方只为当前页读取
         
     返回:
         dict: 包含搜索结果的字典
     """
-    print(f"handle_long_query: 处理查询 '{query_expr}'")
+    print(f"handle_long_query: 处理查询 '{getattr(query_expr, 'raw', query_expr)}'")
     
     # 获取查询词列表
     word_list = parse_to_list(query_expr)
     print(f"解析到的关键词: {word_list}")
     
-    # 简单地使用OR搜索查找更多可能的结果
-    print("执行OR搜索以获取更广泛的结果")
-    results = or_search(" ".join(word_list))
+    # 有 NOT 子句时放宽为"任意正向词 AND NOT ..."，不引入被排除的文档
+    relaxed = relaxed_query(parse_expression(query_expression(query_expr)))
+    if relaxed is not None and not isinstance(relaxed, (Term, Or)):
+        print(f"执行放宽后的布尔查询以获取更广泛的结果")
+        results = boolean_search(relaxed, hydrate=hydrate)
+    else:
+        # 简单地使用OR搜索查找更多可能的结果
+        print("执行OR搜索以获取更广泛的结果")
+        results = or_search(" ".join(word_list), hydrate=hydrate)
     
     # 检查结果
     result_count = len(results["results"]) if "results" in results else 0
@@ -73,77 +110,35 @@ def handle_long_query(query_expr):
 
 
 
-def parse_query(query_expr):
+def parse_query(query_expr, hydrate=True):
     """
     解析查询表达式并调用对应的搜索函数
     
     支持的格式:
-    - (term1) AND (term2)        -> and_search
-    - (term1 term2)              -> phrase_search
-    - (term1) AND (term2 term3)  -> 词查询和短语查询的交集
+    - (term1)                           -> or_search
+    - (term1) (term2) / (term1) OR ...  -> or_search（MaxScore top-k）
+    - (term1 term2)                     -> phrase_search
+    - 其它任意组合的 AND / OR / NOT / 短语 / 括号嵌套 -> boolean_search
+
+    hydrate 为 False 时结果只包含文档ID和打分数据，不读取标题/URL/正文（没有语料统计量时读取排序需要的正文）
     """
 
-    # 调用Boolean_test.py的方法，获得处理后的query 
-    query_expr = build_query(query_expr)
+    # 调用Boolean_test.py的方法，获得处理后的query（已分析的查询直接复用表达式）
+    query_expr = query_expression(query_expr)
     print(f"被Boolean处理后的query: {query_expr}")
-    # 移除多余的空格
-    query_expr = query_expr.strip()
-    
-    # 检查是否包含 AND
-    if ' AND ' in query_expr:
-        # 分割 AND 子句
-        parts = query_expr.split(' AND ')
-        
-        # 检查是否有包含空格的子句（短语查询）
-        has_phrase = any(' ' in part.strip('()') for part in parts)
-        
-        if not has_phrase:
-            # 如果都是单个词，直接使用 AND 查询
-            terms = []
-            for part in parts:
-                term = part.strip('()')
-                terms.append(term)
-            return and_search(' '.join(terms))
-        
-        # 如果有短语，需要进行交集操作
-        results_list = []
-        for part in parts:
-            # 去掉括号并处理每个子句
-            part = part.strip('()')
-            if ' ' in part:  # 如果包含空格，作为短语处理
-                results = phrase_search(part)
-            else:  # 单个词直接 OR 搜索
-                results = or_search(part)
-            
-            if "results" in results:
-                results_list.append(set(doc["doc_id"] for doc in results["results"]))
-            else:
-                return results  # 返回错误信息
-        
-        # 求所有结果的交集
-        if results_list:
-            common_doc_ids = set.intersection(*results_list)
-            # 从最后一次查询的结果中提取完整的文档信息
-            final_results = []
-            for doc in results["results"]:  # 使用最后一次查询的结果
-                if doc["doc_id"] in common_doc_ids:
-                    final_results.append(doc)
-            
-            return {
-                "results": final_results,
-                "found_terms": []  # 这里可以合并所有查询的found_terms
-            }
-    
-    # 如果只有一个括号对，作为短语查询处理
-    if query_expr.startswith('(') and query_expr.endswith(')'):
-        query = query_expr[1:-1].strip()
-        if ' ' in query:  # 如果包含空格，作为短语处理
-            return phrase_search(query)
-        else:  # 单个词用 OR 搜索
-            return or_search(query)
-    
-    # 默认作为 OR 查询处理
-    return or_search(query_expr)
+    tree = parse_expression(query_expr)
+
+    if tree is None:
+        return {"message": "No valid search terms after removing stop words."}
+    if isinstance(tree, Term):
+        return or_search(tree.word, hydrate=hydrate)
+    if isinstance(tree, Phrase):
+        return phrase_search(" ".join(tree.words), hydrate=hydrate)
+    if isinstance(tree, Or) and all(isinstance(child, Term) for child in tree.children):
+        return or_search(" ".join(child.word for child in tree.children), hydrate=hydrate)
+
+    # 布尔组合：按代价安排求值顺序，NOT 作为集合差
+    return boolean_search(tree, hydrate=hydrate)
 
 def test_parser():
     """测试解析器"""
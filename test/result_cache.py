@@ -0,0 +1,163 @@
+'''
+查询结果缓存：以 build_query 生成的规范化布尔表达式为键
+    - 按估算的内存占用设上限，超出时按 LRU 淘汰
+    - 条目超过 TTL 后失效
+    - 记录命中/未命中次数
+    - 索引版本变化时整体失效；put 可以带上查询开始时的版本，版本已经变化时不写入
+'''
+
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from boolean_query import parse_expression, to_expression
+
+
+def canonical_expression(expression):
+    """
+    规范化布尔表达式：统一大小写和空白，AND / OR 的子句在各层去重后排序
+    "(Python) AND (java)" 与 "(java)  AND (python)" 得到相同的键
+    """
+    return to_expression(parse_expression(expression), canonical=True)
+
+
+def estimate_size(obj, _seen=None):
+    """粗略估算对象（dict/list/str 等嵌套结构）占用的字节数"""
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(estimate_size(k, _seen) + estimate_size(v, _seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(estimate_size(item, _seen) for item in obj)
+    elif hasattr(obj, "__dict__"):
+        size += estimate_size(vars(obj), _seen)
+    return size
+
+
+class QueryResultCache:
+    """
+    线程安全的 LRU + TTL 结果缓存
+    :param max_bytes: 缓存条目估算大小之和的上限
+    :param ttl: 条目存活秒数，None 表示不过期
+    :param version_fn: 返回当前索引版本的函数，版本变化时清空缓存
+    :param version_check_interval: 两次检查索引版本之间的最短间隔（秒）
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=600, version_fn=None, version_check_interval=1.0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.version_fn = version_fn
+        self.version_check_interval = version_check_interval
+        self._entries = OrderedDict()  # key -> (value, size, expires_at)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._version = version_fn() if version_fn else None
+        self._version_checked_at = self._version_read_at = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.stale_puts = 0
+
+    def _check_version(self, now):
+        """
+        到了检查间隔时读取索引版本，版本变化时清空缓存
+        version_fn 可能列目录、stat 文件，在锁外执行；锁内只比较和替换
+        """
+        if self.version_fn is None:
+            return
+        with self._lock:
+            if now - self._version_checked_at < self.version_check_interval:
+                return
+            self._version_checked_at = now
+        version = self.version_fn()
+        with self._lock:
+            # 并发检查时，较早开始的读取不能覆盖较新的结果
+            if now < self._version_read_at:
+                return
+            self._version_read_at = now
+            if version != self._version:
+                self._version = version
+                self._entries.clear()
+                self._bytes = 0
+                self.invalidations += 1
+
+    def version(self):
+        """返回当前的索引版本（必要时先检查），在执行查询前取得，写入结果时传给 put"""
+        self._check_version(time.monotonic())
+        with self._lock:
+            return self._version
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def get(self, key):
+        """返回缓存的值，不存在或已过期时返回 None"""
+        now = time.monotonic()
+        self._check_version(now)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, _, expires_at = entry
+            if expires_at is not None and expires_at <= now:
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, size=None, version=None):
+        """
+        写入缓存，单个条目超过上限时不缓存
+        :param size: 预先估算的大小（例如在执行查询的线程/进程中算好），None 时在这里估算
+        :param version: 开始查询时 version() 的返回值，与当前版本不同时说明结果基于旧索引，不写入
+        """
+        if size is None:
+            size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+        now = time.monotonic()
+        expires_at = now + self.ttl if self.ttl is not None else None
+        self._check_version(now)
+        with self._lock:
+            if version is not None and version != self._version:
+                self.stale_puts += 1
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, expires_at)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "stale_puts": self.stale_puts,
+                "index_version": self._version,
+            }
@@ -3,6 +3,25 @@ import numpy as np
 from sklearn.feature_extraction.text import TfidfVectorizer
 from rank_bm25 import BM25Okapi
 from sklearn.preprocessing import MinMaxScaler
+from corpus_stats import bm25_term_score
+
+# 打分引擎（scoring_engine.py）是离线工具：main()/compute_scores 对保存下来的搜索结果做 TF-IDF/BM25/LM 融合排序
+# （python retrieval_model.py search_results.json），第一次使用时从 cache 目录加载，没有引擎文件时退回到逐查询拟合模型。
+# /api/search 的排序是 retrieval_sort（基于语料统计量的 BM25，包含增量段中的文档），不使用打分引擎：
+# 引擎的矩阵只覆盖构建时的基础索引，而且融合权重会改变线上排序
+ENGINE_DIR = "cache"
+_scoring_engine = None
+_scoring_engine_loaded = False
+
+def get_scoring_engine():
+    """加载常驻打分引擎，没有引擎文件时返回 None"""
+    global _scoring_engine, _scoring_engine_loaded
+    if not _scoring_engine_loaded:
+        # 只有离线排序用到，查询服务导入本模块时不加载 scipy 矩阵相关代码
+        from scoring_engine import ScoringEngine
+        _scoring_engine = ScoringEngine.load(ENGINE_DIR)
+        _scoring_engine_loaded = True
+    return _scoring_engine
 
 def load_search_results(filename):
     """加载指定的JSON文件，返回搜索结果。"""
@@ -34,11 +53,18 @@ def normalize_sum(scores):
     total = scores.sum()
     return scores / total if total != 0 else scores
 
-def compute_scores(documents, queries):
-    """计算并归一化各模型的分数。"""
-    tfidf_scores = compute_tfidf(documents, queries)
-    bm25_scores = compute_bm25(documents, queries)
-    lm_scores = compute_lm(documents, queries)
+def compute_scores(documents, queries, doc_ids=None):
+    """
+    计算并归一化各模型的分数。
+    提供 doc_ids 且打分引擎可用时，用预先构建的语料矩阵做一次稀疏乘法，不再逐查询拟合模型。
+    """
+    engine = get_scoring_engine() if doc_ids is not None else None
+    if engine is not None:
+        tfidf_scores, bm25_scores, lm_scores = engine.score(doc_ids, queries)
+    else:
+        tfidf_scores = compute_tfidf(documents, queries)
+        bm25_scores = compute_bm25(documents, queries)
+        lm_scores = compute_lm(documents, queries)
 
     tfidf_scores_normalized = normalize_sum(tfidf_scores)
     bm25_scores_normalized = normalize_sum(bm25_scores)
@@ -68,12 +94,13 @@ def main(results):
     """主函数：加载数据，计算分数，返回前N条文档。"""
     # 加载搜索结果
     search_results = results
-    documents = [doc["content"] for doc in search_results["results"]]
+    documents = [doc.get("content", "") for doc in search_results["results"]]
     doc_list = search_results["results"]
     queries = search_results["found_terms"]
     print('给我看看queries: ', queries)
+    doc_ids = [doc["doc_id"] for doc in doc_list] if all("doc_id" in doc for doc in doc_list) else None
     # 计算分数
-    tfidf_scores, bm25_scores, lm_scores = compute_scores(documents, queries)
+    tfidf_scores, bm25_scores, lm_scores = compute_scores(documents, queries, doc_ids)
     
     # 排序文档
     sorted_docs = rank_documents(doc_list, tfidf_scores, bm25_scores, lm_scores)
@@ -88,6 +115,33 @@ def main(results):
     
     return output
 
+def heuristic_scores(results, query_terms):
+    """
+    没有语料统计量时的简化BM25启发式评分（需要文档内容）
+    """
+    final_scores = np.zeros(len(results))
+    
+    # 极速版BM25评分：只检查词是否存在而不计算完整TF-IDF
+    doc_lengths = np.array([len(doc.get("content", "").split()) for doc in results])
+    avg_length = np.mean(doc_lengths) if doc_lengths.size > 0 else 1
+    
+    # 归一化文档长度
+    length_factors = 1.0 / (0.5 + 0.5 * (doc_lengths / avg_length) + 1e-9)
+    
+    # 对每个文档预先计算一个基础分数
+    for i, doc in enumerate(results):
+        # 利用内置命中计数或position数据(如存在)
+        content = doc.get("content", "").lower()
+        term_count = sum(1 for term in query_terms if term.lower() in content)
+        
+        # 使用简化的BM25启发式公式
+        final_scores[i] = term_count * length_factors[i]
+        
+        # 如果有total_tf，将其考虑在内
+        if "total_tf" in doc:
+            final_scores[i] += doc["total_tf"] * 0.3
+    return final_scores
+
 def retrieval_sort(search_results, top_n=300):
     """
     对搜索结果进行高效重排序，优化为毫秒级
@@ -117,37 +171,27 @@ def retrieval_sort(search_results, top_n=300):
     if not query_terms and len(results) > 0 and "content" in results[0]:
         query_terms = results[0]["content"].split()[:10]
     
-    # 2. 极速版BM25评分：只检查词是否存在而不计算完整TF-IDF
-    term_weights = {term: 1.0 for term in query_terms}  # 简单词权重
-    
-    # 3. 并行计算得分 (使用numpy向量化操作代替循环)
-    doc_lengths = np.array([len(doc.get("content", "").split()) for doc in results])
-    avg_length = np.mean(doc_lengths) if doc_lengths.size > 0 else 1
-    
-    # 归一化文档长度
-    length_factors = 1.0 / (0.5 + 0.5 * (doc_lengths / avg_length) + 1e-9)
-    
-    # 对每个文档预先计算一个基础分数
-    for i, doc in enumerate(results):
-        # 利用内置命中计数或position数据(如存在)
-        content = doc.get("content", "").lower()
-        term_count = sum(1 for term in query_terms if term.lower() in content)
-        
-        # 使用简化的BM25启发式公式
-        final_scores[i] = term_count * length_factors[i]
-        
-        # 如果有total_tf，将其考虑在内
-        if "total_tf" in doc:
-            final_scores[i] += doc["total_tf"] * 0.3
+    corpus = search_results.get("corpus")
+    term_df = search_results.get("term_df", {})
+    if corpus and all("doc_length" in doc for doc in results):
+        # 2. 真正的BM25：tf 来自 postings，df/N/avgdl/文档长度来自索引构建时保存的统计量
+        for i, doc in enumerate(results):
+            final_scores[i] = sum(
+                bm25_term_score(tf, term_df.get(term, 1), doc["doc_length"], corpus["N"], corpus["avgdl"])
+                for term, tf in doc.get("term_frequencies", {}).items()
+            )
+    else:
+        # 没有语料统计量时退回到基于内容的估计
+        final_scores = heuristic_scores(results, query_terms)
     
-    # 4. 使用argpartition代替完整排序（更快）
+    # 3. 使用argpartition代替完整排序（更快）
     if len(final_scores) > top_n:
         top_indices = np.argpartition(-final_scores, top_n)[:top_n]
         top_indices = top_indices[np.argsort(-final_scores[top_indices])]
     else:
         top_indices = np.argsort(-final_scores)
     
-    # 5. 获取排序后的文档
+    # 4. 获取排序后的文档
     sorted_results = [results[i] for i in top_indices]
     
     # 返回结果
@@ -156,3 +200,11 @@ def retrieval_sort(search_results, top_n=300):
         "found_terms": search_results.get("found_terms", [])
     }
 
+
+if __name__ == "__main__":
+    # 离线排序：python retrieval_model.py search_results.json（search_func 返回的 {"results", "found_terms"}）
+    import sys
+
+    ranked = main(load_search_results(sys.argv[1] if len(sys.argv) > 1 else "search_results_test.json"))
+    for doc, score in ranked["results"][:20]:
+        print(f"{score:.4f}  {doc.get('doc_id', '')}  {doc.get('title', '')}")
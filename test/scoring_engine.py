@@ -0,0 +1,156 @@
+'''
+常驻内存的向量化打分引擎（替代每次查询重新拟合 TfidfVectorizer / BM25Okapi）
+
+对整个语料只构建一次 CSR 文档-词矩阵，并预先计算：
+    - TF-IDF 权重（与 TfidfVectorizer 默认设置一致：平滑 idf，按文档 L2 归一化）
+    - BM25 权重（idf、文档长度归一化都已算进矩阵）
+    - 原始词频（语言模型分数使用）
+三个权重矩阵横向拼接成一个 (文档数, 3 × 词表大小) 的矩阵，
+对任意候选文档子集打分只需要一次稀疏矩阵-矩阵乘法。
+
+这是离线工具，供 retrieval_model.main()/compute_scores 对保存下来的搜索结果做融合排序；
+/api/search 使用 retrieval_model.retrieval_sort（基于语料统计量的 BM25），不加载引擎。
+'''
+
+import json
+import os
+import sys
+
+import numpy as np
+from scipy import sparse
+
+from binary_index import PostingsShard
+from corpus_stats import K1, B
+
+ENGINE_MATRIX_FILE = "scoring_engine.npz"
+ENGINE_VOCAB_FILE = "scoring_engine_vocab.json"
+ENGINE_NORMS_FILE = "scoring_engine_norms.npy"
+
+
+class ScoringEngine:
+    """
+    :param weights: 拼接后的 CSR 权重矩阵，行号就是 doc_id
+    :param vocabulary: {term: 列号}
+    :param doc_norms: 每篇文档 TF-IDF 向量归一化前的 L2 范数
+    """
+
+    def __init__(self, weights, vocabulary, doc_norms=None):
+        self.weights = weights.tocsr()
+        self.vocabulary = vocabulary
+        self.doc_norms = doc_norms
+        self.vocab_size = len(vocabulary)
+
+    @classmethod
+    def from_tf_matrix(cls, tf, vocabulary, k1=K1, b=B):
+        """
+        从原始词频矩阵预计算全部权重
+        :param tf: (文档数, 词表大小) 的稀疏词频矩阵
+        """
+        tf = sparse.csr_matrix(tf, dtype=np.float64)
+        tf.sum_duplicates()
+        doc_lengths = np.asarray(tf.sum(axis=1)).ravel()
+        n_docs = max(int(np.count_nonzero(doc_lengths)), 1)
+        avgdl = doc_lengths[doc_lengths > 0].mean() if doc_lengths.any() else 1.0
+        df = np.bincount(tf.indices, minlength=tf.shape[1]).astype(np.float64)
+
+        # 每个非零元素所在的行号
+        rows = np.repeat(np.arange(tf.shape[0]), np.diff(tf.indptr))
+        cols = tf.indices
+        values = tf.data
+
+        # TF-IDF：tf × 平滑 idf，再按行做 L2 归一化
+        tfidf_idf = np.log((1 + n_docs) / (1 + df)) + 1
+        tfidf = tf.copy()
+        tfidf.data = values * tfidf_idf[cols]
+        doc_norms = np.sqrt(np.asarray(tfidf.multiply(tfidf).sum(axis=1)).ravel())
+        safe_norms = np.where(doc_norms > 0, doc_norms, 1.0)
+        tfidf.data = tfidf.data / safe_norms[rows]
+
+        # BM25：idf × 饱和后的 tf，长度归一化按文档预先计算
+        bm25_idf = np.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+        bm25 = tf.copy()
+        norm = k1 * (1 - b + b * doc_lengths[rows] / avgdl)
+        bm25.data = bm25_idf[cols] * values * (k1 + 1) / (values + norm)
+
+        weights = sparse.hstack([tfidf, bm25, tf], format="csr")
+        return cls(weights, vocabulary, doc_norms)
+
+    @classmethod
+    def from_shards(cls, shard_paths):
+        """遍历二进制倒排索引分片构建引擎"""
+        vocabulary = {}
+        rows, cols, values = [], [], []
+        for path in shard_paths:
+            shard = PostingsShard(path)
+            try:
+                for term, postings in shard.iter_postings():
+                    col = vocabulary.setdefault(term, len(vocabulary))
+                    rows.extend(postings.doc_ids)
+                    cols.extend([col] * len(postings))
+                    values.extend(postings.tfs)
+            finally:
+                shard.close()
+        n_docs = max(rows) + 1 if rows else 0
+        tf = sparse.coo_matrix((values, (rows, cols)), shape=(n_docs, len(vocabulary)))
+        return cls.from_tf_matrix(tf, vocabulary)
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        sparse.save_npz(os.path.join(directory, ENGINE_MATRIX_FILE), self.weights)
+        np.save(os.path.join(directory, ENGINE_NORMS_FILE), self.doc_norms)
+        with open(os.path.join(directory, ENGINE_VOCAB_FILE), "w", encoding="utf-8") as f:
+            json.dump(self.vocabulary, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, directory):
+        """加载保存好的引擎，文件不存在时返回 None"""
+        matrix_path = os.path.join(directory, ENGINE_MATRIX_FILE)
+        vocab_path = os.path.join(directory, ENGINE_VOCAB_FILE)
+        if not (os.path.exists(matrix_path) and os.path.exists(vocab_path)):
+            return None
+        with open(vocab_path, "r", encoding="utf-8") as f:
+            vocabulary = json.load(f)
+        norms_path = os.path.join(directory, ENGINE_NORMS_FILE)
+        doc_norms = np.load(norms_path) if os.path.exists(norms_path) else None
+        return cls(sparse.load_npz(matrix_path), vocabulary, doc_norms)
+
+    def query_matrix(self, terms):
+        """
+        构造 (3 × 词表大小, 3) 的查询矩阵，每一列分别选出 TF-IDF、BM25、词频块中的查询词
+        每个查询词单独作为一个查询，与 compute_tfidf/compute_bm25/compute_lm 的求和方式一致
+        """
+        cols = [self.vocabulary[term] for term in terms if term in self.vocabulary]
+        rows = []
+        model_cols = []
+        for block in range(3):
+            rows.extend(block * self.vocab_size + col for col in cols)
+            model_cols.extend([block] * len(cols))
+        data = np.ones(len(rows))
+        return sparse.csr_matrix((data, (rows, model_cols)), shape=(3 * self.vocab_size, 3))
+
+    def score(self, doc_ids, terms):
+        """
+        对候选文档打分
+        :param doc_ids: 候选文档ID列表（字符串或整数）
+        :param terms: 查询词列表
+        :return: (tfidf_scores, bm25_scores, lm_scores)，均为与 doc_ids 对齐的数组
+        """
+        rows = np.array([int(doc_id) for doc_id in doc_ids], dtype=np.int64)
+        valid = (rows >= 0) & (rows < self.weights.shape[0])
+        scores = np.zeros((len(rows), 3))
+        if valid.any():
+            product = self.weights[rows[valid]] @ self.query_matrix(terms)
+            scores[valid] = product.toarray()
+        return scores[:, 0], scores[:, 1], scores[:, 2]
+
+
+if __name__ == "__main__":
+    # 从二进制索引分片构建并保存打分引擎: python scoring_engine.py [cache 目录]
+    cache_dir = sys.argv[1] if len(sys.argv) > 1 else "cache"
+    paths = sorted(
+        os.path.join(cache_dir, name) for name in os.listdir(cache_dir)
+        if name.startswith("inverted_index_") and name.endswith(".bin")
+    )
+    engine = ScoringEngine.from_shards(paths)
+    engine.save(cache_dir)
+    print(f"打分引擎已保存到 {cache_dir}: {engine.weights.shape[0]} 篇文档, {engine.vocab_size} 个词")
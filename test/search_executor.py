@@ -0,0 +1,183 @@
+'''
+把 CPU 密集的查询分析、检索和排序从 asyncio 事件循环中移出去执行
+    - SEARCH_EXECUTOR=thread（默认）：线程池，共享进程内的索引缓存和结果缓存
+    - SEARCH_EXECUTOR=process：进程池，绕开 GIL，吞吐随 CPU 核数增长；
+      每个工作进程各自按需映射索引分片（mmap 的页由操作系统共享）
+    - SEARCH_WORKERS：工作线程/进程数，默认为 CPU 核数
+    - SEARCH_TIMEOUT：单个请求的截止时间（秒），默认 30
+
+截止时间之后，还没开始的任务直接取消；已经在执行的任务在各阶段之间检查 SearchDeadline，
+超时或被取消时抛出 SearchCancelled，不再继续做后面的检索和排序。
+'''
+
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from query_parser import parse_query, handle_long_query, analyze_query
+from result_cache import estimate_size
+from retrieval_model import retrieval_sort
+from search_func import track_unavailable_shards
+
+EXECUTOR_KIND = os.environ.get("SEARCH_EXECUTOR", "thread")
+WORKERS = int(os.environ.get("SEARCH_WORKERS", 0)) or os.cpu_count() or 1
+SEARCH_TIMEOUT = float(os.environ.get("SEARCH_TIMEOUT", 30))
+
+
+class SearchCancelled(Exception):
+    """查询超过截止时间或被取消"""
+
+
+class SearchDeadline:
+    """
+    协作式取消：执行方在各阶段之间调用 check()
+    线程池中 cancel() 立即对正在执行的任务可见；进程池中只能依靠截止时间本身
+    """
+
+    def __init__(self, timeout=SEARCH_TIMEOUT):
+        # 使用 time.time()，在不同进程之间也可以比较
+        self.expires_at = time.time() + timeout if timeout else None
+        self.cancelled = False
+
+    def remaining(self):
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.time())
+
+    def cancel(self):
+        self.cancelled = True
+
+    def check(self, stage=""):
+        if self.cancelled:
+            raise SearchCancelled(f"查询已取消 {stage}".strip())
+        if self.expires_at is not None and time.time() >= self.expires_at:
+            raise SearchCancelled(f"查询超时 {stage}".strip())
+
+
+def run_search_pipeline(analyzed, deadline=None):
+    """
+    执行查询并排序，返回排好序的轻量结果（只有文档ID和打分数据，不含标题/URL/正文）
+    标题/URL 和摘要只在分页返回时为当前页读取；没有语料统计量时检索阶段会读取正文供启发式评分使用
+    :return: {"results": 排好序的结果, "unavailable_shards": 未响应的分片服务器（结果不完整，不应缓存）,
+              "size": 结果的估算大小（写入结果缓存时使用，不在事件循环中遍历结果）}
+    """
+    deadline = deadline or SearchDeadline(None)
+    unavailable = track_unavailable_shards()
+    print(f"执行搜索...")
+    deadline.check("（检索前）")
+    results = parse_query(analyzed, hydrate=False)
+    print(f"初始搜索返回结果结构: {results.keys() if isinstance(results, dict) else '非字典结构'}")
+
+    # 检查结果是否为空或少于30条
+    result_count = 0
+    if isinstance(results, dict) and "results" in results:
+        result_count = len(results["results"])
+
+    print(f"初始搜索找到 {result_count} 条结果")
+
+    # 修改检查逻辑，处理结果可能为空的情况
+    if result_count < 30:
+        deadline.check("（补充检索前）")
+        print(f"搜索结果较少 (仅{result_count}条)，尝试使用handle_long_query函数")
+        # 调用handle_long_query获取更多结果
+        alternative_results = handle_long_query(analyzed, hydrate=False)
+
+        # 检查替代结果
+        alt_result_count = 0
+        if isinstance(alternative_results, dict) and "results" in alternative_results:
+            alt_result_count = len(alternative_results["results"])
+
+        print(f"替代搜索找到 {alt_result_count} 条结果")
+
+        # 只有当替代结果有更多内容时才替换
+        if alt_result_count > result_count:
+            print(f"使用handle_long_query获得更多结果: {alt_result_count}条")
+            results = alternative_results
+        else:
+            print("handle_long_query未能提供更好的结果，保留原始结果")
+
+    # 限制结果数量，防止排序过慢
+    max_results = 5000
+    if "results" in results and len(results["results"]) > max_results:
+        print(f"结果数量过多 ({len(results['results'])}), 限制为前{max_results}条进行排序")
+        results["results"] = results["results"][:max_results]
+
+    deadline.check("（排序前）")
+    print(f"搜索结束，开始进行推荐排序")
+    sort_start = time.time()
+    result_after_sort = retrieval_sort(results)
+    print(f"排序完成，用时: {time.time() - sort_start:.2f} 秒")
+    # 没有语料统计量时结果中带有启发式评分用的正文，排序之后不再需要，不放进结果缓存
+    ranked = [
+        {key: value for key, value in doc.items() if key != "content"} if "content" in doc else doc
+        for doc in result_after_sort.get("results", [])
+    ]
+    return {"results": ranked, "unavailable_shards": sorted(unavailable), "size": estimate_size(ranked)}
+
+
+def analyze_in_worker(query, deadline):
+    deadline.check("（分析前）")
+    return analyze_query(query)
+
+
+class SearchExecutor:
+    """
+    在线程池或进程池中执行查询，await 时受截止时间约束
+    :param kind: "thread" 或 "process"
+    :param workers: 工作线程/进程数
+    """
+
+    def __init__(self, kind=EXECUTOR_KIND, workers=WORKERS):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"未知的执行器类型: {kind}")
+        self.kind = kind
+        self.workers = workers
+        self._pool = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            if self.kind == "process":
+                # 服务进程中已经有事件循环和后台线程，用 spawn 启动干净的工作进程
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            else:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="search")
+            print(f"查询执行器: {self.kind} × {self.workers}")
+        return self._pool
+
+    async def run(self, fn, *args, deadline):
+        """
+        在执行器中运行 fn(*args, deadline)，超过截止时间抛出 SearchCancelled
+        await 被取消（例如服务关闭）时同样通知执行方停止
+        """
+        deadline.check()
+        pool = self._get_pool()
+        try:
+            future = pool.submit(fn, *args, deadline)
+        except BrokenProcessPool:
+            # 工作进程异常退出后重建进程池
+            self._pool = None
+            future = self._get_pool().submit(fn, *args, deadline)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout=deadline.remaining())
+        except asyncio.TimeoutError:
+            deadline.cancel()
+            raise SearchCancelled("查询超时")
+        except asyncio.CancelledError:
+            deadline.cancel()
+            raise
+
+    async def analyze(self, query, deadline):
+        return await self.run(analyze_in_worker, query, deadline=deadline)
+
+    async def search(self, analyzed, deadline):
+        return await self.run(run_search_pipeline, analyzed, deadline=deadline)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
@@ -10,25 +10,51 @@ from nltk.corpus import stopwords
 import nltk
 import pickle
 import os
-import string
 import json
+import threading
 from retrieval_model import retrieval_sort
+from binary_index import PostingsShard, TermPostings, shard_file_name
+from query_eval import top_k_or, intersect, count_phrase_matches
+from boolean_query import plan_query, execute_plan, all_words, positive_words, to_expression
+from bisect import bisect_left
+from doc_store import DocStore, build_doc_store, store_exists
+from corpus_stats import load_corpus_stats
+from snippets import make_snippet, fallback_snippet
+from segments import SegmentIndex, SEGMENTS_DIR, MANIFEST_FILE
+from shard_router import load_router
+from shard_server import ShardCoordinator, load_cluster, CLUSTER_FILE
+from query_log import QUERY_LOG_FILE
+from shard_cache import ShardCache
+from mongo_terms import TermStore
 # 缓存文件路径
 CACHE_DIR = "cache"
+
+# 确保缓存目录存在
+if not os.path.exists(CACHE_DIR):
+    os.makedirs(CACHE_DIR)
+
+# 词到分片的路由（cache/routing.json，见 shard_router.py），没有路由表时按首字符切分
+_router = load_router(CACHE_DIR)
+SHARDS = _router.shards()
+
 # II_CACHE_FILE_A = os.path.join(CACHE_DIR, "inverted_index_a_cache.pkl")
 II_CACHE_FILES = {
-    char: os.path.join(CACHE_DIR, f"inverted_index_{char}_cache.pkl")
-    for char in string.ascii_lowercase + string.digits
+    shard: os.path.join(CACHE_DIR, f"inverted_index_{shard}_cache.pkl")
+    for shard in SHARDS
 }
 # 实例去访问
 # print(II_CACHE_FILES["a"])  # /path/to/cache/inverted_index_a_cache.pkl
 
+# 二进制倒排索引分片（mmap 打开，按词惰性解码），存在时优先于 pickle 缓存
+II_BINARY_FILES = {
+    shard: os.path.join(CACHE_DIR, shard_file_name(shard))
+    for shard in SHARDS
+}
 
-CONTENT_CACHE_FILE = os.path.join(CACHE_DIR, "content_cache.pkl")
 
-# 确保缓存目录存在
-if not os.path.exists(CACHE_DIR):
-    os.makedirs(CACHE_DIR)
+CONTENT_CACHE_FILE = os.path.join(CACHE_DIR, "content_cache.pkl")
+# 偏移表 + 记录文件形式的文档存储（content.offsets / content.records），按 doc_id O(1) 读取
+CONTENT_STORE_PREFIX = os.path.join(CACHE_DIR, "content")
 
 # 确保下载必要的NLTK数据
 try:
@@ -45,91 +71,223 @@ lemmatizer = WordNetLemmatizer()
 STOP_WORDS = set(stopwords.words('english'))
 
 # 连接到 MongoDB
-client = pymongo.MongoClient("mongodb://35.214.122.215:27017")
+# connect=False：第一次使用时才建立连接，预加载后 fork 出的工作进程各自连接（MongoClient 不能跨 fork 共享）
+MONGO_URI = os.environ.get("MONGO_URI", "mongodb://35.214.122.215:27017")
+client = pymongo.MongoClient(MONGO_URI, connect=False)
 db = client['search_db']
 content_collection = db['content']
 # inverted_index_collection_a = db['inverted_index_a']
 # inverted_index_collections["a"]
 inverted_index_collections = {
-    char: db[f"inverted_index_{char}"] for char in string.ascii_lowercase + string.digits
+    shard: db[f"inverted_index_{shard}"] for shard in SHARDS
 }
 
+# 本地没有二进制/pickle 分片文件时按词查询 MongoDB（见 mongo_terms.py），只读取查询用到的词；
+# MONGO_TERM_LOOKUP=0 时恢复原来的行为：扫描整个集合、保存为 pickle 缓存后在内存中查询
+MONGO_TERM_LOOKUP = os.environ.get("MONGO_TERM_LOOKUP", "1") != "0"
+_term_store = TermStore(MONGO_URI, 'search_db')
+
 # 缓存数据
 # _inverted_index_cache_a = None
-# _inverted_index_caches["a"]
-_inverted_index_caches = {char: None for char in string.ascii_lowercase + string.digits}
+# 已加载的分片由 _shard_cache 管理（见 shard_cache.py 和下面的 load_inverted_index_caches）
+# SHARD_CACHE_MB：已加载分片估算大小之和的上限（MB），0 表示不限制；SHARD_CACHE_POLICY：lru 或 lfu
+SHARD_CACHE_MB = int(os.environ.get("SHARD_CACHE_MB", 0))
+SHARD_CACHE_POLICY = os.environ.get("SHARD_CACHE_POLICY", "lru")
+# pickle 分片反序列化成 dict/list 后在内存中的大小约为文件大小的倍数
+PICKLE_MEMORY_FACTOR = 4
 
 _content_cache = None
+_content_lock = threading.Lock()
+
+# 语料统计量（N、avgdl、文档长度），用于直接从 postings 计算 BM25
+_corpus_stats = None
+_corpus_stats_loaded = False
+
+# 增量写入的段（见 segments.py），与基础索引一起查询
+SEGMENTS_PATH = os.path.join(CACHE_DIR, SEGMENTS_DIR)
+_segment_index = None
+
+# 分片服务器集群配置（见 shard_server.py），存在时倒排索引分片由分片服务器提供，本进程不加载
+CLUSTER_PATH = os.environ.get("SHARD_CLUSTER") or os.path.join(CACHE_DIR, CLUSTER_FILE)
+_shard_coordinator = None
+_shard_coordinator_loaded = False
+# 当前线程中的查询未能从哪些分片服务器取到 postings（见 track_unavailable_shards）
+_shard_tracking = threading.local()
+
+# 或查询保留的候选文档数（之后由 retrieval_sort 重排并截取前 300 条）
+OR_TOP_K = 1000
+
+# 参与索引版本计算的文件后缀
+INDEX_FILE_SUFFIXES = ('.bin', '.pkl', '.offsets', '.records', '.json')
+# 缓存目录中不属于索引的文件（查询日志等），变化时不影响版本号
+NON_INDEX_FILES = (QUERY_LOG_FILE,)
 
-def load_inverted_index_caches(first_char):
-    """加载倒排索引缓存"""
-    for char, value in _inverted_index_caches.items():
-        if char == first_char:
-            if _inverted_index_caches[char] is None:
-                globals()[f"_inverted_index_caches_{char}"] = _inverted_index_caches[char]
-                print(f"加载倒排索引缓存{char}...")
-                try:
-                    with open(II_CACHE_FILES[char], 'rb') as f:
-                        _inverted_index_caches[char] = pickle.load(f)
-                    print(f"从文件加载倒排索引缓存{char}完成")
-                except (FileNotFoundError, EOFError):
-                    print(f"从数据库加载倒排索引缓存{char}...")
-                    _inverted_index_caches[char] = {}
-                    for term_doc in inverted_index_collections[char].find():
-                        _inverted_index_caches[char][term_doc['term']] = term_doc['data']
-                    # 保存到文件
-                    with open(II_CACHE_FILES[char], 'wb') as f:
-                        pickle.dump(_inverted_index_caches[char], f)
-                    print(f"倒排索引缓存{char}已保存到文件")
+def index_version():
+    """
+    当前索引的版本号：由缓存目录中索引文件的名称、修改时间和大小组成，
+    重新构建或替换索引文件后自动变化
+    """
+    parts = []
+    for name in sorted(os.listdir(CACHE_DIR)):
+        if name.endswith(INDEX_FILE_SUFFIXES) and name not in NON_INDEX_FILES:
+            stat = os.stat(os.path.join(CACHE_DIR, name))
+            parts.append(f"{name}:{stat.st_mtime_ns}:{stat.st_size}")
+    # 新增/删除/合并段都会替换 manifest
+    manifest = os.path.join(SEGMENTS_PATH, MANIFEST_FILE)
+    if os.path.exists(manifest):
+        parts.append(f"{MANIFEST_FILE}:{os.stat(manifest).st_mtime_ns}")
+    return str(hash(tuple(parts)))
+
+def get_segment_index():
+    """打开增量段的视图（没有段时为空视图，之后写入的段会被自动发现）"""
+    global _segment_index
+    if _segment_index is None:
+        _segment_index = SegmentIndex(SEGMENTS_PATH)
+    return _segment_index
+
+def get_shard_coordinator():
+    """有集群配置时返回分片服务器协调器，否则返回 None（在本进程内加载分片）"""
+    global _shard_coordinator, _shard_coordinator_loaded
+    if not _shard_coordinator_loaded:
+        servers = load_cluster(CLUSTER_PATH)
+        if servers:
+            _shard_coordinator = ShardCoordinator(servers, _router)
+            print(f"倒排索引由 {len(servers)} 台分片服务器提供: {CLUSTER_PATH}")
+        _shard_coordinator_loaded = True
+    return _shard_coordinator
+
+def track_unavailable_shards():
+    """
+    开始记录当前线程中未响应的分片服务器，返回记录用的集合
+    一次查询在一个线程（或进程池的一个进程）中执行，调用方据此判断结果是否完整
+    """
+    _shard_tracking.servers = set()
+    return _shard_tracking.servers
+
+def _load_shard(shard):
+    """从二进制分片、pickle 缓存或数据库加载一个分片（由 _shard_cache 调用，同一分片不会并发执行）"""
+    print(f"加载倒排索引缓存{shard}...")
+    if os.path.exists(II_BINARY_FILES[shard]):
+        cache = PostingsShard(II_BINARY_FILES[shard])
+        print(f"从二进制索引映射倒排索引缓存{shard}完成")
+        return cache
+    try:
+        with open(II_CACHE_FILES[shard], 'rb') as f:
+            cache = pickle.load(f)
+        print(f"从文件加载倒排索引缓存{shard}完成")
+    except (FileNotFoundError, EOFError):
+        print(f"从数据库加载倒排索引缓存{shard}...")
+        cache = {}
+        for term_doc in inverted_index_collections[shard].find():
+            cache[term_doc['term']] = term_doc['data']
+        # 保存到文件
+        with open(II_CACHE_FILES[shard], 'wb') as f:
+            pickle.dump(cache, f)
+        print(f"倒排索引缓存{shard}已保存到文件")
+    return cache
+
+def estimated_shard_bytes(shard, cache=None):
+    """
+    分片加载后估算占用的内存：二进制分片按文件大小（mmap 的页预热后计入常驻内存），
+    pickle 分片按文件大小乘以 PICKLE_MEMORY_FACTOR；还没有缓存文件时为 0
+    """
+    if os.path.exists(II_BINARY_FILES[shard]) and not isinstance(cache, dict):
+        return os.path.getsize(II_BINARY_FILES[shard])
+    if os.path.exists(II_CACHE_FILES[shard]):
+        return os.path.getsize(II_CACHE_FILES[shard]) * PICKLE_MEMORY_FACTOR
+    return 0
 
+_shard_cache = ShardCache(
+    _load_shard, estimated_shard_bytes, max_bytes=SHARD_CACHE_MB * 1024 * 1024, policy=SHARD_CACHE_POLICY
+)
 
+def load_inverted_index_caches(shard):
+    """
+    加载倒排索引缓存，返回分片（PostingsShard 或 dict）
+    同一分片只加载一次：预热线程和查询线程并发请求时，后到者等待加载完成，不会看到只加载了一部分的分片；
+    超出 SHARD_CACHE_MB 时最久未使用（或命中最少）的分片被淘汰，之后用到时重新加载
+    """
+    return _shard_cache.get(shard)
 
+def iter_vocabulary():
+    """
+    遍历基础索引中的 (term, df)，用于查询建议（suggest.py）
+    二进制分片直接读取文件中的词典，不经过分片缓存；pickle 分片只在已加载时读取，
+    按词查询 MongoDB 的分片没有本地词表
+    """
+    for shard in SHARDS:
+        if os.path.exists(II_BINARY_FILES[shard]):
+            postings_shard = PostingsShard(II_BINARY_FILES[shard])
+            try:
+                for term, df, _ in postings_shard.iter_term_stats():
+                    yield term, df
+            finally:
+                postings_shard.close()
+            continue
+        cache = _shard_cache.peek(shard)
+        if isinstance(cache, dict):
+            for term, mapping in cache.items():
+                yield term, len(mapping)
+
+def shard_cache_stats():
+    return _shard_cache.stats()
+
+def shard_of(term):
+    """词所在的分片名（见 routing.json），不属于任何分片时返回 None"""
+    return _router.shard_of(term)
+
+def uses_term_lookup(shard):
+    """分片是否按词从 MongoDB 查询（本地没有该分片的任何缓存文件）"""
+    return MONGO_TERM_LOOKUP and shard in II_BINARY_FILES and not (os.path.exists(II_BINARY_FILES[shard]) or os.path.exists(II_CACHE_FILES[shard]))
+
+def fetch_mongo_postings(terms):
+    """
+    按词从 MongoDB 读取 postings：每个分片一次批量查询，各分片并发
+    :return: {term: TermPostings}，索引中没有的词不在其中
+    """
+    terms_by_shard = {}
+    for term in terms:
+        terms_by_shard.setdefault(_router.shard_of(term), set()).add(term)
+    found = _term_store.fetch(terms_by_shard)
+    return {term: TermPostings.from_mapping(term, data) for term, data in found.items()}
+
+def prefetch_shard(shard):
+    """加载分片，二进制分片还把文件页读入内存，之后的查询不再因缺页等待磁盘"""
+    if uses_term_lookup(shard):
+        # 按词查询的分片没有可以预先加载的内容
+        return
+    cache = load_inverted_index_caches(shard)
+    if isinstance(cache, PostingsShard):
+        cache.prefetch()
 
 def load_content_caches():
     """加载数据到缓存，优先从文件加载，如果文件不存在则从数据库加载并保存到文件"""
     global _content_cache
     
-    if all(value is not None for value in _inverted_index_caches.values()) and _content_cache is not None:
+    if _content_cache is not None:
         return  # 如果内存中已有缓存，直接返回
     
-    # 尝试从文件加载文档内容缓存
-    if _content_cache is None:
-        print("加载文档内容...")
-        try:
-            with open(CONTENT_CACHE_FILE, 'rb') as f:
-                _content_cache = pickle.load(f)
-            print("从文件加载文档内容完成")
-        except (FileNotFoundError, EOFError):
-            print("从数据库加载文档内容...")
-            _content_cache = {
-                str(doc['doc_id']): doc 
-                for doc in content_collection.find({}, {"_id": 0})
-            }
-            # 保存到文件
-            with open(CONTENT_CACHE_FILE, 'wb') as f:
-                pickle.dump(_content_cache, f)
-            print("文档内容已保存到文件")
-    
-
-    # 在服务器中 可以一次性加载所有缓存文件
-    # for char, value in _inverted_index_caches.items():
-    #     if _inverted_index_caches[char] is None:
-    #         globals()[f"_inverted_index_caches_{char}"] = _inverted_index_caches[char]
-    #         print(f"加载倒排索引缓存{char}...")
-    #         try:
-    #             with open(II_CACHE_FILES[char], 'rb') as f:
-    #                 _inverted_index_caches[char] = pickle.load(f)
-    #             print(f"从文件加载倒排索引缓存{char}完成")
-    #         except (FileNotFoundError, EOFError):
-    #             print(f"从数据库加载倒排索引缓存{char}...")
-    #             _inverted_index_caches[char] = {}
-    #             for term_doc in inverted_index_collections[char].find():
-    #                 _inverted_index_caches[char][term_doc['term']] = term_doc['data']
-    #             # 保存到文件
-    #             with open(II_CACHE_FILES[char], 'wb') as f:
-    #                 pickle.dump(_inverted_index_caches[char], f)
-    #             print(f"倒排索引缓存{char}已保存到文件")
-
+    with _content_lock:
+        # 尝试从文件加载文档内容缓存
+        if _content_cache is None:
+            print("加载文档内容...")
+            if store_exists(CONTENT_STORE_PREFIX):
+                _content_cache = DocStore(CONTENT_STORE_PREFIX)
+                print("从文档存储映射文档内容完成")
+                return
+            try:
+                # 兼容旧的 pickle 缓存
+                with open(CONTENT_CACHE_FILE, 'rb') as f:
+                    _content_cache = pickle.load(f)
+                print("从文件加载文档内容完成")
+            except (FileNotFoundError, EOFError):
+                print("从数据库加载文档内容...")
+                # 流式写入文档存储，不再把全部内容放进内存；同时保存每个词的字节区间用于生成摘要
+                # （text_analysis 在导入时读取停用词，放在 NLTK 数据下载之后导入）
+                from text_analysis import add_token_offsets
+                build_doc_store(add_token_offsets(content_collection.find({}, {"_id": 0})), CONTENT_STORE_PREFIX)
+                _content_cache = DocStore(CONTENT_STORE_PREFIX)
+                print("文档内容已保存到文档存储")
 
 
 def process_query(query):
@@ -143,10 +301,187 @@ def process_query(query):
     # 去除停用词并进行词形还原
     return [lemmatizer.lemmatize(word) for word in words if word not in STOP_WORDS]
 
-def or_search(query):
+# 可以按需读取的文档字段
+DOC_FIELDS = ("title", "url", "content")
+# 没有语料统计量时 retrieval_sort 的启发式评分（retrieval_model.heuristic_scores）需要正文
+HEURISTIC_FIELDS = ("content",)
+
+def get_document(doc_id, fields=DOC_FIELDS):
+    """
+    按 doc_id 读取文档的指定字段（文档存储只读取需要的字段）
+    :param fields: 需要的字段，为空时只检查文档是否存在
+    :return: {"doc_id", 字段...}，文档不存在时返回 None
+    """
+    doc_id = str(doc_id)
+    segments = get_segment_index()
+    if segments.active:
+        # 新增或更新过的文档从段中读取，已删除的文档不再返回
+        segment = segments.segment_of(doc_id)
+        if segment is not None:
+            return segment.store.get(doc_id, fields) if fields else {"doc_id": doc_id}
+        if not segments.base_live(doc_id):
+            return None
+    if not fields:
+        return {"doc_id": doc_id} if doc_id in _content_cache else None
+    if isinstance(_content_cache, DocStore):
+        return _content_cache.get(doc_id, fields)
+    document = _content_cache.get(doc_id)
+    if document is None:
+        return None
+    return {"doc_id": doc_id, **{field: document.get(field) for field in fields}}
+
+def result_fields(hydrate):
+    """
+    查询结果中读取的文档字段
+    hydrate 为 False 时只读取排序需要的字段：有语料统计量时不读取，否则读取启发式评分用的正文
+    """
+    if hydrate:
+        return DOC_FIELDS
+    return () if get_corpus_stats() is not None else HEURISTIC_FIELDS
+
+def hydrate_documents(doc_ids, fields=DOC_FIELDS):
+    """
+    只为需要展示的文档读取内容（例如当前页）
+    :return: 与 doc_ids 对齐的文档列表，不存在的文档为 None
+    """
+    load_content_caches()
+    return [get_document(doc_id, fields) for doc_id in doc_ids]
+
+def get_snippet(doc_id, term_positions):
+    """
+    根据匹配位置生成查询摘要，只读取摘要覆盖的那一段正文
+    旧格式的文档存储/pickle 缓存没有词的字节区间，退回到截取正文开头
+    :return: {"snippet", "highlights"}，文档不存在时返回 None
+    """
+    load_content_caches()
+    segments = get_segment_index()
+    segment = segments.segment_of(doc_id) if segments.active else None
+    store = segment.store if segment is not None else _content_cache
+    if isinstance(store, DocStore):
+        offsets = store.token_offsets(doc_id)
+        if offsets:
+            return make_snippet(
+                offsets, term_positions,
+                lambda start, end: store.read_content_bytes(doc_id, start, end)
+            )
+    document = get_document(doc_id, ("content",))
+    if document is None:
+        return None
+    return fallback_snippet(document["content"])
+
+def get_corpus_stats():
+    """加载语料统计量（包含增量段中的文档），没有统计文件时返回 None"""
+    global _corpus_stats, _corpus_stats_loaded
+    if not _corpus_stats_loaded:
+        _corpus_stats = load_corpus_stats(CACHE_DIR)
+        _corpus_stats_loaded = True
+        if _corpus_stats is None:
+            print("未找到语料统计文件，BM25 将退回到基于内容的估计")
+    if _corpus_stats is None:
+        return None
+    return get_segment_index().corpus_stats(_corpus_stats)
+
+def with_corpus_statistics(result, postings_lists):
+    """
+    在查询结果中附上 BM25 需要的统计量：每个词的 df、语料的 N 和 avgdl，以及每篇文档的长度
+    """
+    stats = get_corpus_stats()
+    if stats is None or "results" not in result:
+        return result
+    result["term_df"] = {postings.term: postings.df for postings in postings_lists}
+    result["corpus"] = stats.summary()
+    for doc in result["results"]:
+        doc["doc_length"] = stats.doc_length(doc["doc_id"])
+    return result
+
+def get_term_postings(term):
+    """
+    获取词的 postings（文档ID升序），二进制分片直接解码，pickle/MongoDB 分片做一次转换，
+    再与增量段中的 postings 合并（过滤掉已删除/已更新的旧副本）
+    :return: TermPostings，词不在索引中时返回 None
+    """
+    return get_segment_index().merge_postings(term, get_base_term_postings(term))
+
+def lookup_terms(query_terms):
+    """
+    获取全部查询词的 postings，有分片服务器时一次并行请求所有相关的服务器
+    :return: (found_terms, postings_lists)，按查询词顺序，只包含索引中存在的词
+    """
+    coordinator = get_shard_coordinator()
+    segments = get_segment_index()
+    if coordinator is not None:
+        base = fetch_remote_postings(coordinator, query_terms)
+        get_postings = lambda term: segments.merge_postings(term, base.get(term))
+    else:
+        # 按词查询 MongoDB 的分片：全部查询词一次批量读取，其余分片在本地查找
+        remote_terms = [term for term in query_terms if uses_term_lookup(_router.shard_of(term))]
+        if remote_terms:
+            base = fetch_mongo_postings(remote_terms)
+            remote_terms = set(remote_terms)
+            get_postings = lambda term: (
+                segments.merge_postings(term, base.get(term)) if term in remote_terms else get_term_postings(term)
+            )
+        else:
+            get_postings = get_term_postings
+    found_terms = []
+    postings_lists = []
+    for term in query_terms:
+        postings = get_postings(term)
+        if postings is not None:
+            found_terms.append(term)
+            postings_lists.append(postings)
+    return found_terms, postings_lists
+
+def fetch_remote_postings(coordinator, terms):
+    """从分片服务器获取 postings，未响应的服务器记录到当前线程的查询中"""
+    postings, failed = coordinator.fetch_postings(set(terms))
+    if failed:
+        print(f"分片服务器未响应，结果可能不完整: {', '.join(failed)}")
+        servers = getattr(_shard_tracking, "servers", None)
+        if servers is not None:
+            servers.update(failed)
+    return postings
+
+def get_base_term_postings(term):
+    """基础索引中词的 postings"""
+    coordinator = get_shard_coordinator()
+    if coordinator is not None:
+        return fetch_remote_postings(coordinator, [term]).get(term)
+    shard_name = _router.shard_of(term)
+    if shard_name not in II_BINARY_FILES:
+        return None
+    if uses_term_lookup(shard_name):
+        return fetch_mongo_postings([term]).get(term)
+    shard = load_inverted_index_caches(shard_name)
+    if isinstance(shard, PostingsShard):
+        return shard.get_postings(term)
+    if term in shard:
+        return TermPostings.from_mapping(term, shard[term])
+    return None
+
+def collect_term_data(doc_id, postings_lists):
+    """
+    只为最终保留的文档收集每个词的 tf 和位置
+    :return: (total_tf, {term: tf}, {term: positions})
+    """
+    total_tf = 0
+    terms = {}
+    positions = {}
+    for postings in postings_lists:
+        i = bisect_left(postings.doc_ids, doc_id)
+        if i < len(postings.doc_ids) and postings.doc_ids[i] == doc_id:
+            total_tf += postings.tfs[i]
+            terms[postings.term] = postings.tfs[i]
+            positions[postings.term] = postings.positions(i)
+    return total_tf, terms, positions
+
+def or_search(query, top_k=OR_TOP_K, hydrate=True):
     """
     或查询（OR）：查找包含任意查询词的文档
+    使用 MaxScore 剪枝只计算可能进入前 top_k 的文档
     :param query: 查询的关键词字符串，多个关键词用空格分隔
+    :param top_k: 返回的最大文档数，None 表示返回全部
+    :param hydrate: 是否读取标题/URL/正文，False 时只返回文档ID和打分数据（见 result_fields）
     :return: 查询结果列表或错误信息
     """
     load_content_caches()
@@ -155,56 +490,49 @@ def or_search(query):
     if not query_terms:
         return {"message": "No valid search terms after removing stop words."}
     
-    doc_scores = {}
-    found_terms = []
-    
-    for term in query_terms:
-        first_char = term[0]
-        load_inverted_index_caches(first_char)
-        if term in _inverted_index_caches[first_char]:
-            found_terms.append(term)
-            results = _inverted_index_caches[first_char][term]
-            for doc_id, data in results.items():
-                if doc_id not in doc_scores:
-                    doc_scores[doc_id] = {
-                        'total_tf': 0,
-                        'terms': {},
-                        'positions': {}
-                    }
-                doc_scores[doc_id]['total_tf'] += data['tf']
-                doc_scores[doc_id]['terms'][term] = data['tf']
-                doc_scores[doc_id]['positions'][term] = data['positions']
+    found_terms, postings_lists = lookup_terms(query_terms)
 
     if not found_terms:
         return {"message": f"None of the search terms were found in the index."}
 
+    if top_k is None:
+        top_k = sum(len(postings) for postings in postings_lists)
+
+    # 有语料统计量时按 BM25 剪枝排序，否则按 total_tf
+    stats = get_corpus_stats()
+    term_score = upper_bound = None
+    if stats is not None:
+        term_score = lambda j, i: stats.bm25(
+            postings_lists[j].tfs[i], postings_lists[j].df, postings_lists[j].doc_ids[i]
+        )
+        upper_bound = lambda j: stats.upper_bound(postings_lists[j].max_tf, postings_lists[j].df)
+
     output = []
-    for doc_id, score_data in sorted(
-        doc_scores.items(), 
-        key=lambda x: x[1]['total_tf'], 
-        reverse=True
-    ):
-        document = _content_cache.get(doc_id)
+    fields = result_fields(hydrate)
+    for score, doc_id in top_k_or(postings_lists, top_k, term_score, upper_bound):
+        document = get_document(doc_id, fields)
         if document:
+            total_tf, terms, positions = collect_term_data(doc_id, postings_lists)
             output.append({
-                "doc_id": doc_id,
-                "title": document['title'],
-                "url": document['url'],
-                "content": document['content'],
-                "total_tf": score_data['total_tf'],
-                "term_frequencies": score_data['terms'],
-                "term_positions": score_data['positions']
+                **document,
+                "score": score,
+                "total_tf": total_tf,
+                "term_frequencies": terms,
+                "term_positions": positions
             })
     
-    return {
+    return with_corpus_statistics({
         "results": output, 
         "found_terms": found_terms
-    }
+    }, postings_lists)
 
-def phrase_search(query):
+def phrase_search(query, max_matches=None, hydrate=True):
     """
     短语查询：查找包含完整短语的文档（词必须相邻）
+    先对所有短语词的文档ID求交集，再对交集中的文档线性合并位置列表
     :param query: 查询的短语（不需要引号）
+    :param max_matches: 每篇文档最多统计的短语出现次数，只需判断是否存在时传 1
+    :param hydrate: 是否读取标题/URL/正文，False 时只返回文档ID和打分数据（见 result_fields）
     :return: 查询结果列表或错误信息
     """
     load_content_caches()
@@ -213,75 +541,57 @@ def phrase_search(query):
     if len(query_terms) < 2:
         return {"message": "Phrase search requires at least two non-stop words."}
     
-    doc_scores = {}
-    found_terms = []
-    
-    # 首先找到包含所有查询词的文档
-    for term in query_terms:
-        first_char = term[0]
-        load_inverted_index_caches(first_char)
-        if term in _inverted_index_caches[first_char]:
-            found_terms.append(term)
-            results = _inverted_index_caches[first_char][term]
-            for doc_id, data in results.items():
-                if doc_id not in doc_scores:
-                    doc_scores[doc_id] = {
-                        'total_tf': 0,
-                        'terms': {},
-                        'positions': {},
-                        'phrase_matches': 0
-                    }
-                doc_scores[doc_id]['total_tf'] += data['tf']
-                doc_scores[doc_id]['terms'][term] = data['tf']
-                doc_scores[doc_id]['positions'][term] = data['positions']
+    found_terms, postings_lists = lookup_terms(query_terms)
     
     if not found_terms:
         return {"message": f"None of the phrase terms were found in the index."}
     
-    # 检查词的位置是否相邻
-    filtered_docs = {}
-    for doc_id, score_data in doc_scores.items():
-        # 检查文档是否包含所有查询词
-        if len(score_data['positions']) == len(query_terms):
-            phrase_matches = find_phrase_matches(
-                query_terms, 
-                score_data['positions']
-            )
+    # 只有包含全部短语词的文档才需要检查位置
+    filtered_docs = []
+    if len(found_terms) == len(query_terms):
+        for doc_id, indices in intersect(postings_lists):
+            position_lists = [
+                postings.positions(i) for postings, i in zip(postings_lists, indices)
+            ]
+            phrase_matches = count_phrase_matches(position_lists, limit=max_matches)
             if phrase_matches > 0:
-                score_data['phrase_matches'] = phrase_matches
-                filtered_docs[doc_id] = score_data
+                filtered_docs.append((doc_id, indices, position_lists, phrase_matches))
 
     if not filtered_docs:
         return {"message": f"The phrase '{query}' was not found in any document."}
 
     output = []
-    for doc_id, score_data in sorted(
-        filtered_docs.items(), 
-        key=lambda x: x[1]['phrase_matches'], 
+    fields = result_fields(hydrate)
+    for doc_id, indices, position_lists, phrase_matches in sorted(
+        filtered_docs, 
+        key=lambda x: x[3], 
         reverse=True
     ):
-        document = _content_cache.get(doc_id)
+        document = get_document(doc_id, fields)
         if document:
+            terms = {}
+            positions = {}
+            for postings, i, term_positions in zip(postings_lists, indices, position_lists):
+                terms[postings.term] = postings.tfs[i]
+                positions[postings.term] = term_positions
             output.append({
-                "doc_id": doc_id,
-                "title": document['title'],
-                "url": document['url'],
-                "content": document['content'],
-                "total_tf": score_data['total_tf'],
-                "term_frequencies": score_data['terms'],
-                "term_positions": score_data['positions'],
-                "phrase_matches": score_data['phrase_matches']
+                **document,
+                "total_tf": sum(postings.tfs[i] for postings, i in zip(postings_lists, indices)),
+                "term_frequencies": terms,
+                "term_positions": positions,
+                "phrase_matches": phrase_matches
             })
     
-    return {
+    return with_corpus_statistics({
         "results": output, 
         "found_terms": found_terms
-    }
+    }, postings_lists)
 
-def and_search(query):
+def and_search(query, hydrate=True):
     """
     与查询：查找同时包含所有查询词的文档
     :param query: 查询的关键词字符串，多个关键词用空格分隔
+    :param hydrate: 是否读取标题/URL/正文，False 时只返回文档ID和打分数据（见 result_fields）
     :return: 查询结果列表或错误信息
     """
     load_content_caches()
@@ -291,32 +601,10 @@ def and_search(query):
         return {"message": "No valid search terms after removing stop words."}
     
     if len(query_terms) == 1:
-        return or_search(" ".join(query_terms))
+        return or_search(" ".join(query_terms), top_k=None, hydrate=hydrate)
     
-    doc_scores = {}
-    found_terms = []
-    term_docs = {}  # 存储每个词出现的文档集合
-    
-    # 首先收集每个词出现的文档
-    for term in query_terms:
-        first_char = term[0]
-        load_inverted_index_caches(first_char)
-        if term in _inverted_index_caches[first_char]:
-            found_terms.append(term)
-            results = _inverted_index_caches[first_char][term]
-            term_docs[term] = set(results.keys())  # 该词出现的所有文档ID
-            
-            # 记录文档信息
-            for doc_id, data in results.items():
-                if doc_id not in doc_scores:
-                    doc_scores[doc_id] = {
-                        'total_tf': 0,
-                        'terms': {},
-                        'positions': {}
-                    }
-                doc_scores[doc_id]['total_tf'] += data['tf']
-                doc_scores[doc_id]['terms'][term] = data['tf']
-                doc_scores[doc_id]['positions'][term] = data['positions']
+    # 首先获取每个词的 postings（不展开成字典）
+    found_terms, postings_lists = lookup_terms(query_terms)
     
     if not found_terms:
         return {"message": f"None of the search terms were found in the index."}
@@ -325,69 +613,106 @@ def and_search(query):
         missing_terms = set(query_terms) - set(found_terms)
         return {"message": f"Some terms were not found: {', '.join(missing_terms)}"}
     
-    # 计算所有词共同出现的文档（求交集）
-    common_docs = set.intersection(*term_docs.values())
+    # 从最稀有的词开始跳跃求交集，只为交集中的文档收集 tf 和位置
+    common_docs = intersect(postings_lists)
     
     if not common_docs:
         return {"message": f"No documents contain all the terms: {', '.join(query_terms)}"}
     
-    # 只保留包含所有词的文档
-    filtered_scores = {
-        doc_id: score_data 
-        for doc_id, score_data in doc_scores.items() 
-        if doc_id in common_docs
-    }
+    scored_docs = []
+    for doc_id, indices in common_docs:
+        terms = {}
+        positions = {}
+        total_tf = 0
+        for postings, i in zip(postings_lists, indices):
+            total_tf += postings.tfs[i]
+            terms[postings.term] = postings.tfs[i]
+            positions[postings.term] = postings.positions(i)
+        scored_docs.append((doc_id, total_tf, terms, positions))
 
     output = []
-    for doc_id, score_data in sorted(
-        filtered_scores.items(), 
-        key=lambda x: x[1]['total_tf'], 
+    fields = result_fields(hydrate)
+    for doc_id, total_tf, terms, positions in sorted(
+        scored_docs, 
+        key=lambda x: x[1], 
         reverse=True
     ):
-        document = _content_cache.get(doc_id)
+        document = get_document(doc_id, fields)
         if document:
             output.append({
-                "doc_id": doc_id,
-                "title": document['title'],
-                "url": document['url'],
-                "content": document['content'],
-                "total_tf": score_data['total_tf'],
-                "term_frequencies": score_data['terms'],
-                "term_positions": score_data['positions']
+                **document,
+                "total_tf": total_tf,
+                "term_frequencies": terms,
+                "term_positions": positions
             })
     
-    return {
+    return with_corpus_statistics({
         "results": output, 
         "found_terms": found_terms
-    }
+    }, postings_lists)
+
+def boolean_search(tree, hydrate=True):
+    """
+    任意嵌套的布尔查询（AND / OR / NOT / 短语），语法树由 boolean_query.parse_expression 生成
+    所有词的 postings 一次取回，再按估计的文档数安排求值顺序，NOT 作为集合差执行
+    :param tree: 布尔查询语法树
+    :param hydrate: 是否读取标题/URL/正文，False 时只返回文档ID和打分数据（见 result_fields）
+    :return: 查询结果列表或错误信息
+    """
+    load_content_caches()
+    analyzed = {word: process_query(word) for word in all_words(tree)}
+    query_terms = []
+    for terms in analyzed.values():
+        query_terms.extend(term for term in terms if term not in query_terms)
+
+    found_terms, postings_lists = lookup_terms(query_terms)
+    postings = dict(zip(found_terms, postings_lists))
+    plan = plan_query(tree, analyzed.__getitem__, postings)
+    if plan is None:
+        return {"message": "No valid search terms after removing stop words."}
+
+    # 打分只使用正子句中的词，被 NOT 排除的词不参与
+    scoring_terms = []
+    for word in positive_words(tree):
+        scoring_terms.extend(term for term in analyzed[word] if term in postings and term not in scoring_terms)
+    scoring_postings = [postings[term] for term in scoring_terms]
+
+    output = []
+    fields = result_fields(hydrate)
+    for doc_id in execute_plan(plan):
+        document = get_document(doc_id, fields)
+        if document:
+            total_tf, terms, positions = collect_term_data(doc_id, scoring_postings)
+            output.append({
+                **document,
+                "total_tf": total_tf,
+                "term_frequencies": terms,
+                "term_positions": positions
+            })
+
+    if not output:
+        return {"message": f"No documents match the query: {to_expression(tree)}"}
+
+    output.sort(key=lambda doc: doc["total_tf"], reverse=True)
+    return with_corpus_statistics({
+        "results": output,
+        "found_terms": scoring_terms
+    }, scoring_postings)
 
-def find_phrase_matches(query_terms, positions):
+def find_phrase_matches(query_terms, positions, limit=None):
     """
     查找短语匹配的次数
     :param query_terms: 查询词列表
     :param positions: 每个词的位置字典
+    :param limit: 找到这么多次匹配后提前结束
     :return: 匹配的次数
     """
     if not query_terms or not positions:
         return 0
+    if any(term not in positions for term in query_terms):
+        return 0
     
-    # 获取第一个词的所有位置
-    matches = 0
-    first_positions = positions[query_terms[0]]
-    
-    # 对于第一个词的每个位置，检查是否存在连续的短语
-    for pos in first_positions:
-        is_match = True
-        for i, term in enumerate(query_terms[1:], 1):
-            # 检查下一个词是否在预期位置
-            expected_pos = pos + i
-            if term not in positions or expected_pos not in positions[term]:
-                is_match = False
-                break
-        if is_match:
-            matches += 1
-    
-    return matches
+    return count_phrase_matches([positions[term] for term in query_terms], limit=limit)
 
 def test_search():
     """
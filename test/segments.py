@@ -0,0 +1,542 @@
+'''
+LSM 式的分段增量索引：新增/更新/删除文档不需要重新全量构建
+
+cache/segments/ 目录结构：
+    manifest.json   {"generation", "next_seq", "segments": [{"name", "seq", "docs"}], "tombstones": {doc_id: seq}}
+    seg_<n>/        一个不可变的段：index.bin（二进制倒排索引）、content.{offsets,records}（文档存储）、
+                    corpus_stats.json / doc_lengths.sparse（语料统计量）；文档存储的偏移表和文档长度表
+                    都是按 doc_id 排序的稀疏表，段的大小只与其中的文档数有关
+    .lock           写操作（新增、删除、合并）之间的文件锁
+
+    - 每批新文档写成一个新段，序号 seq 递增；create_ii.py 构建的基础索引视为 seq = 0 的段
+    - 墓碑 tombstones[doc_id] = t 表示 seq < t 的段中该文档的副本已失效：
+      更新文档时 t 为新段的 seq（旧副本失效），删除文档时 t 大于现有的全部 seq；
+      只有基础索引或更早的段中确实有该文档的副本时才记录（全新的文档没有墓碑）
+    - 查询时合并基础索引和所有段的 postings，过滤掉失效的副本
+    - manifest 通过临时文件 + os.replace 原子替换，读取方（包括 fork 出的其他工作进程）
+      每隔 REFRESH_INTERVAL 秒检查一次 manifest 是否变化
+    - 后台合并按段的大小分层：同一层的段达到 MERGE_FACTOR 个时合并成一个更大的段，
+      合并时直接丢弃失效的副本，更早的副本都已丢弃的墓碑随之删除
+    - 基础索引的文档存储位于段目录的上一级（cache/content.*），用来判断文档是否在基础索引中；
+      没有文档存储（旧的 pickle 缓存）时无法判断，视为所有文档都在基础索引中
+
+用法：
+    python segments.py add new_docs.json     新增/更新文档（JSON 数组，包含 doc_id/title/url/content）
+    python segments.py delete 12 34          删除文档
+    python segments.py merge [--all]         按分层策略合并一次（--all 合并全部段）
+    python segments.py status
+'''
+
+import argparse
+import fcntl
+import heapq
+import json
+import math
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from itertools import groupby
+
+from binary_index import write_index, PostingsShard, TermPostings
+from doc_store import build_doc_store, store_exists, DocStore
+from corpus_stats import save_corpus_stats, load_corpus_stats, CorpusStats
+
+SEGMENTS_DIR = "segments"
+MANIFEST_FILE = "manifest.json"
+LOCK_FILE = ".lock"
+INDEX_FILE = "index.bin"
+CONTENT_PREFIX = "content"
+
+# 基础索引（全量构建的分片）的序号
+BASE_SEQ = 0
+# 同一层的段达到这个数量时合并
+MERGE_FACTOR = 4
+# 第 0 层段的文档数上限，之后每层乘以 MERGE_FACTOR
+TIER_BASE_DOCS = 1000
+# 读取方检查 manifest 变化的最短间隔（秒）
+REFRESH_INTERVAL = 1.0
+# 后台合并的检查间隔（秒）
+MERGE_INTERVAL = 30
+
+
+def manifest_path(directory):
+    return os.path.join(directory, MANIFEST_FILE)
+
+
+def read_manifest(directory):
+    try:
+        with open(manifest_path(directory), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"generation": 0, "next_seq": BASE_SEQ + 1, "segments": [], "tombstones": {}}
+
+
+def write_manifest(directory, manifest):
+    path = manifest_path(directory)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(path + ".tmp", path)
+
+
+@contextmanager
+def writer_lock(directory, blocking=True):
+    """
+    写操作之间互斥（跨进程），blocking 为 False 且锁被占用时产出 False
+    """
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, LOCK_FILE), "a") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class Segment:
+    """一个已经写好的只读段"""
+
+    def __init__(self, directory, name, seq):
+        self.name = name
+        self.seq = seq
+        self.directory = os.path.join(directory, name)
+        self.index = PostingsShard(os.path.join(self.directory, INDEX_FILE))
+        self.store = DocStore(os.path.join(self.directory, CONTENT_PREFIX))
+        self.stats = load_corpus_stats(self.directory)
+
+
+class _PositionsView:
+    """合并后的 postings 中按需解码的位置列表，第 k 个元素来自某个源 postings 的第 i 项"""
+    __slots__ = ("refs",)
+
+    def __init__(self, refs):
+        self.refs = refs
+
+    def __getitem__(self, k):
+        postings, i = self.refs[k]
+        return postings.positions(i)
+
+    def __len__(self):
+        return len(self.refs)
+
+
+def write_segment(path, postings, documents, doc_lengths):
+    """
+    写出一个段目录（先写临时目录再重命名，读取方不会看到写了一半的段）
+    :param postings: 按词字典序排列的 (term, {doc_id: {"tf", "positions"}}) 迭代器
+    :param documents: 包含 token_offsets 的文档迭代器
+    :param doc_lengths: {doc_id: 文档长度}，在 postings 和 documents 都被消费后才读取
+    """
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    count = build_doc_store(documents, os.path.join(tmp_path, CONTENT_PREFIX), sparse=True)
+    write_index(os.path.join(tmp_path, INDEX_FILE), postings)
+    save_corpus_stats(doc_lengths, tmp_path, sparse=True)
+    # 写入后、提交 manifest 前中断时会留下同名的目录，它不在 manifest 中，可以直接覆盖
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+    return count
+
+
+def open_base_store(directory):
+    """打开基础索引的文档存储（段目录的上一级），不存在时返回 None"""
+    prefix = os.path.join(os.path.dirname(os.path.abspath(directory)), CONTENT_PREFIX)
+    return DocStore(prefix) if store_exists(prefix) else None
+
+
+@contextmanager
+def copy_locator(directory, entries):
+    """
+    :param entries: manifest 中的段
+    :return: has_copy(doc_id, before=None)，基础索引或 entries 中 seq < before 的段是否有该文档的副本（不论是否已失效）
+    """
+    base = open_base_store(directory)
+    stores = [(entry["seq"], DocStore(os.path.join(directory, entry["name"], CONTENT_PREFIX))) for entry in entries]
+
+    def has_copy(doc_id, before=None):
+        if base is None or doc_id in base:
+            return True
+        return any(doc_id in store for seq, store in stores if before is None or seq < before)
+
+    try:
+        yield has_copy
+    finally:
+        for _, store in stores:
+            store.close()
+        if base is not None:
+            base.close()
+
+
+def add_documents(directory, docs):
+    """
+    把一批文档写成一个新段；doc_id 已存在时新段中的版本生效
+    :return: 新段的名称，docs 为空时返回 None
+    """
+    # text_analysis 在导入时读取 NLTK 停用词，调用时再导入
+    from text_analysis import analyze_text
+
+    inverted = {}
+    doc_lengths = {}
+    documents = []
+    for doc in docs:
+        doc_id = int(doc["doc_id"])
+        words, offsets = analyze_text(doc.get("content") or "", with_offsets=True)
+        doc_lengths[doc_id] = len(words)
+        for position, word in enumerate(words, start=1):
+            entry = inverted.setdefault(word, {}).setdefault(doc_id, {"tf": 0, "positions": []})
+            entry["tf"] += 1
+            entry["positions"].append(position)
+        documents.append({**doc, "token_offsets": offsets})
+    if not documents:
+        return None
+
+    with writer_lock(directory):
+        manifest = read_manifest(directory)
+        seq = manifest["next_seq"]
+        name = f"seg_{manifest['generation'] + 1:08d}"
+        terms = sorted(inverted, key=lambda t: t.encode("utf-8"))
+        write_segment(
+            os.path.join(directory, name),
+            ((term, inverted[term]) for term in terms),
+            documents,
+            doc_lengths,
+        )
+        with copy_locator(directory, manifest["segments"]) as has_copy:
+            for doc_id in doc_lengths:
+                # 更早的段（以及基础索引）中的旧版本失效；全新的文档不需要墓碑
+                if has_copy(doc_id):
+                    manifest["tombstones"][str(doc_id)] = seq
+        manifest["segments"].append({"name": name, "seq": seq, "docs": len(documents)})
+        manifest["next_seq"] = seq + 1
+        manifest["generation"] += 1
+        write_manifest(directory, manifest)
+    print(f"新段 {name}: {len(documents)} 篇文档, {len(terms)} 个词")
+    return name
+
+
+def delete_documents(directory, doc_ids):
+    """删除文档：记录墓碑，合并时才真正丢弃"""
+    with writer_lock(directory):
+        manifest = read_manifest(directory)
+        # 大于现有全部段的序号，所有副本都失效
+        seq = manifest["next_seq"]
+        deleted = 0
+        with copy_locator(directory, manifest["segments"]) as has_copy:
+            for doc_id in doc_ids:
+                # 不存在的文档不需要墓碑
+                if has_copy(int(doc_id)):
+                    manifest["tombstones"][str(int(doc_id))] = seq
+                    deleted += 1
+        manifest["next_seq"] = seq + 1
+        manifest["generation"] += 1
+        write_manifest(directory, manifest)
+    print(f"已删除 {deleted} 篇文档")
+
+
+def segment_tier(docs):
+    if docs < TIER_BASE_DOCS:
+        return 0
+    return int(math.log(docs / TIER_BASE_DOCS, MERGE_FACTOR)) + 1
+
+
+def pick_merge(manifest):
+    """分层合并策略：返回最低的、段数达到 MERGE_FACTOR 的层中最旧的 MERGE_FACTOR 个段"""
+    tiers = {}
+    for entry in sorted(manifest["segments"], key=lambda e: e["seq"]):
+        tiers.setdefault(segment_tier(entry["docs"]), []).append(entry)
+    for tier in sorted(tiers):
+        if len(tiers[tier]) >= MERGE_FACTOR:
+            return tiers[tier][:MERGE_FACTOR]
+    return []
+
+
+def _tagged_postings(segment):
+    for term, postings in segment.index.iter_postings():
+        yield term, segment, postings
+
+
+def _merged_postings(segments, tombstones):
+    """按词合并多个段的 postings，只保留仍然有效的副本"""
+    streams = heapq.merge(
+        *(_tagged_postings(segment) for segment in segments),
+        key=lambda item: item[0].encode("utf-8")
+    )
+    for term, group in groupby(streams, key=lambda item: item[0]):
+        mapping = {}
+        for _, segment, postings in group:
+            for i, doc_id in enumerate(postings.doc_ids):
+                if tombstones.get(str(doc_id), -1) <= segment.seq:
+                    mapping[doc_id] = {"tf": postings.tfs[i], "positions": postings.positions(i)}
+        if mapping:
+            yield term, mapping
+
+
+def merge_segments(directory, merge_all=False, blocking=True):
+    """
+    执行一次合并
+    :param merge_all: 合并全部段，否则按分层策略挑选
+    :param blocking: 为 False 时如果其他进程正在写入则直接返回
+    :return: 合并出的新段名称，没有需要合并的段时返回 None
+    """
+    with writer_lock(directory, blocking) as locked:
+        if not locked:
+            return None
+        manifest = read_manifest(directory)
+        entries = manifest["segments"] if merge_all else pick_merge(manifest)
+        if len(entries) < 2:
+            return None
+        start = time.time()
+        tombstones = manifest["tombstones"]
+        segments = [Segment(directory, entry["name"], entry["seq"]) for entry in entries]
+        seq = max(segment.seq for segment in segments)
+        name = f"seg_{manifest['generation'] + 1:08d}"
+
+        doc_lengths = {}
+        merged_docs = set()
+
+        def live_documents():
+            for segment in segments:
+                for doc_id in segment.store.doc_ids():
+                    merged_docs.add(doc_id)
+                    if tombstones.get(str(doc_id), -1) <= segment.seq:
+                        document = segment.store.get(doc_id)
+                        document["token_offsets"] = segment.store.token_offsets(doc_id)
+                        doc_lengths[doc_id] = segment.stats.doc_length(doc_id) if segment.stats else 0
+                        yield document
+
+        count = write_segment(
+            os.path.join(directory, name), _merged_postings(segments, tombstones), live_documents(), doc_lengths
+        )
+        merged_names = {entry["name"] for entry in entries}
+        manifest["segments"] = [entry for entry in manifest["segments"] if entry["name"] not in merged_names]
+        # 失效副本已经丢弃：基础索引和剩下的段中都没有更早副本的墓碑不再需要
+        # （合并出的段 seq 不小于其中任何有效副本原来的 seq，不会被这些墓碑覆盖）
+        with copy_locator(directory, manifest["segments"]) as has_copy:
+            pruned = [
+                doc_id for doc_id in merged_docs
+                if str(doc_id) in tombstones and not has_copy(doc_id, before=tombstones[str(doc_id)])
+            ]
+        for doc_id in pruned:
+            del tombstones[str(doc_id)]
+        manifest["segments"].append({"name": name, "seq": seq, "docs": count})
+        manifest["generation"] += 1
+        write_manifest(directory, manifest)
+
+        # 其他进程可能仍然映射着旧段的文件，删除目录不影响已经打开的映射
+        for segment in segments:
+            segment.index.close()
+            segment.store.close()
+            shutil.rmtree(segment.directory, ignore_errors=True)
+    print(f"合并 {len(entries)} 个段 -> {name}: {count} 篇文档，删除 {len(pruned)} 个墓碑，用时 {time.time() - start:.2f} 秒")
+    return name
+
+
+class SegmentIndex:
+    """
+    查询方使用的段视图：合并各段的 postings、定位文档、汇总语料统计量
+    manifest 变化后自动重新加载（最多每 refresh_interval 秒检查一次）
+    """
+
+    def __init__(self, directory, refresh_interval=REFRESH_INTERVAL):
+        self.directory = directory
+        self.refresh_interval = refresh_interval
+        self._segments = []  # 按 seq 从新到旧
+        self._tombstones = {}
+        self.generation = None
+        self._manifest_mtime = None
+        self._checked_at = 0.0
+        self._stats_cache = (None, None)
+        self._lock = threading.Lock()
+        self.refresh(force=True)
+
+    def refresh(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._checked_at < self.refresh_interval:
+            return
+        self._checked_at = now
+        try:
+            mtime = os.stat(manifest_path(self.directory)).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._manifest_mtime and not force:
+            return
+        with self._lock:
+            manifest = read_manifest(self.directory)
+            opened = {segment.name: segment for segment in self._segments}
+            try:
+                segments = [
+                    opened.get(entry["name"]) or Segment(self.directory, entry["name"], entry["seq"])
+                    for entry in sorted(manifest["segments"], key=lambda e: e["seq"], reverse=True)
+                ]
+            except (FileNotFoundError, ValueError) as e:
+                # manifest 读取之后段又被合并删除了，下次检查时重试
+                print(f"加载段失败，稍后重试: {e}")
+                return
+            # 不再使用的旧段不主动关闭：正在执行的查询可能还在读取，引用释放后自动关闭映射
+            self._segments = segments
+            self._tombstones = {int(doc_id): seq for doc_id, seq in manifest["tombstones"].items()}
+            self.generation = manifest["generation"]
+            self._manifest_mtime = mtime
+            if segments or self._tombstones:
+                print(f"段索引第 {self.generation} 代: {len(segments)} 个段, {len(self._tombstones)} 个墓碑")
+
+    @property
+    def active(self):
+        return bool(self._segments or self._tombstones)
+
+    def _live(self, doc_id, seq):
+        return self._tombstones.get(doc_id, -1) <= seq
+
+    def merge_postings(self, term, base=None):
+        """
+        合并基础索引和各段中词的 postings
+        :param base: 基础索引中的 TermPostings（没有时为 None）
+        :return: 只包含有效副本的 TermPostings，词不存在时返回 None
+        """
+        self.refresh()
+        segments, tombstones = self._segments, self._tombstones
+        if not segments and not tombstones:
+            return base
+        sources = [(segment.seq, segment.index.get_postings(term)) for segment in segments]
+        sources.append((BASE_SEQ, base))
+        refs = []
+        for seq, postings in sources:
+            if postings is None:
+                continue
+            for i, doc_id in enumerate(postings.doc_ids):
+                if tombstones.get(doc_id, -1) <= seq:
+                    refs.append((doc_id, postings, i))
+        if not refs:
+            return None
+        # 每篇文档只有一个有效副本，按 doc_id 排序即可
+        refs.sort(key=lambda ref: ref[0])
+        return TermPostings(
+            term,
+            [doc_id for doc_id, _, _ in refs],
+            [postings.tfs[i] for _, postings, i in refs],
+            positions=_PositionsView([(postings, i) for _, postings, i in refs]),
+        )
+
+    def segment_of(self, doc_id):
+        """返回包含文档有效副本的段，文档在基础索引中或不存在时返回 None"""
+        self.refresh()
+        doc_id = int(doc_id)
+        for segment in self._segments:
+            if doc_id in segment.store and self._live(doc_id, segment.seq):
+                return segment
+        return None
+
+    def base_live(self, doc_id):
+        """基础索引中的副本是否仍然有效"""
+        return self._live(int(doc_id), BASE_SEQ)
+
+    def corpus_stats(self, base):
+        """
+        合并基础索引和各段的语料统计量（按 manifest 的代数缓存）
+        :param base: 基础索引的 CorpusStats，可以为 None
+        """
+        self.refresh()
+        if not self.active:
+            return base
+        key = (self.generation, id(base))
+        if self._stats_cache[0] == key:
+            return self._stats_cache[1]
+        stats = MergedCorpusStats(base, self._segments, self._tombstones)
+        self._stats_cache = (key, stats)
+        return stats
+
+
+class MergedCorpusStats(CorpusStats):
+    """
+    基础索引和各段合并后的语料统计量
+    N 和总词数由各部分的元数据相加，再减去墓碑对应的失效副本，计算量与墓碑数成正比，
+    而不是与最大的 doc_id 成正比；文档长度按需从新到旧查找有效副本所在的表
+    """
+
+    def __init__(self, base, segments, tombstones):
+        self._base = base
+        self._segments = segments  # 按 seq 从新到旧
+        self._tombstones = tombstones
+        parts = [(BASE_SEQ, base)] + [(segment.seq, segment.stats) for segment in segments]
+        parts = [(seq, stats) for seq, stats in parts if stats is not None]
+        n_docs = sum(stats.n_docs for _, stats in parts)
+        total_terms = sum(stats.total_terms for _, stats in parts)
+        for doc_id, tombstone in tombstones.items():
+            for seq, stats in parts:
+                if seq < tombstone and doc_id in stats:
+                    n_docs -= 1
+                    total_terms -= stats.doc_length(doc_id)
+        super().__init__(n_docs, total_terms / n_docs if n_docs else 0.0, None, total_terms)
+
+    def doc_length(self, doc_id):
+        doc_id = int(doc_id)
+        # 全新的文档只在段中，没有墓碑，所以先查各段（每段一次二分查找）
+        tombstone = self._tombstones.get(doc_id, -1)
+        for segment in self._segments:
+            if segment.seq < tombstone:
+                return 0
+            if segment.stats is not None and doc_id in segment.stats:
+                return segment.stats.doc_length(doc_id)
+        if tombstone > BASE_SEQ or self._base is None:
+            return 0
+        return self._base.doc_length(doc_id)
+
+    def __contains__(self, doc_id):
+        return self.doc_length(doc_id) > 0
+
+
+class BackgroundMerger(threading.Thread):
+    """
+    后台定期按分层策略合并段；多个工作进程同时运行时，通过文件锁保证同一时间只有一个在合并
+    """
+
+    def __init__(self, directory, interval=MERGE_INTERVAL):
+        super().__init__(daemon=True, name="segment-merger")
+        self.directory = directory
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                while merge_segments(self.directory, blocking=False):
+                    pass
+            except Exception as e:
+                print(f"后台合并出错: {e}")
+
+    def stop(self):
+        self._stop_event.set()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="分段增量索引")
+    parser.add_argument("--dir", default=os.path.join("cache", SEGMENTS_DIR), help="段目录")
+    commands = parser.add_subparsers(dest="command", required=True)
+    add_parser = commands.add_parser("add", help="新增/更新文档")
+    add_parser.add_argument("json_file")
+    delete_parser = commands.add_parser("delete", help="删除文档")
+    delete_parser.add_argument("doc_ids", nargs="+", type=int)
+    merge_parser = commands.add_parser("merge", help="合并段")
+    merge_parser.add_argument("--all", action="store_true")
+    commands.add_parser("status", help="查看段和墓碑")
+    args = parser.parse_args()
+
+    if args.command == "add":
+        with open(args.json_file, "r", encoding="utf-8") as f:
+            add_documents(args.dir, json.load(f))
+    elif args.command == "delete":
+        delete_documents(args.dir, args.doc_ids)
+    elif args.command == "merge":
+        if not merge_segments(args.dir, merge_all=args.all):
+            print("没有需要合并的段")
+    else:
+        manifest = read_manifest(args.dir)
+        print(f"第 {manifest['generation']} 代, {len(manifest['tombstones'])} 个墓碑")
+        for entry in sorted(manifest["segments"], key=lambda e: e["seq"]):
+            print(f"  {entry['name']}: seq={entry['seq']}, {entry['docs']} 篇文档, 第 {segment_tier(entry['docs'])} 层")
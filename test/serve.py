@@ -0,0 +1,161 @@
+'''
+预加载后 fork 的多进程服务：python serve.py [--workers N] [--port 8080]
+
+uvicorn --workers 会让每个工作进程各自导入应用、各自加载索引，内存随进程数成倍增长。
+这里由父进程先预热（并行加载或 mmap 全部索引，见 warmup.py），执行 gc.freeze() 把这些对象移出 GC 的扫描范围，
+再绑定监听端口并 fork 出 N 个工作进程共享同一个 socket：
+    - 二进制分片、文档存储是 mmap 的只读文件页，所有进程共享同一份物理内存
+    - pickle 缓存等 Python 对象通过写时复制共享；冻结后 GC 不会再写它们的对象头，
+      避免回收时把整页复制到每个子进程
+工作进程异常退出时由父进程重新 fork：启动后很快就退出的进程按指数退避延迟重启，
+RESTART_WINDOW 秒内重启超过 --max-restarts 次时停止所有工作进程，父进程以非零状态退出。
+
+fork 模式下建议使用线程执行器（SEARCH_EXECUTOR=thread，默认），
+进程执行器会在每个工作进程中再 spawn 出各自重新加载索引的进程。
+'''
+
+import argparse
+import gc
+import os
+import signal
+import socket
+import sys
+import time
+from collections import deque
+
+import uvicorn
+
+from main import app, warmup, suggestion_engine
+
+# 运行不到这么多秒就退出的工作进程视为启动失败，重启前按指数退避等待
+MIN_UPTIME = 10.0
+RESTART_DELAY = 0.5
+MAX_RESTART_DELAY = 30.0
+# 统计重启次数的时间窗口（秒）
+RESTART_WINDOW = 60.0
+MAX_RESTARTS = 10
+
+
+def bind_socket(host, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(sock):
+    """工作进程：在继承的 socket 上运行 uvicorn，不再加载任何索引"""
+    # 父进程的信号处理不适用于工作进程，交给 uvicorn 重新安装
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    server = uvicorn.Server(uvicorn.Config(app, log_level="info"))
+    server.run(sockets=[sock])
+
+
+def spawn_worker(sock):
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            run_worker(sock)
+        except Exception as e:
+            print(f"工作进程 {os.getpid()} 出错: {e}")
+            code = 1
+        finally:
+            os._exit(code)
+    print(f"启动工作进程 {pid}")
+    return pid
+
+
+def wait_unless_stopping(seconds, stopping):
+    """分小段睡眠，收到停止信号后立即返回"""
+    deadline = time.monotonic() + seconds
+    while not stopping() and time.monotonic() < deadline:
+        time.sleep(min(0.1, deadline - time.monotonic()))
+
+
+def serve(host, port, workers, max_restarts=MAX_RESTARTS):
+    """:return: 进程退出状态，工作进程反复退出、超过重启次数上限时为 1"""
+    print("父进程预加载索引...")
+    start = time.time()
+    # 在 fork 之前同步完成预热，工作进程继承已加载的索引和就绪状态
+    warmup.run()
+    # 查询建议的词表同样在 fork 之前构建，工作进程中的后台线程只负责定期刷新
+    suggestion_engine.build()
+    # 预加载产生的对象全部移入永久代，之后的 GC 不再遍历/修改它们
+    gc.collect()
+    gc.freeze()
+    print(f"预加载用时 {time.time() - start:.2f} 秒，冻结对象 {gc.get_freeze_count()} 个")
+
+    sock = bind_socket(host, port)
+    print(f"\n服务器启动在端口 {port}，{workers} 个工作进程")
+    print(f"请访问: http://localhost:{port}")
+
+    children = {}  # pid -> 启动时间
+    stopping = False
+    restarts = deque()  # 最近 RESTART_WINDOW 秒内的重启时间
+    failures = 0  # 连续启动失败的次数，决定退避时间
+    exit_code = 0
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(workers):
+        children[spawn_worker(sock)] = time.monotonic()
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        started = children.pop(pid, None)
+        if stopping:
+            continue
+        now = time.monotonic()
+        while restarts and now - restarts[0] > RESTART_WINDOW:
+            restarts.popleft()
+        if len(restarts) >= max_restarts:
+            print(f"工作进程 {pid} 退出（状态 {status}），{RESTART_WINDOW:.0f} 秒内已重启 {len(restarts)} 次，停止服务")
+            exit_code = 1
+            stop(None, None)
+            continue
+        if started is not None and now - started < MIN_UPTIME:
+            delay = min(RESTART_DELAY * 2 ** failures, MAX_RESTART_DELAY)
+            failures += 1
+        else:
+            delay = 0
+            failures = 0
+        print(f"工作进程 {pid} 退出（状态 {status}），{delay:.1f} 秒后重新启动")
+        wait_unless_stopping(delay, lambda: stopping)
+        if stopping:
+            continue
+        restarts.append(time.monotonic())
+        children[spawn_worker(sock)] = time.monotonic()
+    sock.close()
+    return exit_code
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="预加载索引后 fork 多个工作进程提供服务")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--max-restarts", type=int, default=MAX_RESTARTS,
+                        help=f"{RESTART_WINDOW:.0f} 秒内最多重启工作进程的次数，超过时以非零状态退出")
+    args = parser.parse_args()
+    if not hasattr(os, "fork"):
+        sys.exit("预加载 fork 模式需要支持 fork 的系统，请直接运行 main.py")
+    sys.exit(serve(args.host, args.port, args.workers, args.max_restarts))
@@ -0,0 +1,185 @@
+'''
+倒排索引分片缓存：按内存预算保留已加载的分片
+    - 已加载分片估算大小之和超过 max_bytes 时按 LRU（最久未使用）或 LFU（命中最少）淘汰
+    - 同一分片的并发未命中只触发一次加载（single-flight），其余请求等待这次加载的结果；
+      加载失败时等待者一起收到异常，下一次请求重新加载
+    - 按分片记录估算内存、命中、未命中、加载次数/耗时和淘汰次数
+
+被淘汰的分片只是从缓存中移除，不主动关闭：正在使用它的查询持有引用，引用释放后由垃圾回收释放内存和 mmap。
+刚加载的分片不会被立即淘汰，单个分片超过预算时缓存中只保留它一个。
+'''
+
+import threading
+import time
+from collections import OrderedDict
+
+POLICIES = ("lru", "lfu")
+
+
+class _Flight:
+    """一次进行中的加载，等待者在 done 上阻塞"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class _ShardStats:
+    def __init__(self):
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.load_seconds = 0.0
+        self.evictions = 0
+
+    def as_dict(self, resident):
+        total = self.hits + self.misses
+        return {
+            "resident": resident,
+            "bytes": self.bytes if resident else 0,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "loads": self.loads,
+            "load_seconds": round(self.load_seconds, 3),
+            "evictions": self.evictions,
+        }
+
+
+class ShardCache:
+    """
+    线程安全的分片缓存
+    :param loader: 分片名 -> 分片对象，在调用 get 的线程中执行（不持有缓存的锁）
+    :param size_fn: (分片名, 分片对象) -> 估算占用的字节数
+    :param max_bytes: 估算大小之和的上限，0 表示不限制
+    :param policy: "lru" 或 "lfu"
+    """
+
+    def __init__(self, loader, size_fn, max_bytes=0, policy="lru"):
+        if policy not in POLICIES:
+            raise ValueError(f"未知的淘汰策略: {policy}（可选 {', '.join(POLICIES)}）")
+        self.loader = loader
+        self.size_fn = size_fn
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self._entries = OrderedDict()  # shard -> (value, size)，按最近使用排序
+        self._flights = {}
+        self._stats = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _shard_stats(self, shard):
+        stats = self._stats.get(shard)
+        if stats is None:
+            stats = self._stats[shard] = _ShardStats()
+        return stats
+
+    def get(self, shard):
+        """返回分片，未加载时加载（并发请求同一分片时只加载一次）"""
+        with self._lock:
+            stats = self._shard_stats(shard)
+            entry = self._entries.get(shard)
+            if entry is not None:
+                self._entries.move_to_end(shard)
+                stats.hits += 1
+                return entry[0]
+            stats.misses += 1
+            flight = self._flights.get(shard)
+            leader = flight is None
+            if leader:
+                flight = self._flights[shard] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        started = time.perf_counter()
+        try:
+            value = self.loader(shard)
+            size = self.size_fn(shard, value)
+        except BaseException as e:
+            flight.error = e
+            with self._lock:
+                del self._flights[shard]
+            flight.done.set()
+            raise
+        flight.value = value
+        with self._lock:
+            del self._flights[shard]
+            stats.loads += 1
+            stats.load_seconds += time.perf_counter() - started
+            stats.bytes = size
+            self._entries[shard] = (value, size)
+            self._bytes += size
+            self._evict(keep=shard)
+        flight.done.set()
+        return value
+
+    def peek(self, shard):
+        """已加载时返回分片，否则返回 None；不加载，也不计入命中统计"""
+        with self._lock:
+            entry = self._entries.get(shard)
+            return entry[0] if entry is not None else None
+
+    def _victim(self, keep):
+        candidates = [shard for shard in self._entries if shard != keep]
+        if not candidates:
+            return None
+        if self.policy == "lfu":
+            # 命中次数相同时淘汰更久未使用的（OrderedDict 中靠前）
+            return min(candidates, key=lambda shard: self._stats[shard].hits)
+        return candidates[0]
+
+    def _evict(self, keep):
+        if not self.max_bytes:
+            return
+        while self._bytes > self.max_bytes:
+            shard = self._victim(keep)
+            if shard is None:
+                print(f"分片 {keep} 的估算大小超过分片缓存上限 {self.max_bytes} 字节")
+                return
+            _, size = self._entries.pop(shard)
+            self._bytes -= size
+            self._stats[shard].evictions += 1
+            print(f"分片缓存超出上限，淘汰分片 {shard}（{size} 字节）")
+
+    def evict(self, shard):
+        """从缓存中移除分片，下次使用时重新加载"""
+        with self._lock:
+            entry = self._entries.pop(shard, None)
+            if entry is not None:
+                self._bytes -= entry[1]
+                self._stats[shard].evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def resident(self):
+        with self._lock:
+            return list(self._entries)
+
+    def stats(self):
+        with self._lock:
+            hits = sum(stats.hits for stats in self._stats.values())
+            misses = sum(stats.misses for stats in self._stats.values())
+            return {
+                "policy": self.policy,
+                "max_bytes": self.max_bytes,
+                "bytes": self._bytes,
+                "resident_shards": len(self._entries),
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+                "loads": sum(stats.loads for stats in self._stats.values()),
+                "evictions": sum(stats.evictions for stats in self._stats.values()),
+                "shards": {
+                    shard: stats.as_dict(shard in self._entries)
+                    for shard, stats in sorted(self._stats.items())
+                },
+            }
@@ -0,0 +1,324 @@
+'''
+词到倒排索引分片的路由
+
+按首字符切分的 36 个分片大小极不均衡（"s"、"c" 远大于 "x"、"q" 和数字分片），
+加载时间和内存都被少数几个大分片决定。这里把路由抽象出来，并持久化在索引目录的 routing.json 中：
+    - first_char：原来的按首字符切分（没有 routing.json 时的默认值，兼容已有的分片和 MongoDB 集合）
+    - hash：crc32(term) % n，n 可配置，分片大小接近均匀
+    - range：按词的字典序切成 n 段，边界根据 postings 大小选取，使每个分片的字节数接近相等；
+      分片内的词依然连续，适合前缀扫描
+
+分片名同时用作文件名（inverted_index_<shard>.bin / .json）和 MongoDB 集合名（inverted_index_<shard>）。
+
+用法：
+    python shard_router.py report [cache]                          各分片的词数、postings 字节数和倾斜程度
+    python shard_router.py report [cache] --simulate hash --shards 64   估算换成另一种路由后的分布
+    python shard_router.py reshard cache new_cache --router range --shards 32
+'''
+
+import argparse
+import heapq
+import json
+import os
+import shutil
+import string
+import sys
+import zlib
+from bisect import bisect_right
+from itertools import groupby
+
+from binary_index import PostingsShard, IndexWriter, shard_file_name
+
+ROUTING_FILE = "routing.json"
+FIRST_CHAR_SHARDS = string.ascii_lowercase + string.digits
+
+
+class FirstCharRouter:
+    """按首字符路由，只有 a-z0-9 开头的词有分片"""
+    kind = "first_char"
+
+    def __init__(self, shards=FIRST_CHAR_SHARDS):
+        self._shards = list(shards)
+        self._known = set(self._shards)
+
+    def shards(self):
+        return list(self._shards)
+
+    def shard_of(self, term):
+        return term[0] if term and term[0] in self._known else None
+
+    def to_dict(self):
+        return {"type": self.kind, "shards": self._shards}
+
+
+class HashRouter:
+    """crc32(term) % n，与进程无关、结果稳定（不使用 Python 内置的 hash）"""
+    kind = "hash"
+
+    def __init__(self, n_shards):
+        self.n_shards = n_shards
+
+    def shards(self):
+        return [f"h{i:03d}" for i in range(self.n_shards)]
+
+    def shard_of(self, term):
+        return f"h{zlib.crc32(term.encode('utf-8')) % self.n_shards:03d}"
+
+    def to_dict(self):
+        return {"type": self.kind, "n_shards": self.n_shards}
+
+
+class RangeRouter:
+    """
+    按字典序区间路由
+    :param boundaries: 第 1..n-1 个分片的起始词（UTF-8 字节序升序），第 0 个分片从最小的词开始
+    """
+    kind = "range"
+
+    def __init__(self, boundaries):
+        self.boundaries = list(boundaries)
+        self._keys = [boundary.encode("utf-8") for boundary in self.boundaries]
+
+    def shards(self):
+        return [f"r{i:03d}" for i in range(len(self.boundaries) + 1)]
+
+    def shard_of(self, term):
+        return f"r{bisect_right(self._keys, term.encode('utf-8')):03d}"
+
+    def to_dict(self):
+        return {"type": self.kind, "boundaries": self.boundaries}
+
+    @classmethod
+    def balanced(cls, term_sizes, n_shards):
+        """
+        根据按字典序排列的 (term, 字节数) 选取边界，使各分片的字节数接近 总量 / n_shards
+        term_sizes 只遍历一次，可以是流式的；为了一次遍历，先收集累计字节数再切分
+        """
+        terms = []
+        cumulative = []
+        total = 0
+        for term, size in term_sizes:
+            total += size
+            terms.append(term)
+            cumulative.append(total)
+        boundaries = []
+        i = 0
+        for k in range(1, n_shards):
+            target = total * k / n_shards
+            while i < len(terms) and cumulative[i] <= target:
+                i += 1
+            # 词之后的第一个词作为下一个分片的起点，跳过重复的边界
+            if i + 1 < len(terms) and (not boundaries or terms[i + 1] > boundaries[-1]):
+                boundaries.append(terms[i + 1])
+        return cls(boundaries)
+
+
+def router_from_dict(data):
+    kind = data.get("type")
+    if kind == FirstCharRouter.kind:
+        return FirstCharRouter(data.get("shards", FIRST_CHAR_SHARDS))
+    if kind == HashRouter.kind:
+        return HashRouter(data["n_shards"])
+    if kind == RangeRouter.kind:
+        return RangeRouter(data["boundaries"])
+    raise ValueError(f"未知的分片路由类型: {kind}")
+
+
+def load_router(directory):
+    """读取索引目录中的路由表，没有 routing.json 时按首字符路由"""
+    path = os.path.join(directory, ROUTING_FILE)
+    if not os.path.exists(path):
+        return FirstCharRouter()
+    with open(path, "r", encoding="utf-8") as f:
+        return router_from_dict(json.load(f))
+
+
+def save_router(router, directory):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, ROUTING_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(router.to_dict(), f, ensure_ascii=False, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def make_router(kind, n_shards, term_sizes=None):
+    """
+    :param kind: first_char / hash / range
+    :param term_sizes: range 路由需要的按字典序排列的 (term, 字节数)
+    """
+    if kind == FirstCharRouter.kind:
+        return FirstCharRouter()
+    if kind == HashRouter.kind:
+        return HashRouter(n_shards)
+    if kind == RangeRouter.kind:
+        return RangeRouter.balanced(term_sizes or (), n_shards)
+    raise ValueError(f"未知的分片路由类型: {kind}")
+
+
+class ShardedIndexWriter:
+    """
+    把按字典序排列的词流分发到各分片的 IndexWriter（每个分片内依然有序）
+    不属于任何分片的词（first_char 路由下非 a-z0-9 开头的词）被跳过
+    """
+
+    def __init__(self, router, output_dir):
+        self.router = router
+        self.output_dir = output_dir
+        self.writers = {}
+        self.skipped = 0
+        os.makedirs(output_dir, exist_ok=True)
+
+    def add(self, term, postings):
+        shard = self.router.shard_of(term)
+        if shard is None:
+            self.skipped += 1
+            return None
+        writer = self.writers.get(shard)
+        if writer is None:
+            writer = self.writers[shard] = IndexWriter(os.path.join(self.output_dir, shard_file_name(shard)))
+        writer.add(term, postings)
+        return shard
+
+    def close(self):
+        """写完全部分片并保存路由表，返回 {分片名: 词数}"""
+        counts = {shard: writer.close() for shard, writer in self.writers.items()}
+        save_router(self.router, self.output_dir)
+        return counts
+
+    def abort(self):
+        for writer in self.writers.values():
+            writer.abort()
+        self.writers = {}
+
+
+def shard_paths(directory):
+    return sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if name.startswith("inverted_index_") and name.endswith(".bin")
+    )
+
+
+def merged_term_sizes(paths):
+    """按字典序合并多个分片的 (term, postings 字节数)"""
+    shards = [PostingsShard(path) for path in paths]
+    try:
+        streams = heapq.merge(*(shard.iter_term_sizes() for shard in shards), key=lambda item: item[0].encode("utf-8"))
+        for term, group in groupby(streams, key=lambda item: item[0]):
+            yield term, sum(size for _, size in group)
+    finally:
+        for shard in shards:
+            shard.close()
+
+
+def skew_report(shard_sizes):
+    """
+    :param shard_sizes: {分片名: (词数, postings 字节数)}
+    :return: 汇总统计：总量、平均、最大、最大/平均、最小
+    """
+    sizes = [size for _, size in shard_sizes.values()]
+    if not sizes:
+        return {"shards": 0}
+    mean = sum(sizes) / len(sizes)
+    largest = max(shard_sizes, key=lambda shard: shard_sizes[shard][1])
+    return {
+        "shards": len(sizes),
+        "total_bytes": sum(sizes),
+        "mean_bytes": mean,
+        "max_bytes": max(sizes),
+        "min_bytes": min(sizes),
+        "max_over_mean": max(sizes) / mean if mean else 0.0,
+        "largest_shard": largest,
+    }
+
+
+def print_report(shard_sizes, title):
+    print(f"\n{title}")
+    print(f"{'分片':<10}{'词数':>12}{'postings 字节数':>20}")
+    for shard in sorted(shard_sizes, key=lambda s: -shard_sizes[s][1]):
+        terms, size = shard_sizes[shard]
+        print(f"{shard:<10}{terms:>12}{size:>20}")
+    summary = skew_report(shard_sizes)
+    if summary["shards"]:
+        print(f"共 {summary['shards']} 个分片, {summary['total_bytes']} 字节, "
+              f"平均 {summary['mean_bytes']:.0f}, 最大 {summary['max_bytes']} ({summary['largest_shard']}), "
+              f"最小 {summary['min_bytes']}, 最大/平均 = {summary['max_over_mean']:.2f}")
+
+
+def current_distribution(directory):
+    result = {}
+    for path in shard_paths(directory):
+        shard = os.path.basename(path)[len("inverted_index_"):-len(".bin")]
+        index = PostingsShard(path)
+        try:
+            sizes = [size for _, size in index.iter_term_sizes()]
+        finally:
+            index.close()
+        result[shard] = (len(sizes), sum(sizes))
+    return result
+
+
+def simulated_distribution(directory, router):
+    result = {}
+    for term, size in merged_term_sizes(shard_paths(directory)):
+        shard = router.shard_of(term)
+        if shard is None:
+            continue
+        terms, total = result.get(shard, (0, 0))
+        result[shard] = (terms + 1, total + size)
+    return result
+
+
+def reshard(source_dir, output_dir, kind, n_shards):
+    """
+    把已有的分片按新的路由重新切分到 output_dir
+    对所有分片做一次 k 路归并，词流依然有序，逐个写入新分片
+    """
+    paths = shard_paths(source_dir)
+    router = make_router(kind, n_shards, merged_term_sizes(paths) if kind == RangeRouter.kind else None)
+    writer = ShardedIndexWriter(router, output_dir)
+    shards = [PostingsShard(path) for path in paths]
+    try:
+        streams = heapq.merge(*(shard.iter_postings() for shard in shards), key=lambda item: item[0].encode("utf-8"))
+        for term, group in groupby(streams, key=lambda item: item[0]):
+            mapping = {}
+            for _, postings in group:
+                mapping.update(postings.to_mapping())
+            writer.add(term, mapping)
+    finally:
+        for shard in shards:
+            shard.close()
+    counts = writer.close()
+    # 文档存储和语料统计量与分片方式无关，直接复制
+    for name in os.listdir(source_dir):
+        if name.startswith("content.") or name in ("corpus_stats.json", "doc_lengths.bin"):
+            shutil.copy2(os.path.join(source_dir, name), os.path.join(output_dir, name))
+    print(f"已按 {kind} 路由写出 {len(counts)} 个分片（{sum(counts.values())} 个词）到 {output_dir}")
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="倒排索引分片路由工具")
+    commands = parser.add_subparsers(dest="command", required=True)
+    report_parser = commands.add_parser("report", help="分片倾斜报告")
+    report_parser.add_argument("directory", nargs="?", default="cache")
+    report_parser.add_argument("--simulate", choices=["first_char", "hash", "range"], help="估算另一种路由下的分布")
+    report_parser.add_argument("--shards", type=int, default=36)
+    reshard_parser = commands.add_parser("reshard", help="按新的路由重新切分分片")
+    reshard_parser.add_argument("directory")
+    reshard_parser.add_argument("output_dir")
+    reshard_parser.add_argument("--router", choices=["first_char", "hash", "range"], default="range")
+    reshard_parser.add_argument("--shards", type=int, default=36)
+    args = parser.parse_args()
+
+    if args.command == "report":
+        router = load_router(args.directory)
+        print_report(current_distribution(args.directory), f"当前分布（{router.kind} 路由）")
+        if args.simulate:
+            paths = shard_paths(args.directory)
+            sizes = merged_term_sizes(paths) if args.simulate == RangeRouter.kind else None
+            candidate = make_router(args.simulate, args.shards, sizes)
+            print_report(simulated_distribution(args.directory, candidate), f"估算分布（{args.simulate} 路由）")
+    else:
+        if os.path.abspath(args.directory) == os.path.abspath(args.output_dir):
+            sys.exit("输出目录不能与输入目录相同")
+        reshard(args.directory, args.output_dir, args.router, args.shards)
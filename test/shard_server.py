@@ -0,0 +1,456 @@
+'''
+按词分区的分片服务器和查询协调器
+
+单个进程装不下全部倒排索引时，把分片（routing.json 中的分片名，见 shard_router.py）分配给多台分片服务器：
+    - 分片服务器只 mmap 自己负责的分片，通过 multiprocessing.connection（TCP + authkey）回答
+      "这些词的 postings"，postings 以索引文件中的压缩块原样返回，不在服务器端解码
+    - 协调器（search_func 所在的 Web 服务进程）把一个查询的所有词按所属服务器分组，
+      并行发出请求（scatter），在超时时间内收集结果（gather），解码后交给原有的查询求值和排序
+    - 超时或出错的服务器上的词按"不在索引中"处理，查询返回不完整的结果，且不写入结果缓存
+    - 建立连接（TCP 连接和认证握手）有单独的超时 SHARD_CONNECT_TIMEOUT，离线或不回应的主机不会让协调器的
+      线程卡在系统的 TCP 连接超时上；连接失败的服务器在 SHARD_RETRY_AFTER 秒内直接跳过，不再尝试连接
+
+按词分区时每个词的 postings 完整地位于一台服务器上，df、N、avgdl 与单机时相同，BM25 分数不变；
+文档存储和语料统计量仍由协调器读取。因此协调器合并的是各服务器返回的 postings，而不是各分片的 top-k 列表：
+一篇文档的得分由分布在不同服务器上的多个词共同决定，只有按文档分区时各分片的 top-k 才能直接合并。
+
+集群配置保存在 cluster.json：{"servers": [{"address": "host:port", "shards": ["a", "b", ...]}, ...]}
+服务进程读取 SHARD_CLUSTER 指定的文件（默认 cache/cluster.json），文件不存在时在本进程内加载全部分片。
+
+用法：
+    python shard_server.py plan cache 10.0.0.1:7101 10.0.0.2:7101   按分片大小把分片分配给各服务器，写出 cluster.json
+    python shard_server.py serve cache --server 0                    启动 cluster.json 中的第 0 台服务器
+    python shard_server.py local cache --servers 3                   在本机启动 3 台服务器并写出 cluster.json（测试用）
+    python shard_server.py status cache                              检查各服务器是否在线
+'''
+
+import argparse
+import ipaddress
+import itertools
+import json
+import os
+import queue
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor, wait
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Connection, answer_challenge, deliver_challenge
+
+from binary_index import PostingsShard, decode_postings, shard_file_name
+from shard_router import load_router
+
+CLUSTER_FILE = "cluster.json"
+# multiprocessing.connection 会反序列化（unpickle）收到的每条消息，知道 authkey 的人可以在对方主机上执行代码：
+# 只有在回环地址上才能使用内置的默认值，其它地址必须设置 SHARD_AUTHKEY
+DEFAULT_AUTHKEY = b"search-shards"
+# 一次 scatter-gather 的超时时间（秒），超时的服务器被跳过
+SHARD_TIMEOUT = float(os.environ.get("SHARD_TIMEOUT", 2.0))
+# 建立一条新连接（TCP 连接 + 认证握手）最多等待的秒数
+SHARD_CONNECT_TIMEOUT = float(os.environ.get("SHARD_CONNECT_TIMEOUT", 1.0))
+# 连接失败后多少秒内不再尝试连接这台服务器
+SHARD_RETRY_AFTER = float(os.environ.get("SHARD_RETRY_AFTER", 5.0))
+# 每台服务器保留的空闲连接数
+POOL_SIZE = 4
+
+
+class ShardUnavailable(Exception):
+    """分片服务器超时、出错或无法连接"""
+
+
+def parse_address(address):
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+def is_loopback(host):
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+
+def authkey_for(host):
+    """
+    连接或监听 host 时使用的 authkey
+    :raises ValueError: 非回环地址且没有设置 SHARD_AUTHKEY
+    """
+    authkey = os.environ.get("SHARD_AUTHKEY")
+    if authkey:
+        return authkey.encode("utf-8")
+    if is_loopback(host):
+        return DEFAULT_AUTHKEY
+    raise ValueError(f"{host} 不是回环地址，必须设置 SHARD_AUTHKEY（所有分片服务器和 Web 服务使用同一个随机值）")
+
+
+def load_cluster(path):
+    """读取集群配置，文件不存在时返回 None"""
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)["servers"]
+
+
+def save_cluster(servers, path):
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"servers": servers}, f, ensure_ascii=False, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def plan_cluster(directory, addresses):
+    """
+    把索引目录中的分片分配给各服务器：按文件大小从大到小，每次分给当前总量最小的服务器
+    :return: [{"address", "shards"}, ...]
+    """
+    router = load_router(directory)
+    sizes = {}
+    for shard in router.shards():
+        path = os.path.join(directory, shard_file_name(shard))
+        if os.path.exists(path):
+            sizes[shard] = os.path.getsize(path)
+    servers = [{"address": address, "shards": []} for address in addresses]
+    loads = [0] * len(servers)
+    for shard in sorted(sizes, key=lambda s: -sizes[s]):
+        target = loads.index(min(loads))
+        servers[target]["shards"].append(shard)
+        loads[target] += sizes[shard]
+    for server, load in zip(servers, loads):
+        server["shards"].sort()
+        print(f"{server['address']}: {len(server['shards'])} 个分片, {load / 2 ** 20:.1f} MB")
+    return servers
+
+
+class ShardServer:
+    """
+    为一部分分片提供 postings 查询
+    :param directory: 索引目录（包含分片文件和 routing.json）
+    :param shards: 本服务器负责的分片名
+    :param address: "host:port"，端口为 0 时由系统分配（见 self.address）
+    """
+
+    def __init__(self, directory, shards, address):
+        self.router = load_router(directory)
+        self.shards = {}
+        for shard in shards:
+            path = os.path.join(directory, shard_file_name(shard))
+            if os.path.exists(path):
+                self.shards[shard] = PostingsShard(path)
+            else:
+                print(f"分片文件不存在，跳过: {path}")
+        host, port = parse_address(address)
+        self._listener = Listener((host, port), authkey=authkey_for(host))
+        self.address = self._listener.address
+        self._stopping = threading.Event()
+
+    def lookup(self, term):
+        shard = self.shards.get(self.router.shard_of(term))
+        return None if shard is None else shard.get_postings_block(term)
+
+    def handle(self, op, args):
+        if op == "postings":
+            return {term: self.lookup(term) for term in args}
+        if op == "ping":
+            return {"shards": sorted(self.shards), "terms": sum(len(shard) for shard in self.shards.values())}
+        raise ValueError(f"未知的请求: {op}")
+
+    def _serve_connection(self, conn):
+        with conn:
+            while True:
+                try:
+                    request_id, op, args = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    reply = (request_id, "ok", self.handle(op, args))
+                except Exception as e:
+                    reply = (request_id, "error", str(e))
+                try:
+                    conn.send(reply)
+                except OSError:
+                    return
+
+    def serve_forever(self):
+        print(f"分片服务器监听 {self.address[0]}:{self.address[1]}，分片: {', '.join(sorted(self.shards))}")
+        while not self._stopping.is_set():
+            try:
+                conn = self._listener.accept()
+            except Exception:
+                # 认证失败或连接中途断开，不影响其它连接
+                continue
+            threading.Thread(target=self._serve_connection, args=(conn,), daemon=True).start()
+
+    def close(self):
+        self._stopping.set()
+        # accept() 不会因为另一个线程关闭监听 socket 而返回，用一次空连接唤醒它
+        try:
+            socket.create_connection(self.address, timeout=1).close()
+        except OSError:
+            pass
+        self._listener.close()
+        for shard in self.shards.values():
+            shard.close()
+
+
+class ShardClient:
+    """
+    到一台分片服务器的连接池；请求超时的连接直接丢弃（迟到的回复不能留给下一个请求）
+    :param connect_timeout: 建立新连接最多等待的秒数
+    :param retry_after: 连接失败后多少秒内直接报告离线
+    """
+
+    def __init__(self, address, pool_size=POOL_SIZE, connect_timeout=SHARD_CONNECT_TIMEOUT,
+                 retry_after=SHARD_RETRY_AFTER):
+        self.label = address
+        self.address = parse_address(address)
+        self.connect_timeout = connect_timeout
+        self.retry_after = retry_after
+        self._authkey = authkey_for(self.address[0])
+        self._idle = queue.LifoQueue(maxsize=pool_size)
+        self._ids = itertools.count()
+        self._down_until = 0.0
+
+    def _connect(self, timeout):
+        """
+        建立新连接，TCP 连接和认证握手都受 timeout 限制
+        （multiprocessing.connection.Client 没有连接超时，离线的主机要等到系统的 TCP 超时）
+        """
+        sock = socket.create_connection(self.address, timeout=timeout)
+        # Connection 直接读写文件描述符，需要阻塞模式
+        sock.setblocking(True)
+        conn = Connection(sock.detach())
+        try:
+            # 服务器 accept 之后立即发出认证挑战，迟迟没有说明服务器不回应
+            if not conn.poll(timeout):
+                raise TimeoutError("认证握手超时")
+            answer_challenge(conn, self._authkey)
+            deliver_challenge(conn, self._authkey)
+        except BaseException:
+            conn.close()
+            raise
+        return conn
+
+    def _checkout(self, timeout):
+        """:return: (连接, 是否为池中的旧连接)"""
+        try:
+            return self._idle.get_nowait(), True
+        except queue.Empty:
+            return self._connect(min(timeout, self.connect_timeout)), False
+
+    def _checkin(self, conn):
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def request(self, op, args, timeout=SHARD_TIMEOUT):
+        if time.monotonic() < self._down_until:
+            raise ShardUnavailable(f"{self.label}: 最近连接失败，暂时跳过")
+        while True:
+            try:
+                conn, reused = self._checkout(timeout)
+            except (OSError, EOFError, AuthenticationError) as e:
+                self._down_until = time.monotonic() + self.retry_after
+                raise ShardUnavailable(f"{self.label}: 无法连接 ({e})")
+            request_id = next(self._ids)
+            try:
+                conn.send((request_id, op, args))
+                if not conn.poll(timeout):
+                    raise ShardUnavailable(f"{self.label}: 超时")
+                reply_id, status, payload = conn.recv()
+            except ShardUnavailable:
+                conn.close()
+                raise
+            except (EOFError, OSError) as e:
+                conn.close()
+                # 池中的连接可能在服务器重启后失效，换一个新连接重试
+                if reused:
+                    continue
+                raise ShardUnavailable(f"{self.label}: 连接断开 ({e})")
+            break
+        if reply_id != request_id:
+            conn.close()
+            raise ShardUnavailable(f"{self.label}: 回复与请求不匹配")
+        self._checkin(conn)
+        if status != "ok":
+            raise ShardUnavailable(f"{self.label}: {payload}")
+        return payload
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def reset_after_fork(self):
+        """fork 出的子进程：丢弃从父进程继承的空闲连接（关闭的只是子进程中的文件描述符），之后各自建立连接"""
+        self.close()
+        self._ids = itertools.count()
+        self._down_until = 0.0
+
+
+class ShardCoordinator:
+    """
+    把查询词分发给负责它们的分片服务器并收集 postings
+    :param servers: 集群配置中的服务器列表
+    :param router: 词到分片名的路由（与构建分片时的 routing.json 一致）
+    """
+
+    def __init__(self, servers, router, timeout=SHARD_TIMEOUT):
+        self.router = router
+        self.timeout = timeout
+        self.clients = [ShardClient(server["address"]) for server in servers]
+        self._owner = {
+            shard: client for server, client in zip(servers, self.clients) for shard in server["shards"]
+        }
+        # 线程池在第一次查询时创建：预加载后 fork 的工作进程各自创建自己的线程
+        self._pool = None
+        # 父进程在 fork 之前用过协调器时，子进程继承的线程池没有工作线程，池中的连接与父进程共用 socket，
+        # 两者都在子进程中丢弃（弱引用：不因注册而让协调器一直存活）
+        after_fork = weakref.WeakMethod(self._after_fork)
+        os.register_at_fork(after_in_child=lambda: after_fork() and after_fork()())
+
+    def _after_fork(self):
+        self._pool = None
+        for client in self.clients:
+            client.reset_after_fork()
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(
+                max_workers=max(1, len(self.clients)) * POOL_SIZE, thread_name_prefix="shard"
+            )
+        return self._pool
+
+    def _scatter(self, op, groups, timeout):
+        """
+        并行向各服务器发出请求，最多等待 timeout 秒
+        :param groups: {ShardClient: args}
+        :return: ({ShardClient: 回复}, [未响应的服务器地址])
+        """
+        timeout = self.timeout if timeout is None else timeout
+        pool = self._get_pool()
+        futures = {pool.submit(client.request, op, args, timeout): client for client, args in groups.items()}
+        done, _ = wait(futures, timeout=timeout)
+        replies = {}
+        failed = []
+        for future, client in futures.items():
+            if future in done and future.exception() is None:
+                replies[client] = future.result()
+            else:
+                error = future.exception() if future in done else "超时"
+                print(f"分片服务器 {client.label} 未响应: {error}")
+                failed.append(client.label)
+        return replies, failed
+
+    def fetch_postings(self, terms, timeout=None):
+        """
+        :return: ({term: TermPostings 或 None}, [未响应的服务器地址])
+        """
+        postings = {}
+        groups = {}
+        for term in terms:
+            client = self._owner.get(self.router.shard_of(term))
+            if client is None:
+                postings[term] = None
+            else:
+                groups.setdefault(client, []).append(term)
+        replies, failed = self._scatter("postings", groups, timeout)
+        for client, group in groups.items():
+            blocks = replies.get(client, {})
+            for term in group:
+                block = blocks.get(term)
+                postings[term] = None if block is None else decode_postings(term, *block)
+        return postings, failed
+
+    def status(self, timeout=None):
+        """:return: {服务器地址: ping 的回复或 None}"""
+        replies, _ = self._scatter("ping", {client: None for client in self.clients}, timeout)
+        return {client.label: replies.get(client) for client in self.clients}
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+        for client in self.clients:
+            client.close()
+
+
+def launch_local(directory, n_servers, base_port):
+    """在本机启动 n_servers 个分片服务器子进程并写出 cluster.json，Ctrl+C 时全部停止"""
+    addresses = [f"127.0.0.1:{base_port + i}" for i in range(n_servers)]
+    cluster_path = os.path.join(directory, CLUSTER_FILE)
+    save_cluster(plan_cluster(directory, addresses), cluster_path)
+    children = [
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), "serve", directory, "--server", str(i)])
+        for i in range(n_servers)
+    ]
+    print(f"已启动 {n_servers} 个分片服务器，集群配置: {cluster_path}")
+    try:
+        while all(child.poll() is None for child in children):
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for child in children:
+            if child.poll() is None:
+                child.terminate()
+        for child in children:
+            child.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="按词分区的倒排索引分片服务器")
+    commands = parser.add_subparsers(dest="command", required=True)
+    plan_parser = commands.add_parser("plan", help="把分片分配给服务器，写出 cluster.json")
+    plan_parser.add_argument("directory")
+    plan_parser.add_argument("addresses", nargs="+", help="host:port")
+    serve_parser = commands.add_parser("serve", help="启动一台分片服务器")
+    serve_parser.add_argument("directory")
+    serve_parser.add_argument("--server", type=int, help="cluster.json 中的服务器序号")
+    serve_parser.add_argument("--address", help="host:port（与 --shards 一起使用，不读取 cluster.json）")
+    serve_parser.add_argument("--shards", help="逗号分隔的分片名")
+    local_parser = commands.add_parser("local", help="在本机启动多台分片服务器（测试用）")
+    local_parser.add_argument("directory")
+    local_parser.add_argument("--servers", type=int, default=2)
+    local_parser.add_argument("--base-port", type=int, default=7101)
+    status_parser = commands.add_parser("status", help="检查各分片服务器")
+    status_parser.add_argument("directory")
+    args = parser.parse_args()
+
+    if args.command == "plan":
+        save_cluster(plan_cluster(args.directory, args.addresses), os.path.join(args.directory, CLUSTER_FILE))
+    elif args.command == "serve":
+        if args.server is not None:
+            server_config = load_cluster(os.path.join(args.directory, CLUSTER_FILE))[args.server]
+            address, shards = server_config["address"], server_config["shards"]
+        elif args.address and args.shards:
+            address, shards = args.address, args.shards.split(",")
+        else:
+            sys.exit("需要 --server 或者 --address 和 --shards")
+        try:
+            server = ShardServer(args.directory, shards, address)
+        except ValueError as e:
+            sys.exit(str(e))
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    elif args.command == "local":
+        launch_local(args.directory, args.servers, args.base_port)
+    else:
+        servers = load_cluster(os.path.join(args.directory, CLUSTER_FILE))
+        if not servers:
+            sys.exit("没有 cluster.json")
+        coordinator = ShardCoordinator(servers, load_router(args.directory))
+        for address, reply in coordinator.status().items():
+            if reply is None:
+                print(f"{address}: 离线")
+            else:
+                print(f"{address}: {len(reply['shards'])} 个分片, {reply['terms']} 个词")
+        coordinator.close()
@@ -0,0 +1,111 @@
+'''
+基于词位置的查询摘要
+每个结果已经带有 term_positions（倒排索引中的位置，从 1 开始），
+文档存储中保存了每个位置在正文中的字节区间（doc_store.DocStore.token_offsets），
+因此只需要找到匹配位置最密集的窗口，按字节区间切出这一小段正文，
+不需要把整篇文档返回给前端，也不需要在请求时重新分词。
+高亮区间按 UTF-16 码元计数，与前端 JavaScript 字符串的下标一致（emoji 等 BMP 之外的字符占两个码元）。
+'''
+
+# 摘要窗口包含的索引词数（不含停用词，实际显示的单词更多）
+SNIPPET_TOKENS = 32
+# 窗口起点在第一个匹配位置之前保留的词数
+LEAD_TOKENS = 4
+# 没有词位置信息时退回到截取正文开头的字符数
+FALLBACK_CHARS = 200
+ELLIPSIS = "..."
+
+
+def utf16_len(text):
+    """字符串在 JavaScript 中的长度（UTF-16 码元数）"""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def merge_positions(term_positions):
+    """把 {term: [positions]} 合并成按位置排序的 [(position, term), ...]"""
+    merged = [
+        (position, term)
+        for term, positions in term_positions.items()
+        for position in positions
+    ]
+    merged.sort()
+    return merged
+
+
+def densest_window(matches, window=SNIPPET_TOKENS):
+    """
+    双指针找出 window 个位置内匹配最多的区间，
+    优先覆盖更多不同的查询词，其次是匹配次数，最后取最靠前的
+    :param matches: merge_positions 的结果
+    :return: (第一个匹配位置, 最后一个匹配位置)，没有匹配时返回 None
+    """
+    if not matches:
+        return None
+    best = None
+    best_key = None
+    term_counts = {}
+    left = 0
+    for right, (position, term) in enumerate(matches):
+        term_counts[term] = term_counts.get(term, 0) + 1
+        while position - matches[left][0] >= window:
+            left_term = matches[left][1]
+            term_counts[left_term] -= 1
+            if not term_counts[left_term]:
+                del term_counts[left_term]
+            left += 1
+        key = (len(term_counts), right - left + 1)
+        if best_key is None or key > best_key:
+            best_key = key
+            best = (matches[left][0], position)
+    return best
+
+
+def snippet_range(first, last, n_tokens, window=SNIPPET_TOKENS, lead=LEAD_TOKENS):
+    """以匹配区间为中心，确定摘要覆盖的位置区间 [start, end]（从 1 开始，包含两端）"""
+    start = max(1, first - lead)
+    end = min(n_tokens, max(last, start + window - 1))
+    start = max(1, min(start, end - window + 1))
+    return start, end
+
+
+def make_snippet(offsets, term_positions, read_bytes, window=SNIPPET_TOKENS):
+    """
+    生成查询摘要
+    :param offsets: 每个位置在正文中的字节区间，offsets[p - 1] 对应位置 p
+    :param term_positions: {term: [positions]}
+    :param read_bytes: read_bytes(byte_start, byte_end) -> 正文该区间的 UTF-8 字节
+    :return: {"snippet": 摘要文本, "highlights": [[start, end], ...]}，
+             高亮区间是摘要字符串内的 UTF-16 码元下标（前端直接用于 String.slice）
+    """
+    if not offsets:
+        return None
+    matches = [
+        (position, term) for position, term in merge_positions(term_positions or {})
+        if 1 <= position <= len(offsets)
+    ]
+    span = densest_window(matches, window)
+    first, last = span if span else (1, 1)
+    start, end = snippet_range(first, last, len(offsets), window)
+
+    base = offsets[start - 1][0]
+    raw = read_bytes(base, offsets[end - 1][1])
+    if raw is None:
+        return None
+    text = bytes(raw).decode("utf-8", errors="ignore")
+
+    prefix = ELLIPSIS + " " if start > 1 else ""
+    suffix = " " + ELLIPSIS if end < len(offsets) else ""
+    # 字节区间换算成摘要字符串中的 UTF-16 码元下标
+    highlights = []
+    for position, _ in matches:
+        if start <= position <= end:
+            byte_start, byte_end = offsets[position - 1]
+            unit_start = len(prefix) + utf16_len(raw[:byte_start - base].decode("utf-8", errors="ignore"))
+            unit_end = len(prefix) + utf16_len(raw[:byte_end - base].decode("utf-8", errors="ignore"))
+            highlights.append([unit_start, unit_end])
+    return {"snippet": prefix + text + suffix, "highlights": highlights}
+
+
+def fallback_snippet(content):
+    """没有词位置信息（旧格式的文档存储或 pickle 缓存）时截取正文开头，由前端按关键词高亮"""
+    return {"snippet": (content or "")[:FALLBACK_CHARS], "highlights": None}
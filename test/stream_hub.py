@@ -0,0 +1,114 @@
+'''
+AI 回答流的合并与重放（/api/ai-stream）
+    - 同一问题（规范化后的布尔表达式相同）同时只向上游发起一个请求，产生的文本块分发给所有订阅者；
+      中途加入的订阅者先收到已经产生的文本块，再继续接收新的
+    - 完整结束的回答保存在按估算大小设上限的 LRU + TTL 缓存中，之后的相同问题直接重放，不再请求上游
+    - 上游出错时订阅者先收到已产生的文本块，再收到同一个异常；出错或不完整的回答不缓存
+
+上游请求在独立的任务中执行，发起请求的客户端断开后仍会读完（回答长度由 max_tokens 限制），
+完整的回答进入缓存供之后的请求使用。
+'''
+
+import asyncio
+
+from result_cache import QueryResultCache, canonical_expression
+
+ANSWER_CACHE_BYTES = 16 * 1024 * 1024
+ANSWER_CACHE_TTL = 3600
+
+
+def answer_key(expression):
+    """问题的缓存键：规范化后的布尔表达式，子句顺序和大小写不同的问题共用一个回答"""
+    return canonical_expression(expression)
+
+
+class _Flight:
+    """一个进行中的上游请求，chunks 只追加"""
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.task = None
+        self.changed = asyncio.Condition()
+
+
+class StreamHub:
+    """
+    :param max_bytes: 已完成回答的缓存上限（估算大小之和）
+    :param ttl: 已完成回答的缓存秒数
+    """
+
+    def __init__(self, max_bytes=ANSWER_CACHE_BYTES, ttl=ANSWER_CACHE_TTL):
+        self.cache = QueryResultCache(max_bytes=max_bytes, ttl=ttl)
+        self._flights = {}
+        self.upstream_requests = 0
+        self.coalesced = 0
+
+    async def _produce(self, key, flight, source):
+        completed = False
+        try:
+            async for chunk in source:
+                async with flight.changed:
+                    flight.chunks.append(chunk)
+                    flight.changed.notify_all()
+            completed = True
+        except Exception as e:
+            flight.error = e
+        finally:
+            # 先写入缓存再移除，新的订阅者总能在两者之一中找到这个回答
+            if completed:
+                # 空回答正常结束，不报错，也不缓存
+                if flight.chunks:
+                    self.cache.put(key, list(flight.chunks))
+            elif flight.error is None:
+                flight.error = RuntimeError("上游请求被取消")
+            self._flights.pop(key, None)
+            async with flight.changed:
+                flight.done = True
+                flight.changed.notify_all()
+
+    async def subscribe(self, key, open_source):
+        """
+        逐个产生问题的回答文本块
+        :param open_source: 无参数的函数，返回上游的异步迭代器；只在没有缓存且没有进行中的请求时调用
+        """
+        cached = self.cache.get(key)
+        if cached is not None:
+            for chunk in cached:
+                yield chunk
+            return
+
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _Flight()
+            self.upstream_requests += 1
+            flight.task = asyncio.ensure_future(self._produce(key, flight, open_source()))
+        else:
+            self.coalesced += 1
+
+        flight.subscribers += 1
+        try:
+            i = 0
+            while True:
+                while i < len(flight.chunks):
+                    yield flight.chunks[i]
+                    i += 1
+                if flight.done:
+                    break
+                async with flight.changed:
+                    await flight.changed.wait_for(lambda: flight.done or len(flight.chunks) > i)
+            if flight.error is not None:
+                raise flight.error
+        finally:
+            flight.subscribers -= 1
+
+    def stats(self):
+        return {
+            "in_flight": len(self._flights),
+            "subscribers": sum(flight.subscribers for flight in self._flights.values()),
+            "upstream_requests": self.upstream_requests,
+            "coalesced": self.coalesced,
+            "cache": self.cache.stats(),
+        }
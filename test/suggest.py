@@ -0,0 +1,317 @@
+'''
+查询建议（/api/query-suggestions）
+
+第一层：进程内的前缀补全，每次按键在微秒级返回
+    - 查询日志（query_log.py）中的历史查询，按查询次数排序，用整个输入作为前缀
+    - 索引词表，按 df 排序，补全输入的最后一个词
+  两者都是按字典序排列的数组，一个前缀对应其中连续的一段（二分查找得到）；
+  段内条目较多的前缀中，长度不超过 PRECOMPUTE_PREFIX_LEN 的（如单个字母）在构建时（后台线程）算出权重最高的若干项，
+  更长的在第一次查询时计算，记在最多 TOP_CACHE_SIZE 项的 LRU 中。这种冷计算不在事件循环中执行：
+  suggest(compute=False) 遇到它时返回 None，由调用方交给线程池。
+  词表在后台线程中构建，之后每 REFRESH_INTERVAL 秒从查询日志重建历史查询，索引版本变化时重建词表。
+
+第二层（可选）：LLM 生成的相关查询（query_extension.extend_query_gpt35）
+  在专用的小线程池中执行，不占用事件循环默认线程池（分页读取、查询分析、查询日志都在那里）；
+  结果按查询缓存，同一查询的并发请求只调用一次。
+  只有调用方明确要求（expand=true）或输入停顿了 LLM_SETTLE_SECONDS 秒时才发起调用：
+  每次按键只登记一个延迟任务，在此期间输入了以它为前缀的更长查询时取消；
+  同时进行的调用数超过 LLM_MAX_PENDING 时不再发起新的调用。
+'''
+
+import asyncio
+import heapq
+import os
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from result_cache import QueryResultCache
+
+SUGGEST_LIMIT = 10
+# 词表只保留至少出现在这么多篇文档中的词（去掉拼写错误等只出现一次的词）
+MIN_TERM_DF = int(os.environ.get("SUGGEST_MIN_DF", 2))
+# 历史查询和索引版本的检查间隔（秒）
+REFRESH_INTERVAL = 300
+# 前缀对应的条目超过此数时记住前 k 项，否则每次直接扫描
+SCAN_LIMIT = 256
+# 构建时预先算好前 k 项的前缀长度上限
+PRECOMPUTE_PREFIX_LEN = 2
+# 查询时算出的前缀结果最多记住的条数（LRU）
+TOP_CACHE_SIZE = 4096
+# 大于任何字符，prefix + PREFIX_END 是所有以 prefix 开头的字符串的上界
+PREFIX_END = "\U0010ffff"
+
+SUGGEST_LLM = os.environ.get("SUGGEST_LLM", "1") != "0"
+LLM_CACHE_TTL = 24 * 3600
+# 执行 LLM 调用的线程数和同时进行的调用数上限
+LLM_WORKERS = int(os.environ.get("SUGGEST_LLM_WORKERS", 2))
+LLM_MAX_PENDING = int(os.environ.get("SUGGEST_LLM_MAX_PENDING", 4))
+# 输入停顿多少秒后才为它在后台发起调用
+LLM_SETTLE_SECONDS = float(os.environ.get("SUGGEST_LLM_SETTLE", 0.8))
+
+
+def normalize(text):
+    """与查询日志相同的规范化：小写，合并空白"""
+    return " ".join(text.lower().split())
+
+
+class PrefixIndex:
+    """
+    按字典序排列的字符串数组和对应的权重，返回以给定前缀开头、权重最高的字符串
+    :param weights: {字符串: 权重}
+    :param precompute: 构建时算好前 k 项的前缀长度上限
+    :param cache_size: 查询时算出的前缀结果最多记住的条数
+    """
+
+    def __init__(self, weights, precompute=PRECOMPUTE_PREFIX_LEN, cache_size=TOP_CACHE_SIZE):
+        self.keys = sorted(weights)
+        self.weights = array("q", (weights[key] for key in self.keys))
+        self.cache_size = cache_size
+        self._fixed = {}
+        self._top = OrderedDict()
+        self._lock = threading.Lock()
+        for length in range(1, precompute + 1):
+            self._precompute(length)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _precompute(self, length):
+        """算好所有长度为 length、条目数超过 SCAN_LIMIT 的前缀的前 k 项"""
+        lo = 0
+        while lo < len(self.keys):
+            prefix = self.keys[lo][:length]
+            hi = bisect_left(self.keys, prefix + PREFIX_END, lo)
+            if len(prefix) == length and hi - lo > SCAN_LIMIT:
+                self._fixed[prefix] = self._best(lo, hi, SUGGEST_LIMIT)
+            lo = hi
+
+    def _best(self, lo, hi, limit):
+        # 权重相同时 nlargest 保持下标顺序，即按字典序
+        best = heapq.nlargest(limit, range(lo, hi), key=self.weights.__getitem__)
+        return [self.keys[i] for i in best]
+
+    def complete(self, prefix, limit=SUGGEST_LIMIT, compute=True):
+        """
+        :param compute: 为 False 时，需要在整段条目上计算（没有预先算好、也不在 LRU 中）的前缀返回 None
+        """
+        lo = bisect_left(self.keys, prefix)
+        hi = bisect_left(self.keys, prefix + PREFIX_END, lo)
+        if hi - lo <= SCAN_LIMIT:
+            return self._best(lo, hi, limit)
+        top = self._fixed.get(prefix)
+        if top is not None and len(top) >= limit:
+            return top[:limit]
+        with self._lock:
+            top = self._top.get(prefix)
+            if top is not None:
+                self._top.move_to_end(prefix)
+        if top is None or len(top) < limit:
+            if not compute:
+                return None
+            top = self._best(lo, hi, max(limit, SUGGEST_LIMIT))
+            with self._lock:
+                self._top[prefix] = top
+                self._top.move_to_end(prefix)
+                while len(self._top) > self.cache_size:
+                    self._top.popitem(last=False)
+        return top[:limit]
+
+
+class SuggestionEngine:
+    """
+    :param query_log: QueryLog，历史查询的来源，None 时只补全词
+    :param vocabulary_fn: 返回 (term, df) 迭代器的函数（search_func.iter_vocabulary）
+    :param version_fn: 返回当前索引版本的函数，版本变化时重建词表
+    """
+
+    def __init__(self, query_log=None, vocabulary_fn=None, version_fn=None, min_df=MIN_TERM_DF,
+                 refresh_interval=REFRESH_INTERVAL):
+        self.query_log = query_log
+        self.vocabulary_fn = vocabulary_fn
+        self.version_fn = version_fn
+        self.min_df = min_df
+        self.refresh_interval = refresh_interval
+        self.queries = PrefixIndex({})
+        self.terms = PrefixIndex({})
+        self.vocabulary_version = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def build_vocabulary(self):
+        if self.vocabulary_fn is None:
+            return
+        version = self.version_fn() if self.version_fn else None
+        start = time.time()
+        weights = {}
+        for term, df in self.vocabulary_fn():
+            if df >= self.min_df:
+                weights[term] = max(df, weights.get(term, 0))
+        # 整体替换，查询线程看到的始终是完整的数组
+        self.terms = PrefixIndex(weights)
+        self.vocabulary_version = version
+        print(f"查询建议词表: {len(self.terms)} 个词，用时 {time.time() - start:.2f} 秒")
+
+    def refresh_queries(self):
+        if self.query_log is not None:
+            self.queries = PrefixIndex(dict(self.query_log.query_counts()))
+
+    def build(self):
+        """在当前线程中构建词表和历史查询（serve.py 在 fork 之前调用）"""
+        self.build_vocabulary()
+        self.refresh_queries()
+
+    def _run(self):
+        try:
+            if self.vocabulary_version is None:
+                self.build()
+            while not self._stop.wait(self.refresh_interval):
+                self.refresh_queries()
+                if self.version_fn is not None and self.version_fn() != self.vocabulary_version:
+                    self.build_vocabulary()
+        except Exception as e:
+            print(f"构建查询建议出错: {e}")
+
+    def start(self):
+        """在后台线程中构建并定期刷新"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="suggest", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def suggest(self, text, limit=SUGGEST_LIMIT, compute=True):
+        """
+        :param compute: 为 False 时只使用已经算好的结果，需要冷计算时返回 None（调用方改在线程池中执行）
+        :return: 补全后的查询，历史查询在前，不足时用词表补全最后一个词
+        """
+        text = normalize(text)
+        if not text:
+            return []
+        queries = self.queries.complete(text, limit + 1, compute)
+        if queries is None:
+            return None
+        results = [query for query in queries if query != text][:limit]
+        head, _, last = text.rpartition(" ")
+        if len(results) < limit and last:
+            terms = self.terms.complete(last, limit + 1, compute)
+            if terms is None:
+                return None
+            for term in terms:
+                candidate = f"{head} {term}" if head else term
+                if candidate != text and candidate not in results:
+                    results.append(candidate)
+                    if len(results) >= limit:
+                        break
+        return results
+
+
+class LLMExpander:
+    """
+    缓存的 LLM 查询扩展
+    :param expand_fn: 查询 -> {"expanded_queries": [...]}，阻塞调用，在专用线程池中执行
+    :param workers: 线程池大小
+    :param max_pending: 同时进行的调用数上限
+    :param settle: 不等待结果的请求在输入停顿多少秒后才发起调用
+    """
+
+    def __init__(self, expand_fn, enabled=SUGGEST_LLM, ttl=LLM_CACHE_TTL, workers=LLM_WORKERS,
+                 max_pending=LLM_MAX_PENDING, settle=LLM_SETTLE_SECONDS):
+        self.expand_fn = expand_fn
+        self.enabled = enabled
+        self.workers = workers
+        self.max_pending = max_pending
+        self.settle = settle
+        self.cache = QueryResultCache(max_bytes=8 * 1024 * 1024, ttl=ttl)
+        self._pending = {}
+        self._timers = {}
+        self._executor = None
+        self.skipped = 0
+
+    def _get_executor(self):
+        # 第一次使用时创建，预加载后 fork 出的工作进程各自创建
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="suggest-llm")
+        return self._executor
+
+    async def _run(self, key):
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self._get_executor(), self.expand_fn, key)
+        except Exception as e:
+            print(f"生成查询扩展时出错: {str(e)}")
+            return []
+        # extend_query_gpt35 出错时返回 JSON 格式的错误信息，不缓存
+        if not isinstance(result, dict):
+            print(f"生成查询扩展时出错: {result}")
+            return []
+        expanded = result.get("expanded_queries", [])
+        if expanded:
+            self.cache.put(key, expanded)
+        return expanded
+
+    def _start(self, key):
+        """发起调用，已有进行中的调用时复用它；达到并发上限时返回 None"""
+        self._timers.pop(key, None)
+        task = self._pending.get(key)
+        if task is not None:
+            return task
+        if len(self._pending) >= self.max_pending:
+            self.skipped += 1
+            return None
+        task = asyncio.ensure_future(self._run(key))
+        self._pending[key] = task
+        task.add_done_callback(lambda _, key=key: self._pending.pop(key, None))
+        return task
+
+    def _schedule(self, key):
+        """输入停顿 settle 秒后再发起调用；之前登记的、是这次输入前缀的查询说明用户还在输入，取消它们"""
+        for end in range(1, len(key)):
+            timer = self._timers.pop(key[:end], None)
+            if timer is not None:
+                timer.cancel()
+        if key in self._timers or key in self._pending:
+            return
+        self._timers[key] = asyncio.get_running_loop().call_later(self.settle, self._start, key)
+
+    async def expand(self, text, wait=False):
+        """
+        :param wait: 为 True 时立即发起调用并等待结果；为 False 时只返回已缓存的结果，
+                     未缓存时登记一个延迟调用，输入停顿后在后台生成供之后的请求使用
+        :return: 扩展的查询列表，没有（或未等待、达到并发上限）时返回 None
+        """
+        if not self.enabled:
+            return None
+        key = normalize(text)
+        if not key:
+            return None
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        if not wait:
+            self._schedule(key)
+            return None
+        task = self._start(key)
+        if task is None:
+            return None
+        # 一个请求被取消时不影响等待同一任务的其他请求
+        return await asyncio.shield(task)
+
+    def stats(self):
+        return {
+            "pending": len(self._pending),
+            "scheduled": len(self._timers),
+            "skipped": self.skipped,
+            "cache": self.cache.stats(),
+        }
+
+    def close(self):
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,49 @@
+'''
+建索引时使用的文本预处理：小写化、按 \\b\\w+\\b 切词、去停用词、词形还原
+同时可以返回每个保留下来的词在正文 UTF-8 编码中的字节区间，
+倒排索引中的位置 p（从 1 开始）对应 offsets[p - 1]，用于生成摘要时直接定位原文。
+'''
+
+import re
+
+from nltk.corpus import stopwords
+from nltk.stem import WordNetLemmatizer
+
+TOKEN_PATTERN = re.compile(r'\b\w+\b')
+
+lemmatizer = WordNetLemmatizer()
+stop_words = set(stopwords.words('english'))
+
+
+def analyze_text(text, with_offsets=False):
+    """
+    :param text: 文档正文
+    :param with_offsets: 是否同时返回字节区间
+    :return: 词列表；with_offsets 为 True 时返回 (词列表, [(byte_start, byte_end), ...])
+    """
+    words = []
+    offsets = []
+    byte_position = 0
+    char_position = 0
+    for match in TOKEN_PATTERN.finditer(text):
+        word = match.group().lower()
+        if word in stop_words:
+            continue
+        words.append(lemmatizer.lemmatize(word))
+        if with_offsets:
+            # 增量地把字符下标换算成字节下标
+            byte_position += len(text[char_position:match.start()].encode('utf-8'))
+            start = byte_position
+            byte_position += len(match.group().encode('utf-8'))
+            char_position = match.end()
+            offsets.append((start, byte_position))
+    if with_offsets:
+        return words, offsets
+    return words
+
+
+def add_token_offsets(docs):
+    """为文档流中的每篇文档附加 token_offsets 字段，供文档存储保存"""
+    for doc in docs:
+        _, offsets = analyze_text(doc.get('content') or '', with_offsets=True)
+        yield {**doc, 'token_offsets': offsets}
@@ -0,0 +1,201 @@
+'''
+启动预热：并行加载倒排索引分片、文档存储和语料统计量，并提供就绪状态
+
+分片按查询日志（query_log.py）中的流行度排序：最常被查询的词所在的分片最先加载，
+二进制分片还会把文件页读入内存（prefetch），第一次查询不再等待磁盘或 MongoDB 的全表扫描。
+    - WARMUP=0：不预热，立即就绪，分片在第一次查询时加载（原来的行为）
+    - WARMUP_WORKERS：并行加载的线程数，默认 4
+    - WARMUP_REQUIRED：就绪前必须加载完成的分片数（按流行度取前 N 个），默认 0 表示全部；
+      其余分片在就绪之后继续在后台加载
+设置了分片缓存上限（SHARD_CACHE_MB）时只预热按流行度排在前面、估算大小之和不超过上限的分片，
+避免后加载的冷门分片把先加载的热门分片淘汰掉；其余分片在第一次查询时加载。
+配置了分片服务器（shard_server.py）时本进程不加载分片，改为在后台线程中探测分片服务器，全部在线后才就绪。
+探测只在 start() 中进行，不阻塞 run()：serve.py 的父进程在 fork 之前调用 run()，不会因为某台分片服务器
+离线而迟迟不绑定端口，也不会在 fork 之前使用协调器；各工作进程启动时各自探测。
+
+就绪状态由 main.py 的 /healthz/ready 返回，负载均衡只把请求发给已经预热完成的工作进程。
+SEARCH_EXECUTOR=process 时查询在各自按需加载分片的子进程中执行，预热只覆盖 Web 进程本身。
+'''
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import search_func
+
+WARMUP_ENABLED = os.environ.get("WARMUP", "1") != "0"
+WARMUP_WORKERS = int(os.environ.get("WARMUP_WORKERS", 4))
+WARMUP_REQUIRED = int(os.environ.get("WARMUP_REQUIRED", 0))
+# 等待分片服务器时两次探测之间的间隔（秒）
+CLUSTER_RETRY_INTERVAL = 1.0
+
+
+def shard_popularity(term_counts, shard_of):
+    """按路由把查询日志中的词计数汇总到分片"""
+    popularity = {}
+    for term, count in term_counts.items():
+        shard = shard_of(term)
+        if shard is not None:
+            popularity[shard] = popularity.get(shard, 0) + count
+    return popularity
+
+
+class Warmup:
+    """
+    :param query_log: QueryLog，用于确定加载顺序；None 时按分片名顺序加载
+    :param workers: 并行加载的线程数
+    :param required: 就绪前必须加载的分片数，0 表示全部
+    """
+
+    def __init__(self, query_log=None, workers=WARMUP_WORKERS, required=WARMUP_REQUIRED, enabled=WARMUP_ENABLED):
+        self.query_log = query_log
+        self.workers = workers
+        self.required = required
+        self.enabled = enabled
+        self.order = []
+        self.skipped = []
+        self.required_shards = set()
+        self.loaded = set()
+        self.errors = {}
+        self.offline_servers = []
+        self.cluster_mode = False
+        self.cluster_checked = False
+        self.support_loaded = False
+        self.started_at = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def plan(self):
+        """:return: 按流行度从高到低排列的分片名（没有查询记录的分片保持原顺序排在后面）"""
+        shards = list(search_func.SHARDS)
+        if self.query_log is None:
+            return shards
+        popularity = shard_popularity(self.query_log.term_counts(), search_func.shard_of)
+        return sorted(shards, key=lambda shard: -popularity.get(shard, 0))
+
+    def fit_budget(self, order, max_bytes):
+        """:return: (在内存预算内预热的分片, 跳过的分片)，max_bytes 为 0 时全部预热"""
+        if not max_bytes:
+            return order, []
+        selected = []
+        skipped = []
+        total = 0
+        for shard in order:
+            size = search_func.estimated_shard_bytes(shard)
+            if skipped or total + size > max_bytes:
+                skipped.append(shard)
+            else:
+                selected.append(shard)
+                total += size
+        return selected, skipped
+
+    def _load_shard(self, shard):
+        search_func.prefetch_shard(shard)
+        return shard
+
+    def _load_support(self):
+        """文档存储、增量段和语料统计量：每个查询都会用到，始终是就绪的前提"""
+        search_func.load_content_caches()
+        search_func.get_segment_index()
+        search_func.get_corpus_stats()
+
+    def _support_done(self, future):
+        error = future.exception()
+        with self._lock:
+            if error is None:
+                self.support_loaded = True
+            else:
+                self.errors["support"] = str(error)
+        if error is not None:
+            print(f"预热文档存储/统计量失败: {error}")
+
+    def _watch_cluster(self):
+        """探测分片服务器直到全部在线（在各进程自己的后台线程中执行）"""
+        coordinator = search_func.get_shard_coordinator()
+        while True:
+            offline = [address for address, reply in coordinator.status().items() if reply is None]
+            with self._lock:
+                self.offline_servers = offline
+                self.cluster_checked = True
+            if not offline:
+                return
+            print(f"等待分片服务器: {', '.join(offline)}")
+            time.sleep(CLUSTER_RETRY_INTERVAL)
+
+    def run(self):
+        """在当前线程中执行预热，全部加载完成（或失败）后返回"""
+        if not self.enabled or self.started_at is not None:
+            return
+        self.started_at = time.time()
+        self.cluster_mode = search_func.get_shard_coordinator() is not None
+        self.order = [] if self.cluster_mode else self.plan()
+        self.order, self.skipped = self.fit_budget(self.order, search_func.SHARD_CACHE_MB * 1024 * 1024)
+        if self.skipped:
+            print(f"分片缓存上限 {search_func.SHARD_CACHE_MB} MB，跳过预热 {len(self.skipped)} 个分片")
+        self.required_shards = set(self.order[:self.required] if self.required else self.order)
+        print(f"开始预热: {len(self.order)} 个分片（就绪需要 {len(self.required_shards)} 个），{self.workers} 个线程")
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="warmup") as pool:
+            pool.submit(self._load_support).add_done_callback(self._support_done)
+            # 线程池按提交顺序取任务，流行的分片先加载
+            futures = {pool.submit(self._load_shard, shard): shard for shard in self.order}
+            for future in as_completed(futures):
+                shard = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"预热分片 {shard} 失败: {e}")
+                    with self._lock:
+                        self.errors[shard] = str(e)
+                    continue
+                with self._lock:
+                    self.loaded.add(shard)
+        self.finished_at = time.time()
+        print(f"预热完成: {len(self.loaded)}/{len(self.order)} 个分片，用时 {self.finished_at - self.started_at:.2f} 秒")
+
+    def _run_and_watch(self):
+        self.run()
+        if self.cluster_mode:
+            self._watch_cluster()
+
+    def start(self):
+        """在后台线程中预热；已经在 fork 之前执行过 run() 时只探测分片服务器"""
+        if self._thread is not None or not self.enabled:
+            return
+        if self.started_at is None:
+            self._thread = threading.Thread(target=self._run_and_watch, name="warmup", daemon=True)
+        elif self.cluster_mode:
+            self._thread = threading.Thread(target=self._watch_cluster, name="warmup", daemon=True)
+        else:
+            return
+        self._thread.start()
+
+    def _is_ready(self):
+        return (
+            not self.enabled
+            or self.started_at is not None
+            and self.support_loaded
+            and self.required_shards <= self.loaded
+            and (not self.cluster_mode or self.cluster_checked and not self.offline_servers)
+        )
+
+    def ready(self):
+        with self._lock:
+            return self._is_ready()
+
+    def status(self):
+        with self._lock:
+            pending = [shard for shard in self.order if shard in self.required_shards and shard not in self.loaded]
+            return {
+                "ready": self._is_ready(),
+                "enabled": self.enabled,
+                "loaded_shards": len(self.loaded),
+                "total_shards": len(self.order),
+                "skipped_shards": len(self.skipped),
+                "pending_required": pending,
+                "offline_servers": list(self.offline_servers),
+                "errors": dict(self.errors),
+                "elapsed": None if self.started_at is None else (self.finished_at or time.time()) - self.started_at,
+            }
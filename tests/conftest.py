@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 应用代码在 test/ 目录中，模块之间按平铺的模块名互相导入
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test"))
@@ -0,0 +1,131 @@
+'''
+在本机启动一个假的 SSE 服务器，检查 stream_answer 对正常回答、非 200 状态码和连接中断的处理
+'''
+
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+
+import ds_api
+from ds_api import DeepSeekError, parse_sse_line, stream_answer
+
+
+def sse_event(payload):
+    return "data: " + json.dumps(payload) + "\n\n"
+
+
+def delta(text):
+    return {"choices": [{"delta": {"content": text}}]}
+
+
+class FakeDeepSeek(BaseHTTPRequestHandler):
+    """按请求路径返回不同的响应，路径在测试中通过 ds_api.url 指定"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def send_chunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def start_stream(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path.startswith("/ok"):
+            self.start_stream()
+            self.send_chunk(sse_event(delta("Hello")))
+            # 没有空格的 data 行、空的 choices（用量统计块）、非 JSON 的行
+            self.send_chunk("data:" + json.dumps(delta(", world")) + "\n\n")
+            self.send_chunk(sse_event({"choices": [], "usage": {"total_tokens": 3}}))
+            self.send_chunk(": keep-alive\n\ndata: not json\n\n")
+            self.send_chunk("data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+        elif self.path.startswith("/error"):
+            body = b'{"error": {"message": "rate limited"}}'
+            self.send_response(429)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path.startswith("/disconnect"):
+            # 发出第一个文本块后直接断开，分块编码没有结束
+            self.start_stream()
+            self.send_chunk(sse_event(delta("partial")))
+            self.close_connection = True
+        elif self.path.startswith("/truncated"):
+            # 分块编码正常结束，但是没有 [DONE]
+            self.start_stream()
+            self.send_chunk(sse_event(delta("partial")))
+            self.wfile.write(b"0\r\n\r\n")
+
+
+@pytest.fixture(scope="module")
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), FakeDeepSeek)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def collect(server, monkeypatch, path):
+    """读取 stream_answer 产生的文本块，返回 (文本块列表, 异常)"""
+    monkeypatch.setattr(ds_api, "url", server + path)
+
+    async def run():
+        chunks = []
+        async with httpx.AsyncClient(timeout=5) as client:
+            try:
+                async for chunk in stream_answer("question", expression="question", client=client):
+                    chunks.append(chunk)
+            except Exception as e:
+                return chunks, e
+        return chunks, None
+
+    return asyncio.run(run())
+
+
+def test_parse_sse_line():
+    assert parse_sse_line('data: {"choices": []}') == (False, None)
+    assert parse_sse_line('data:{"choices": [{"delta": {"content": "x"}}]}') == (False, "x")
+    assert parse_sse_line('data: {"choices": [{}]}') == (False, None)
+    assert parse_sse_line("data:[DONE]") == (True, None)
+    assert parse_sse_line("event: message") == (False, None)
+
+
+def test_stream_answer_reads_until_done(server, monkeypatch):
+    chunks, error = collect(server, monkeypatch, "/ok")
+    assert error is None
+    assert "".join(chunks) == "Hello, world"
+
+
+def test_stream_answer_raises_on_error_status(server, monkeypatch):
+    chunks, error = collect(server, monkeypatch, "/error")
+    assert chunks == []
+    assert isinstance(error, DeepSeekError)
+    assert "429" in str(error) and "rate limited" in str(error)
+
+
+def test_stream_answer_raises_on_early_disconnect(server, monkeypatch):
+    chunks, error = collect(server, monkeypatch, "/disconnect")
+    assert chunks == ["partial"]
+    assert isinstance(error, httpx.HTTPError)
+
+
+def test_stream_answer_raises_when_done_is_missing(server, monkeypatch):
+    chunks, error = collect(server, monkeypatch, "/truncated")
+    assert chunks == ["partial"]
+    assert isinstance(error, DeepSeekError)
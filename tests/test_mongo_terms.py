@@ -0,0 +1,79 @@
+'''
+用 mongomock 的同步客户端检查 TermStore 的按词查询和 term 索引
+'''
+
+import mongomock
+import pytest
+
+from mongo_terms import COLLECTION_PREFIX, TermStore
+
+DATABASE = "search_db"
+
+
+@pytest.fixture
+def client():
+    client = mongomock.MongoClient()
+    db = client[DATABASE]
+    # 与基线加载方式相同：只有文档，没有 term 索引
+    db[COLLECTION_PREFIX + "a"].insert_many([
+        {"term": "apple", "data": {"1": {"tf": 2, "positions": [0, 5]}}},
+        {"term": "apex", "data": {"2": {"tf": 1, "positions": [7]}}},
+    ])
+    db[COLLECTION_PREFIX + "b"].insert_many([
+        {"term": "banana", "data": {"3": {"tf": 3, "positions": [1, 4, 9]}}},
+    ])
+    return client
+
+
+@pytest.fixture
+def store(client):
+    store = TermStore(database=DATABASE, client=client, timeout=5)
+    yield store
+    store.close()
+
+
+def term_indexed(client, shard):
+    info = client[DATABASE][COLLECTION_PREFIX + shard].index_information()
+    return any(spec["key"] == [("term", 1)] for spec in info.values())
+
+
+def test_fetch_returns_requested_terms_only(store):
+    found = store.fetch({"a": {"apple", "avocado"}, "b": {"banana"}})
+    assert found == {
+        "apple": {"1": {"tf": 2, "positions": [0, 5]}},
+        "banana": {"3": {"tf": 3, "positions": [1, 4, 9]}},
+    }
+    assert store.fetch({"a": set()}) == {}
+
+
+def test_term_index_created_once_per_collection(client, store):
+    assert not term_indexed(client, "a")
+    store.fetch({"a": {"apple"}})
+    assert term_indexed(client, "a")
+    # 只查询过的集合会创建索引
+    assert not term_indexed(client, "b")
+
+    calls = []
+    collection_class = type(client[DATABASE][COLLECTION_PREFIX + "a"])
+    original = collection_class.create_index
+
+    def counting_create_index(self, *args, **kwargs):
+        calls.append(self.name)
+        return original(self, *args, **kwargs)
+
+    collection_class.create_index = counting_create_index
+    try:
+        store.fetch({"a": {"apex"}, "b": {"banana"}})
+        store.fetch({"a": {"apple"}, "b": {"banana"}})
+    finally:
+        collection_class.create_index = original
+    assert calls == [COLLECTION_PREFIX + "b"]
+
+
+def test_index_failure_warns_and_still_fetches(client, store, monkeypatch, capsys):
+    def refuse(self, *args, **kwargs):
+        raise mongomock.OperationFailure("not authorized")
+
+    monkeypatch.setattr(type(client[DATABASE][COLLECTION_PREFIX + "a"]), "create_index", refuse)
+    assert store.fetch({"a": {"apex"}}) == {"apex": {"2": {"tf": 1, "positions": [7]}}}
+    assert "term 索引" in capsys.readouterr().out
@@ -0,0 +1,150 @@
+'''
+在本机启动多个分片服务器，检查 scatter-gather 的结果与超时处理
+'''
+
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from binary_index import PostingsShard, shard_file_name, write_index
+from shard_router import load_router
+from shard_server import ShardClient, ShardCoordinator, ShardServer, ShardUnavailable, authkey_for
+
+POSTINGS = {
+    "apple": {1: {"tf": 2, "positions": [0, 5]}, 4: {"tf": 1, "positions": [3]}},
+    "apex": {2: {"tf": 1, "positions": [7]}},
+    "banana": {1: {"tf": 1, "positions": [2]}, 3: {"tf": 3, "positions": [1, 4, 9]}},
+    "cherry": {5: {"tf": 1, "positions": [0]}},
+}
+
+
+class SlowShardServer(ShardServer):
+    """回复 postings 请求前等待 delay 秒，模拟过载的服务器"""
+
+    delay = 1.0
+
+    def handle(self, op, args):
+        if op == "postings":
+            time.sleep(self.delay)
+        return super().handle(op, args)
+
+
+@pytest.fixture
+def index_dir(tmp_path):
+    # 没有 routing.json：按首字符分片
+    for shard in ("a", "b", "c"):
+        items = sorted((term, postings) for term, postings in POSTINGS.items() if term[0] == shard)
+        write_index(str(tmp_path / shard_file_name(shard)), items)
+    return str(tmp_path)
+
+
+def start(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return {"address": f"{server.address[0]}:{server.address[1]}", "shards": sorted(server.shards)}
+
+
+def test_scatter_gather_skips_timed_out_server(index_dir):
+    servers = [
+        ShardServer(index_dir, ["a"], "127.0.0.1:0"),
+        ShardServer(index_dir, ["b"], "127.0.0.1:0"),
+        SlowShardServer(index_dir, ["c"], "127.0.0.1:0"),
+    ]
+    config = [start(server) for server in servers]
+    coordinator = ShardCoordinator(config, load_router(index_dir), timeout=0.3)
+    try:
+        started = time.monotonic()
+        postings, failed = coordinator.fetch_postings(["apple", "apex", "banana", "cherry", "durian"])
+        assert time.monotonic() - started < SlowShardServer.delay
+
+        assert failed == [config[2]["address"]]
+        assert postings["cherry"] is None
+        assert postings["durian"] is None
+        local = {shard: PostingsShard(os.path.join(index_dir, shard_file_name(shard))) for shard in ("a", "b")}
+        for term in ("apple", "apex", "banana"):
+            expected = local[term[0]].get_postings(term)
+            assert postings[term].doc_ids == expected.doc_ids
+            assert postings[term].tfs == expected.tfs
+            assert [postings[term].positions(i) for i in range(len(expected))] == \
+                [expected.positions(i) for i in range(len(expected))]
+
+        # 超时的服务器不影响之后只涉及其它服务器的查询
+        postings, failed = coordinator.fetch_postings(["banana"])
+        assert failed == [] and postings["banana"].doc_ids == [1, 3]
+    finally:
+        coordinator.close()
+        for server in servers:
+            server.close()
+
+
+def test_unresponsive_host_is_bounded_and_skipped(index_dir):
+    # 只监听不 accept：TCP 连接由内核完成，但永远收不到认证挑战，相当于卡住的主机
+    silent = socket.socket()
+    silent.bind(("127.0.0.1", 0))
+    silent.listen(8)
+    healthy = ShardServer(index_dir, ["a", "b"], "127.0.0.1:0")
+    config = [start(healthy), {"address": "127.0.0.1:%d" % silent.getsockname()[1], "shards": ["c"]}]
+    coordinator = ShardCoordinator(config, load_router(index_dir), timeout=5.0)
+    for client in coordinator.clients:
+        client.connect_timeout = 0.2
+    try:
+        started = time.monotonic()
+        postings, failed = coordinator.fetch_postings(["apple", "banana", "cherry"])
+        assert time.monotonic() - started < 2.0
+        assert failed == [config[1]["address"]]
+        assert postings["apple"].doc_ids == [1, 4] and postings["cherry"] is None
+
+        # 连接失败之后的一段时间内直接跳过，不再等待连接超时
+        started = time.monotonic()
+        _, failed = coordinator.fetch_postings(["cherry"])
+        assert time.monotonic() - started < 0.1
+        assert failed == [config[1]["address"]]
+    finally:
+        coordinator.close()
+        healthy.close()
+        silent.close()
+
+
+def test_client_retries_after_backoff(index_dir):
+    server = ShardServer(index_dir, ["a"], "127.0.0.1:0")
+    address = start(server)["address"]
+    server.close()
+    client = ShardClient(address, retry_after=0.2)
+    with pytest.raises(ShardUnavailable):
+        client.request("ping", None, timeout=0.5)
+    with pytest.raises(ShardUnavailable, match="暂时跳过"):
+        client.request("ping", None, timeout=0.5)
+
+    # 同一端口重新启动后，等待期过去就能再次连接
+    server = ShardServer(index_dir, ["a"], address)
+    start(server)
+    try:
+        time.sleep(0.25)
+        assert client.request("ping", None, timeout=1.0)["shards"] == ["a"]
+    finally:
+        client.close()
+        server.close()
+
+
+def test_status_reports_offline_server(index_dir):
+    server = ShardServer(index_dir, ["a", "b", "c"], "127.0.0.1:0")
+    config = [start(server)]
+    server.close()
+    coordinator = ShardCoordinator(config, load_router(index_dir), timeout=0.3)
+    try:
+        assert coordinator.status() == {config[0]["address"]: None}
+    finally:
+        coordinator.close()
+
+
+def test_authkey_required_off_loopback(monkeypatch):
+    monkeypatch.delenv("SHARD_AUTHKEY", raising=False)
+    assert authkey_for("127.0.0.1")
+    with pytest.raises(ValueError):
+        authkey_for("0.0.0.0")
+    with pytest.raises(ValueError):
+        ShardServer(".", [], "0.0.0.0:0")
+    monkeypatch.setenv("SHARD_AUTHKEY", "secret")
+    assert authkey_for("10.0.0.1") == b"secret"